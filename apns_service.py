@@ -1,12 +1,15 @@
 from __future__ import unicode_literals, print_function, division, absolute_import
 from pprint import pprint
 import logging
-import copy
 import time
+import ssl
 
+import simplejson as json
 import apns
 import socks
 
+import http2
+
 
 logger = logging.getLogger(__name__)
 
@@ -17,12 +20,74 @@ class APNSError(Exception):
 
 
 class NotConnectedError(APNSError):
-    """Exception to be raised when connection to notification service has been severed"""
-    pass
+    """Exception to be raised when connection to notification service has been severed.
+    Results of the tokens answered before that, if any, are kept in results (None for the others).
+    """
+    def __init__(self, *args, **kwargs):
+        self.results = kwargs.pop('results', None)
+        APNSError.__init__(self, *args, **kwargs)
+
+
+class ResultError(APNSError):
+    """Some notifications were rejected by APNS. Per-token results are kept in results."""
+    def __init__(self, *args, **kwargs):
+        self.results = kwargs.pop('results', None)
+        APNSError.__init__(self, *args, **kwargs)
+
+
+def expiration(expires_at=None):
+    """APNS expiration time of a notification (epoch seconds): its expiry time if it has one, an hour from now otherwise"""
+    return int(expires_at) if expires_at else int(time.time()) + 3600
+
+
+class Payload(object):
+    """APNS payload, encoded to json once.
+    APNS calls accept it in place of a payload dict, and every token of a multicast
+    (and the apns library, which only calls json()) reuse the same encoded bytes.
+    Silent notifications (content-available, with no alert, sound or badge) have the background
+    push type, and have to be sent with priority 5. Others are alerts, sent with priority 10.
+    """
+    def __init__(self, payload):
+        payload = dict(payload)
+        aps = {}
+        alert = payload.pop('alert', None)
+        if alert:
+            aps['alert'] = alert
+        sound = payload.pop('sound', None)
+        if sound:
+            aps['sound'] = sound
+        badge = payload.pop('badge', None)
+        if badge is not None:
+            aps['badge'] = int(badge)
+        category = payload.pop('category', None)
+        if category:
+            aps['category'] = category
+        if payload.pop('content-available', False):
+            aps['content-available'] = 1
+        silent = 'content-available' in aps and not any(k in aps for k in ('alert', 'sound', 'badge'))
+        self.push_type = 'background' if silent else 'alert'
+        self.priority = 5 if silent else 10
+        content = {'aps': aps}
+        content.update(payload)
+        self._data = json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    @property
+    def data(self):
+        """json encoded payload, as bytes"""
+        return self._data
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    def json(self):
+        # the interface of apns.Payload used by the apns library
+        return self._data
 
 
 class APNS(object):
-    """Encapsulation of FCM calls
+    """Encapsulation of APNS calls
+    gateway and feedback ("host:port") point the connections at stand-in servers instead of apple servers.
     """
     MAX_PAYLOAD_SIZE = 2 * 1024
 
@@ -30,6 +95,8 @@ class APNS(object):
         self.cert = kwargs['cert']
         self.key = kwargs['key']
         self.release = kwargs.get('release', False)
+        self.gateway = kwargs.get('gateway')
+        self.feedback = kwargs.get('feedback')
         params = {
             'use_sandbox': not self.release,
             'cert_file': self.cert,
@@ -49,51 +116,42 @@ class APNS(object):
 
         try:
             self.service = apns.APNs(**params)
+            if self.gateway:
+                self.point(self.service.gateway_server, self.gateway)
         except Exception as e:
             raise APNSError(e)
 
+    @staticmethod
+    def point(connection, address):
+        """Point an apns library connection, which is not connected yet, at the given host:port address"""
+        host, port = address.rsplit(':', 1)
+        connection.server = host
+        connection.port = int(port)
+
     def notify_single(self, **kwargs):
         token = kwargs['token']
-        payload_dict = copy.deepcopy(kwargs['payload'])
-
-        params = {
-            'alert': payload_dict.pop('alert', None),
-            'badge': payload_dict.pop('badge', None),
-            'sound': payload_dict.pop('sound', None),
-            'category': payload_dict.pop('category', None),
-            'content_available': payload_dict.pop('content-available', False),
-        }
-        params['custom'] = payload_dict
-        payload = apns.Payload(**params)
-        # TODO: ensure that payload size is not larger than max APNS notification payload size
+        payload = kwargs['payload']
+        if not isinstance(payload, Payload):
+            payload = Payload(payload)
 
         try:
-            ret = self.service.gateway_server.send_notification(token, payload)
+            ret = self.service.gateway_server.send_notification(token, payload, expiry=expiration(kwargs.get('expiry')))
             return ret
         except Exception as e:
             raise APNSError(e)
 
     def notify_multiple(self, **kwargs):
-        payload_dict = copy.deepcopy(kwargs['payload'])
-
-        params = {
-            'alert': payload_dict.pop('alert', None),
-            'badge': payload_dict.pop('badge', None),
-            'sound': payload_dict.pop('sound', None),
-            'category': payload_dict.pop('category', None),
-            'content_available': payload_dict.pop('content-available', False),
-        }
-        params['custom'] = payload_dict
-        payload = apns.Payload(**params)
+        payload = kwargs['payload']
+        if not isinstance(payload, Payload):
+            payload = Payload(payload)
 
         frame = apns.Frame()
         identifier = 1
-        expiry = time.time() + 3600
-        priority = 10
+        expiry = expiration(kwargs.get('expiry'))
 
         try:
             for token in kwargs['token']:
-                frame.add_item(token, payload, identifier, expiry, priority)
+                frame.add_item(token, payload, identifier, expiry, payload.priority)
             ret = self.service.gateway_server.send_notification_multiple(frame)
             return ret
         except Exception as e:
@@ -109,6 +167,8 @@ class APNS(object):
 
         try:
             service = apns.APNs(**params)
+            if self.feedback:
+                self.point(service.feedback_server, self.feedback)
             res = []
             for (token_hex, fail_time) in service.feedback_server.items():
                 res.append((token_hex, fail_time))
@@ -122,3 +182,104 @@ class APNS(object):
         for num, msg in enumerate(msgs):
             result_strs.append('Msg #{}: {}'.format(num, msg))
         return '\n'.join(result_strs)
+
+
+class APNSHTTP2(object):
+    """Encapsulation of APNS calls over the HTTP/2 provider API
+
+    Every token gets its own request and response. Requests are sent as concurrent streams,
+    spread over a small pool of connections.
+    """
+    MAX_PAYLOAD_SIZE = 4 * 1024
+    HOSTS = {
+        True: 'api.push.apple.com',
+        False: 'api.sandbox.push.apple.com',
+    }
+
+    def __init__(self, **kwargs):
+        self.cert = kwargs['cert']
+        self.key = kwargs['key']
+        self.release = kwargs.get('release', False)
+        self.topic = kwargs.get('topic')
+        self.timeout = kwargs.get('timeout', 10)
+        host = kwargs.get('host') or APNSHTTP2.HOSTS[self.release]
+        port = int(kwargs.get('port') or 443)
+
+        ssl_context = None
+        if kwargs.get('secure', True):
+            try:
+                ssl_context = ssl.create_default_context(cafile=kwargs.get('ca'))
+                ssl_context.load_cert_chain(self.cert, self.key)
+                ssl_context.set_alpn_protocols(['h2'])
+            except (ssl.SSLError, IOError) as e:
+                raise APNSError(e)
+
+        proxy = None
+        if 'proxy' in kwargs and kwargs['proxy']:
+            proxy_type, proxy_addr = kwargs['proxy'].split('://', 1)
+            if proxy_type != 'http':
+                raise APNSError('only http proxies are supported for APNS over HTTP/2')
+            addr, port_str = proxy_addr.split(':', 2)
+            proxy = (addr, int(port_str))
+
+        try:
+            self.connections = [
+                http2.Connection(host, port, ssl_context=ssl_context, proxy=proxy, timeout=self.timeout,
+                                 max_streams=kwargs.get('max_concurrent_streams', 500))
+                for _ in range(kwargs.get('pool_size', 2))
+            ]
+        except http2.HTTP2Error as e:
+            raise APNSError(e)
+
+    def headers(self, payload, expiry=None):
+        """Request headers of a Payload, expiring at the given time (epoch seconds)"""
+        headers = [
+            ('apns-push-type', payload.push_type),
+            ('apns-priority', str(payload.priority)),
+            ('apns-expiration', str(expiration(expiry))),
+        ]
+        if self.topic:
+            headers.append(('apns-topic', self.topic))
+        return headers
+
+    def send(self, tokens, payload, expiry=None):
+        """Send the payload (a dict or a Payload) to all tokens, and return per-token results in the same order.
+        Each result is a dict with the http status and, for rejected notifications, the reason.
+        """
+        if not isinstance(payload, Payload):
+            payload = Payload(payload)
+        body = payload.data
+        headers = self.headers(payload, expiry)
+        for i, token in enumerate(tokens):
+            self.connections[i % len(self.connections)].submit('POST', '/3/device/{}'.format(token), headers, body, tag=i)
+
+        results = [None] * len(tokens)
+        try:
+            for response in http2.perform(self.connections, timeout=self.timeout):
+                result = {'status': response.status}
+                if response.status != 200:
+                    try:
+                        result['reason'] = json.loads(response.body.decode('utf-8')).get('reason')
+                    except ValueError:
+                        result['reason'] = None
+                results[response.tag] = result
+        except http2.HTTP2Error as e:
+            for conn in self.connections:
+                conn.close()
+            raise NotConnectedError(e, results=results)
+
+        failed = sum(1 for result in results if result['status'] != 200)
+        if failed:
+            raise ResultError('Some notifications were rejected by APNS. {} expected, {} failed'.format(
+                len(tokens), failed), results=results)
+        return results
+
+    def notify_single(self, **kwargs):
+        return self.send([kwargs['token']], kwargs['payload'], kwargs.get('expiry'))
+
+    def notify_multiple(self, **kwargs):
+        return self.send(kwargs['token'], kwargs['payload'], kwargs.get('expiry'))
+
+    def feedback_messages(self):
+        # there is no feedback service with HTTP/2 API. rejected tokens are reported in per-token results
+        return []
@@ -0,0 +1,128 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import os
+import time
+import random
+import logging
+import threading
+
+import simplejson as json
+
+import settings
+import notifier
+import fcm_service
+import apns_service
+
+
+logger = logging.getLogger(__name__)
+
+BODY_PREFIX = 'bench:'
+
+
+def bench_body(size, sent_at=None):
+    """Body of a benchmark message, carrying the time it was sent to the webservice, padded to size bytes"""
+    head = '{}{:.6f}:'.format(BODY_PREFIX, time.time() if sent_at is None else sent_at)
+    return head + 'x' * max(0, size - len(head))
+
+
+def sent_at(body):
+    """Time a benchmark message was sent to the webservice, from its body. None for other messages."""
+    if not body or not body.startswith(BODY_PREFIX):
+        return None
+    try:
+        return float(body[len(BODY_PREFIX):].split(':', 1)[0])
+    except ValueError:
+        return None
+
+
+class Recorder(object):
+    """Record deliveries to fake services, as lines of "<sent at> <delivered at> <number of tokens>"
+    in a file per process (notifier processes are forked), named after the given path and the pid.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.pid = None
+        self.file = None
+        self.lock = threading.Lock()
+
+    def record(self, body, count):
+        started = sent_at(body)
+        if started is None or not self.path:
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.file = open('{}.{}'.format(self.path, self.pid), 'a')
+            self.file.write('{:.6f} {:.6f} {}\n'.format(started, time.time(), count))
+            self.file.flush()
+
+
+recorder = Recorder(None)
+latencies = {'fcm': 0, 'apns': 0}
+jitter = 0
+
+
+def wait(provider):
+    """Take as long as a call to the service, with a random jitter of up to the given share of it"""
+    latency = latencies[provider]
+    if latency > 0:
+        time.sleep(latency * random.uniform(1 - jitter, 1 + jitter))
+
+
+class FakeFCM(fcm_service.FCM):
+    """FCM accepting every token after a configurable latency, without network calls"""
+    def __init__(self, **kwargs):
+        self.adapter = None
+
+    def send(self, registration_ids, payload):
+        if not isinstance(payload, fcm_service.Payload):
+            payload = fcm_service.Payload(payload)
+        wait('fcm')
+        body = json.loads(payload.data.decode('utf-8')).get('notification', {}).get('body')
+        recorder.record(body, len(registration_ids))
+        return [{'message_id': 'bench:{}'.format(i)} for i in range(len(registration_ids))]
+
+
+class FakeAPNS(apns_service.APNS):
+    """Binary protocol APNS accepting every token after a configurable latency"""
+    def __init__(self, **kwargs):
+        self.cert = kwargs.get('cert')
+        self.key = kwargs.get('key')
+        self.release = kwargs.get('release', False)
+
+    def send(self, tokens, payload):
+        if not isinstance(payload, apns_service.Payload):
+            payload = apns_service.Payload(payload)
+        wait('apns')
+        recorder.record(json.loads(payload.data.decode('utf-8'))['aps'].get('alert'), len(tokens))
+        return [{'status': 200} for _ in tokens]
+
+    def notify_single(self, **kwargs):
+        return self.send([kwargs['token']], kwargs['payload'])
+
+    def notify_multiple(self, **kwargs):
+        return self.send(kwargs['token'], kwargs['payload'])
+
+    def feedback_messages(self):
+        return []
+
+
+class FakeAPNSHTTP2(FakeAPNS):
+    """HTTP/2 APNS accepting every token after a configurable latency"""
+    MAX_PAYLOAD_SIZE = apns_service.APNSHTTP2.MAX_PAYLOAD_SIZE
+
+
+def install(fcm_latency=0, apns_latency=0, latency_jitter=0, delivery_log=None):
+    """Replace notification service classes with fakes, in this process and processes forked from it.
+    The async engine calls FCM with an http client of its own, so notifiers are switched to threads.
+    """
+    global recorder, jitter
+    latencies.update(fcm=fcm_latency, apns=apns_latency)
+    jitter = latency_jitter
+    recorder = Recorder(delivery_log)
+    fcm_service.FCM = FakeFCM
+    apns_service.APNS = FakeAPNS
+    apns_service.APNSHTTP2 = FakeAPNSHTTP2
+    # no certificates are needed to talk to fakes
+    notifier.validate_pem_file = lambda pem_file, header=None: True
+    settings.NOTIFIER['engine'] = 'thread'
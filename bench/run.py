@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+"""End-to-end benchmark of pontiac-server.
+
+Starts the server (see server.py) with each given queuer, and a local redis-server for the redis queuer,
+posts notification messages to /notif with a number of concurrent clients, and waits for the fake
+notification services to get them. Reports requests and notifications accepted per second, tokens
+delivered per second, and p50/p99 of accept latency (http response time) and end-to-end latency
+(from posting a message to a fake service getting it) as json.
+Results can be saved as a baseline, and compared against one: it exits with status 1 if any
+result is worse than the baseline by more than the tolerance.
+"""
+
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import os
+import sys
+import glob
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from six.moves import queue
+
+import requests
+import simplejson as json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import fakes
+
+SERVER = os.path.join(HERE, 'server.py')
+
+# result fields compared against a baseline, and whether higher values are better
+COMPARED = (
+    ('requests_per_sec', True),
+    ('notifications_per_sec', True),
+    ('delivered_tokens_per_sec', True),
+    ('accept_latency.p50', False),
+    ('accept_latency.p99', False),
+    ('e2e_latency.p50', False),
+    ('e2e_latency.p99', False),
+)
+
+
+def token_distribution(spec):
+    """Parse a distribution of token counts per message, as "count:weight,count:weight,..." """
+    try:
+        pairs = [part.split(':') for part in spec.split(',')]
+        return [int(count) for count, _ in pairs], [float(weight) for _, weight in pairs]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected "count:weight,...", got "{}"'.format(spec))
+
+
+def percentile(samples, share):
+    """Nearest rank percentile of a list of (value, weight) pairs"""
+    if not samples:
+        return None
+    samples = sorted(samples)
+    total = sum(weight for _, weight in samples)
+    rank = share * total
+    seen = 0
+    for value, weight in samples:
+        seen += weight
+        if seen >= rank:
+            return value
+    return samples[-1][0]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, proc, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('process exited with status {} before listening on port {}'.format(proc.returncode, port))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('nothing listening on port {} after {} seconds'.format(port, timeout))
+
+
+def stop(proc, timeout=10):
+    if proc is None or proc.poll() is not None:
+        return
+    proc.terminate()
+    deadline = time.time() + timeout
+    while proc.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+
+
+def make_requests(args):
+    """Build the bodies of all requests up front, with bodies to be stamped when sent.
+    Tokens are unique, so that none are left out as duplicates.
+    """
+    counts, weights = args.tokens
+    rand = random.Random(args.seed)
+    serial = [0]
+
+    def tokens(provider, count):
+        serial[0] += count
+        if provider == 'apns':
+            return ['{:064x}'.format(n) for n in range(serial[0] - count, serial[0])]
+        return ['bench-token-{}'.format(n) for n in range(serial[0] - count, serial[0])]
+
+    batches = []
+    for _ in range(args.requests):
+        msgs = []
+        for _ in range(args.batch_size):
+            provider = 'apns' if rand.random() < args.apns_share else 'fcm'
+            msgs.append({'type': provider, 'tokens': tokens(provider, weighted_choice(rand, counts, weights))})
+        batches.append(msgs)
+    return batches
+
+
+def weighted_choice(rand, values, weights):
+    point = rand.uniform(0, sum(weights))
+    for value, weight in zip(values, weights):
+        point -= weight
+        if point <= 0:
+            return value
+    return values[-1]
+
+
+def drive(url, batches, args):
+    """Post the given batches of messages with concurrent clients.
+    Returns (start time, end time, list of (status, accept latency, messages, tokens)).
+    """
+    todo = queue.Queue()
+    for msgs in batches:
+        todo.put(msgs)
+    outcomes = []
+    lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        while True:
+            try:
+                msgs = todo.get_nowait()
+            except queue.Empty:
+                return
+            body = fakes.bench_body(args.payload_size)
+            data = json.dumps([dict(msg, body=body) for msg in msgs])
+            start = time.time()
+            try:
+                status = session.post(url, data=data, timeout=args.timeout).status_code
+            except requests.RequestException:
+                status = None
+            outcome = (status, time.time() - start, len(msgs), sum(len(msg['tokens']) for msg in msgs))
+            with lock:
+                outcomes.append(outcome)
+
+    clients = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    start = time.time()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return start, time.time(), outcomes
+
+
+def read_deliveries(delivery_log):
+    deliveries = []
+    for path in glob.glob('{}.*'.format(delivery_log)):
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3:
+                    deliveries.append((float(parts[0]), float(parts[1]), int(parts[2])))
+    return deliveries
+
+
+def run(queuer, args):
+    """Benchmark the server with the given queuer, and return its results"""
+    workdir = tempfile.mkdtemp(prefix='pontiac-bench-')
+    redis_proc = server_proc = None
+    try:
+        config = {
+            'port': args.port or free_port(),
+            'fcm_latency': args.latency,
+            'apns_latency': args.latency,
+            'jitter': args.jitter,
+            'delivery_log': os.path.join(workdir, 'deliveries'),
+            'log_level': args.log_level,
+            'log_dir': workdir,
+        }
+        if queuer == 'redis':
+            config['redis_port'] = free_port()
+            redis_proc = subprocess.Popen([args.redis_server, '--port', str(config['redis_port']), '--save', '',
+                                           '--appendonly', 'no', '--dir', workdir],
+                                          stdout=open(os.path.join(workdir, 'redis.log'), 'w'), stderr=subprocess.STDOUT)
+            wait_for_port(config['redis_port'], redis_proc, args.startup_timeout)
+        server_log = os.path.join(workdir, 'server.log')
+        server_proc = subprocess.Popen([sys.executable, SERVER, json.dumps(config), '--queuer', queuer, '--executer', args.executer],
+                                       stdout=open(server_log, 'w'), stderr=subprocess.STDOUT)
+        wait_for_port(config['port'], server_proc, args.startup_timeout)
+        # let notifiers connect to the fakes before taking time
+        time.sleep(1)
+
+        batches = make_requests(args)
+        start, end, outcomes = drive('http://127.0.0.1:{}/notif'.format(config['port']), batches, args)
+        accepted = [outcome for outcome in outcomes if outcome[0] == 202]
+        expected_tokens = sum(outcome[3] for outcome in accepted)
+
+        deadline = time.time() + args.drain_timeout
+        deliveries = read_deliveries(config['delivery_log'])
+        while sum(count for _, _, count in deliveries) < expected_tokens and time.time() < deadline:
+            if server_proc.poll() is not None:
+                break
+            time.sleep(0.2)
+            deliveries = read_deliveries(config['delivery_log'])
+        delivered_tokens = sum(count for _, _, count in deliveries)
+        duration = max(end - start, 1e-6)
+        last_delivery = max([delivered for _, delivered, _ in deliveries] or [end])
+        return {
+            'queuer': queuer,
+            'executer': args.executer,
+            'requests': len(outcomes),
+            'accepted': len(accepted),
+            'refused': sum(1 for outcome in outcomes if outcome[0] == 429),
+            'errors': sum(1 for outcome in outcomes if outcome[0] not in (202, 429)),
+            'notifications': sum(outcome[2] for outcome in accepted),
+            'tokens': expected_tokens,
+            'delivered_tokens': delivered_tokens,
+            'requests_per_sec': len(accepted) / duration,
+            'notifications_per_sec': sum(outcome[2] for outcome in accepted) / duration,
+            'delivered_tokens_per_sec': delivered_tokens / max(last_delivery - start, 1e-6),
+            'accept_latency': {
+                'p50': percentile([(outcome[1], 1) for outcome in outcomes], 0.5),
+                'p99': percentile([(outcome[1], 1) for outcome in outcomes], 0.99),
+            },
+            'e2e_latency': {
+                'p50': percentile([(delivered - sent, count) for sent, delivered, count in deliveries], 0.5),
+                'p99': percentile([(delivered - sent, count) for sent, delivered, count in deliveries], 0.99),
+            },
+        }
+    except (RuntimeError, OSError) as e:
+        return {'queuer': queuer, 'executer': args.executer, 'error': str(e)}
+    finally:
+        stop(server_proc)
+        stop(redis_proc)
+        if args.keep:
+            print('kept logs of {} run in {}'.format(queuer, workdir), file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def field(result, name):
+    for part in name.split('.'):
+        result = result.get(part) if isinstance(result, dict) else None
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """List results worse than the baseline by more than tolerance (a share of the baseline value)"""
+    regressions = []
+    for queuer, result in results.items():
+        base = baseline.get('results', {}).get(queuer)
+        if not base or 'error' in result or 'error' in base:
+            continue
+        for name, higher_is_better in COMPARED:
+            value, base_value = field(result, name), field(base, name)
+            if not value or not base_value:
+                continue
+            change = (value - base_value) / base_value
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append({'queuer': queuer, 'field': name, 'baseline': base_value, 'value': value,
+                                    'change': change})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='pontiac-bench', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--queuer', choices=['queue', 'redis'], action='append', help='queuers to run with (default both)')
+    parser.add_argument('--executer', choices=['thread', 'process'], default='thread')
+    parser.add_argument('--requests', type=int, default=2000, help='number of http requests')
+    parser.add_argument('--concurrency', type=int, default=16, help='number of concurrent clients')
+    parser.add_argument('--batch-size', type=int, default=10, help='messages per request')
+    parser.add_argument('--tokens', type=token_distribution, default=token_distribution('1:70,10:25,500:5'),
+                        help='distribution of tokens per message, as "count:weight,..."')
+    parser.add_argument('--payload-size', type=int, default=256, help='size of message bodies, in bytes')
+    parser.add_argument('--apns-share', type=float, default=0.2, help='share of messages to APNS, the others go to FCM')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds each call to a fake service takes')
+    parser.add_argument('--jitter', type=float, default=0.5, help='share of the latency calls randomly take more or less')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--port', type=int, default=None, help='port of the webservice (default a free one)')
+    parser.add_argument('--redis-server', default='redis-server', help='redis-server executable')
+    parser.add_argument('--timeout', type=float, default=30, help='http request timeout, in seconds')
+    parser.add_argument('--startup-timeout', type=float, default=30)
+    parser.add_argument('--drain-timeout', type=float, default=120, help='seconds to wait for deliveries after the last request')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the server')
+    parser.add_argument('--keep', action='store_true', help='keep server and redis logs')
+    parser.add_argument('--output', help='file to write results to (default stdout)')
+    parser.add_argument('--save-baseline', help='file to save results to as a baseline')
+    parser.add_argument('--baseline', help='baseline file to compare results against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='share of a baseline value results may be worse by')
+    args = parser.parse_args()
+
+    results = dict((queuer, run(queuer, args)) for queuer in args.queuer or ['queue', 'redis'])
+    report = {
+        'config': dict((key, value) for key, value in vars(args).items()
+                       if key not in ('output', 'save_baseline', 'baseline', 'keep')),
+        'results': results,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = compare(results, json.load(f), args.tolerance)
+    content = json.dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(content)
+    else:
+        print(content)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            f.write(content)
+    for regression in report.get('regressions', []):
+        print('{queuer}: {field} is {value:.4g}, {change:+.1%} from baseline {baseline:.4g}'.format(**regression), file=sys.stderr)
+    sys.exit(1 if report.get('regressions') else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Run pontiac-server.py against in-process fake notification services, for benchmarks.
+
+usage: server.py CONFIG [pontiac-server.py arguments]
+
+CONFIG is a json object with:
+  port: port of the webservice
+  redis_port: port of the redis server, with --queuer redis
+  fcm_latency, apns_latency: seconds each call to a fake service takes
+  jitter: share of the latency calls randomly take more or less
+  delivery_log: path prefix of files deliveries are recorded in (see fakes.Recorder)
+  log_level: level of the root logger
+  log_dir: directory of log files (default ./logs)
+"""
+
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import os
+import sys
+import runpy
+
+import simplejson as json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import settings
+import fakes
+
+SERVER_SCRIPT = os.path.join(ROOT, 'pontiac-server.py')
+
+
+def configure(config):
+    settings.HTTP_SOCKET['port'] = int(config.get('port', settings.HTTP_SOCKET['port']))
+    if config.get('redis_port'):
+        settings.REDIS['port'] = int(config['redis_port'])
+    # webservice processes are started from pontiac-server.py itself, without this configuration
+    settings.THREAD_COUNT['WEBSERVICE'] = 1
+    settings.LOGGING['root']['level'] = config.get('log_level', 'WARNING')
+    if config.get('log_dir'):
+        for handler in settings.LOGGING['handlers'].values():
+            if 'filename' in handler:
+                handler['filename'] = os.path.join(config['log_dir'], os.path.basename(handler['filename']))
+    fakes.install(fcm_latency=config.get('fcm_latency', 0), apns_latency=config.get('apns_latency', 0),
+                  latency_jitter=config.get('jitter', 0), delivery_log=config.get('delivery_log'))
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(2)
+    configure(json.loads(sys.argv[1]))
+    # paths in settings are relative to the repository
+    os.chdir(ROOT)
+    sys.argv = [SERVER_SCRIPT] + sys.argv[2:]
+    runpy.run_path(SERVER_SCRIPT, run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
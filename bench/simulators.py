@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+"""Stand-in FCM and APNS servers, to hammer notifiers without quotas.
+
+The FCM simulator speaks the legacy http api (POST /fcm/send, as fcm_service calls it), the APNS
+simulators speak the binary gateway and feedback protocols (as the apns library calls them, for
+apns_service.APNS) and the HTTP/2 provider API (for apns_service.APNSHTTP2, needs the h2 package).
+Each request (FCM), notification frame (APNS binary) or stream (APNS HTTP/2) takes a latency drawn
+from a given distribution, and fails with given rates:
+  - per-token errors, by name (e.g. NotRegistered for FCM, Unregistered or BadDeviceToken for APNS).
+    With the binary protocol, Unregistered tokens are accepted and reported by the feedback service,
+    and other errors are answered with an invalid token error response, closing the connection.
+  - throttling (FCM and APNS HTTP/2 answer 429, APNS binary answers shutdown and closes)
+  - unavailability (503)
+  - connection resets, without any answer
+  - canonical ids for FCM tokens
+With --tls, servers use certificates signed by a test CA generated in --cert-dir. Settings pointing
+pontiac at the simulators are printed on start.
+"""
+
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import os
+import sys
+import ssl
+import time
+import heapq
+import random
+import select
+import socket
+import struct
+import logging
+import argparse
+import binascii
+import itertools
+import threading
+import subprocess
+from collections import deque
+
+import six
+from six.moves import BaseHTTPServer, socketserver
+import simplejson as json
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+except ImportError:
+    h2 = None
+
+
+logger = logging.getLogger(__name__)
+
+# binary protocol error response statuses
+APNS_INVALID_TOKEN = 8
+APNS_SHUTDOWN = 10
+APNS_PROCESSING_ERROR = 1
+
+
+def parse_latency(spec):
+    """Parse a latency distribution, returning a function drawing seconds from a random.Random.
+    Distributions are "fixed:SECONDS", "uniform:LOW:HIGH", "exp:MEAN" and "lognormal:MEDIAN:SIGMA".
+    """
+    name, _, params = spec.partition(':')
+    try:
+        params = [float(param) for param in params.split(':')] if params else []
+        if name == 'fixed':
+            value, = params or [0]
+            return lambda rand: value
+        if name == 'uniform':
+            low, high = params
+            return lambda rand: rand.uniform(low, high)
+        if name == 'exp':
+            mean, = params
+            return lambda rand: rand.expovariate(1 / mean) if mean > 0 else 0
+        if name == 'lognormal':
+            median, sigma = params
+            return lambda rand: median * rand.lognormvariate(0, sigma)
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError('invalid latency distribution: "{}"'.format(spec))
+
+
+def parse_rates(specs):
+    """Parse a list of "NAME=RATE" into a dict"""
+    rates = {}
+    for spec in specs or []:
+        name, _, rate = spec.partition('=')
+        try:
+            rates[name] = float(rate)
+        except ValueError:
+            raise argparse.ArgumentTypeError('invalid error rate: "{}"'.format(spec))
+    return rates
+
+
+class Behavior(object):
+    """Latency and failures of a simulated service. Rates are shares of requests (or tokens, for errors
+    and canonical ids) in [0, 1].
+    """
+    def __init__(self, latency='fixed:0', errors=None, throttle_rate=0, unavailable_rate=0, reset_rate=0,
+                 canonical_rate=0, seed=None):
+        self.latency = parse_latency(latency) if isinstance(latency, six.string_types) else latency
+        self.errors = sorted((errors or {}).items())
+        self.throttle_rate = throttle_rate
+        self.unavailable_rate = unavailable_rate
+        self.reset_rate = reset_rate
+        self.canonical_rate = canonical_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def draw(self):
+        with self.lock:
+            return self.random.random()
+
+    def chance(self, rate):
+        return rate > 0 and self.draw() < rate
+
+    def delay(self):
+        """Seconds a request takes"""
+        with self.lock:
+            return max(0, self.latency(self.random))
+
+    def token_error(self):
+        """Name of the error a token fails with, or None"""
+        point = self.draw()
+        for name, rate in self.errors:
+            if point < rate:
+                return name
+            point -= rate
+        return None
+
+    def outcome(self):
+        """Fate of a request as a whole: "reset", "throttled", "unavailable" or None"""
+        point = self.draw()
+        for name, rate in (('reset', self.reset_rate), ('throttled', self.throttle_rate), ('unavailable', self.unavailable_rate)):
+            if point < rate:
+                return name
+            point -= rate
+        return None
+
+
+def reset(sock):
+    """Close a connection with a reset, as a crashing server or a middlebox would"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack(str('ii'), 1, 0))
+        sock.close()
+    except (socket.error, ValueError):
+        pass
+
+
+def generate_certs(directory):
+    """Generate (once) a test CA, a server certificate for localhost signed by it, and a client
+    certificate for APNS, with the openssl command. Returns a dict of their paths.
+    """
+    paths = dict((name, os.path.join(directory, name)) for name in
+                 ['ca.pem', 'ca.key', 'server.pem', 'server.key', 'client.pem', 'client.key'])
+    if all(os.path.exists(path) for path in paths.values()):
+        return paths
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    ext = os.path.join(directory, 'server.ext')
+    with open(ext, 'w') as f:
+        f.write('subjectAltName=DNS:localhost,IP:127.0.0.1\n')
+
+    def openssl(*args):
+        subprocess.check_call(('openssl',) + args, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+    openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '365', '-subj', '/CN=pontiac simulator CA',
+            '-keyout', paths['ca.key'], '-out', paths['ca.pem'])
+    for name, subject, extra in (('server', '/CN=localhost', ('-extfile', ext)), ('client', '/CN=pontiac simulator client', ())):
+        csr = os.path.join(directory, '{}.csr'.format(name))
+        openssl('req', '-newkey', 'rsa:2048', '-nodes', '-subj', subject,
+                '-keyout', paths['{}.key'.format(name)], '-out', csr)
+        openssl('x509', '-req', '-in', csr, '-CA', paths['ca.pem'], '-CAkey', paths['ca.key'], '-CAcreateserial',
+                '-days', '365', '-out', paths['{}.pem'.format(name)], *extra)
+    return paths
+
+
+def server_context(certs, alpn=None):
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+    context.load_cert_chain(certs['server.pem'], certs['server.key'])
+    if alpn:
+        context.set_alpn_protocols(alpn)
+    return context
+
+
+class SimulatorMixin(object):
+    """Threaded socket server, with connections wrapped in TLS (handshaking on the handler thread) if a context is given"""
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def setup_simulator(self, behavior, ssl_context=None):
+        self.behavior = behavior
+        self.ssl_context = ssl_context
+
+    def get_request(self):
+        sock, address = self.socket.accept()
+        if self.ssl_context is not None:
+            sock = self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        return sock, address
+
+    def handle_error(self, request, client_address):
+        logger.debug('simulator connection from {} failed: {}'.format(client_address, sys.exc_info()[1]))
+
+
+class FCMHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    message_ids = itertools.count(1)
+
+    def do_POST(self):
+        behavior = self.server.behavior
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        time.sleep(behavior.delay())
+        outcome = behavior.outcome()
+        if outcome == 'reset':
+            reset(self.connection)
+            self.close_connection = True
+            self.wfile = six.BytesIO()
+            return
+        if not (self.headers.get('Authorization') or '').startswith('key='):
+            return self.respond(401, b'<HTML><TITLE>Unauthorized</TITLE></HTML>', 'text/html')
+        try:
+            request = json.loads(body.decode('utf-8'))
+            tokens = request['registration_ids'] if 'registration_ids' in request else [request['to']]
+        except (ValueError, KeyError, TypeError):
+            return self.respond(400, b'bad request', 'text/plain')
+        if outcome == 'throttled':
+            return self.respond(429, b'', 'text/plain', retry_after=1)
+        if outcome == 'unavailable':
+            return self.respond(503, b'', 'text/plain', retry_after=1)
+        results = []
+        for token in tokens:
+            error = behavior.token_error()
+            if error:
+                results.append({'error': error})
+                continue
+            result = {'message_id': '0:{}'.format(next(FCMHandler.message_ids))}
+            if behavior.chance(behavior.canonical_rate):
+                result['registration_id'] = 'canonical-{}'.format(token)
+            results.append(result)
+        failure = sum(1 for result in results if 'error' in result)
+        content = {
+            'multicast_id': next(FCMHandler.message_ids),
+            'success': len(results) - failure,
+            'failure': failure,
+            'canonical_ids': sum(1 for result in results if 'registration_id' in result),
+            'results': results,
+        }
+        self.respond(200, json.dumps(content).encode('utf-8'), 'application/json')
+
+    def respond(self, status, content, content_type, retry_after=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug('fcm simulator: ' + format % args)
+
+
+class FCMSimulator(SimulatorMixin, socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    def __init__(self, address, behavior, ssl_context=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FCMHandler)
+        self.setup_simulator(behavior, ssl_context)
+
+
+class APNSGatewayHandler(socketserver.BaseRequestHandler):
+    """Binary protocol: reads notification frames (commands 0, 1 and 2), and answers only errors"""
+    def handle(self):
+        reader = self.request.makefile('rb')
+        behavior = self.server.behavior
+        while True:
+            try:
+                notification = self.read_notification(reader)
+            except (socket.error, ssl.SSLError, struct.error):
+                return
+            if notification is None:
+                return
+            identifier, token = notification
+            time.sleep(behavior.delay())
+            outcome = behavior.outcome()
+            if outcome == 'reset':
+                return reset(self.request)
+            if outcome is not None:
+                return self.answer_error(APNS_SHUTDOWN, identifier)
+            error = behavior.token_error()
+            if error == 'Unregistered':
+                self.server.feedback.append((int(time.time()), token))
+            elif error:
+                return self.answer_error(APNS_INVALID_TOKEN, identifier)
+
+    @staticmethod
+    def read_exact(reader, size):
+        data = reader.read(size)
+        if len(data) < size:
+            raise struct.error('connection closed in the middle of a frame')
+        return data
+
+    def read_notification(self, reader):
+        """Read a notification. Returns (identifier, token), or None once the connection is closed."""
+        command = reader.read(1)
+        if not command:
+            return None
+        command = six.indexbytes(command, 0)
+        if command == 2:
+            length, = struct.unpack(str('!I'), self.read_exact(reader, 4))
+            items = self.read_exact(reader, length)
+            identifier, token, offset = 0, b'', 0
+            while offset < len(items):
+                item_id, item_length = struct.unpack(str('!BH'), items[offset:offset + 3])
+                data = items[offset + 3:offset + 3 + item_length]
+                if item_id == 1:
+                    token = data
+                elif item_id == 3:
+                    identifier, = struct.unpack(str('!I'), data)
+                offset += 3 + item_length
+        elif command in (0, 1):
+            identifier = 0
+            if command == 1:
+                identifier, _ = struct.unpack(str('!II'), self.read_exact(reader, 8))
+            token_length, = struct.unpack(str('!H'), self.read_exact(reader, 2))
+            token = self.read_exact(reader, token_length)
+            payload_length, = struct.unpack(str('!H'), self.read_exact(reader, 2))
+            self.read_exact(reader, payload_length)
+        else:
+            self.answer_error(APNS_PROCESSING_ERROR, 0)
+            return None
+        return identifier, token
+
+    def answer_error(self, status, identifier):
+        try:
+            self.request.sendall(struct.pack(str('!BBI'), 8, status, identifier))
+        except (socket.error, ssl.SSLError):
+            pass
+
+
+class APNSFeedbackHandler(socketserver.BaseRequestHandler):
+    """Feedback protocol: sends the tokens reported as unregistered since the last connection, and closes"""
+    def handle(self):
+        entries = []
+        while self.server.feedback:
+            entries.append(self.server.feedback.popleft())
+        data = b''.join(struct.pack(str('!IH'), when, len(token)) + token for when, token in entries)
+        try:
+            self.request.sendall(data)
+        except (socket.error, ssl.SSLError):
+            pass
+
+
+class APNSSimulator(SimulatorMixin, socketserver.ThreadingMixIn, socketserver.TCPServer):
+    def __init__(self, address, handler, behavior, ssl_context=None, feedback=None):
+        socketserver.TCPServer.__init__(self, address, handler)
+        self.setup_simulator(behavior, ssl_context)
+        self.feedback = feedback if feedback is not None else deque()
+
+
+class APNSHTTP2Handler(socketserver.BaseRequestHandler):
+    """HTTP/2 provider API: answers every stream on /3/device/<token> after its own latency"""
+    def handle(self):
+        if h2 is None:
+            return
+        sock = self.request
+        behavior = self.server.behavior
+        conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False, header_encoding='utf-8'))
+        conn.initiate_connection()
+        try:
+            sock.sendall(conn.data_to_send())
+            paths = {}
+            pending = []  # heap of (due time, stream id, status, reason)
+            while True:
+                timeout = max(0, pending[0][0] - time.time()) if pending else None
+                buffered = hasattr(sock, 'pending') and sock.pending()
+                if buffered or select.select([sock], [], [], timeout)[0]:
+                    data = sock.recv(65535)
+                    if not data:
+                        return
+                    for event in conn.receive_data(data):
+                        if isinstance(event, h2.events.RequestReceived):
+                            paths[event.stream_id] = dict(event.headers).get(':path', '')
+                        elif isinstance(event, h2.events.DataReceived):
+                            conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                        elif isinstance(event, h2.events.StreamEnded):
+                            status, reason = self.decide(behavior, paths.pop(event.stream_id, ''))
+                            heapq.heappush(pending, (time.time() + behavior.delay(), event.stream_id, status, reason))
+                        elif isinstance(event, h2.events.ConnectionTerminated):
+                            return
+                now = time.time()
+                while pending and pending[0][0] <= now:
+                    _, stream_id, status, reason = heapq.heappop(pending)
+                    if status is None:
+                        # streams answered before are not lost with the connection
+                        sock.sendall(conn.data_to_send())
+                        return reset(sock)
+                    self.answer(conn, stream_id, status, reason)
+                sock.sendall(conn.data_to_send())
+        except (socket.error, ssl.SSLError, h2.exceptions.ProtocolError) as e:
+            logger.debug('apns http/2 simulator connection failed: {}'.format(e))
+
+    @staticmethod
+    def decide(behavior, path):
+        """Status and reason of the response to a request"""
+        if not path.startswith('/3/device/'):
+            return 404, 'BadPath'
+        outcome = behavior.outcome()
+        if outcome == 'reset':
+            return None, None
+        if outcome == 'throttled':
+            return 429, 'TooManyRequests'
+        if outcome == 'unavailable':
+            return 503, 'ServiceUnavailable'
+        error = behavior.token_error()
+        if error == 'Unregistered':
+            return 410, error
+        if error:
+            return 400, error
+        return 200, None
+
+    @staticmethod
+    def answer(conn, stream_id, status, reason):
+        headers = [(':status', str(status)), ('apns-id', binascii.hexlify(os.urandom(16)).decode('ascii'))]
+        if reason is None:
+            conn.send_headers(stream_id, headers, end_stream=True)
+            return
+        content = {'reason': reason}
+        if status == 410:
+            content['timestamp'] = int(time.time() * 1000)
+        body = json.dumps(content).encode('utf-8')
+        conn.send_headers(stream_id, headers + [('content-length', str(len(body)))])
+        conn.send_data(stream_id, body, end_stream=True)
+
+
+def serve(server, name):
+    thread = threading.Thread(target=server.serve_forever, name=name)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='pontiac-simulators', description='stand-in FCM and APNS servers')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--fcm-port', type=int, default=8001, help='0 disables')
+    parser.add_argument('--apns-port', type=int, default=8002, help='binary gateway. 0 disables')
+    parser.add_argument('--feedback-port', type=int, default=8003, help='binary feedback service. 0 disables')
+    parser.add_argument('--apns-http2-port', type=int, default=8004, help='HTTP/2 provider API. 0 disables')
+    parser.add_argument('--tls', action='store_true', help='serve over TLS, with certificates generated in --cert-dir')
+    parser.add_argument('--cert-dir', default='./simulator-certs')
+    parser.add_argument('--fcm-latency', type=parse_latency, default='lognormal:0.05:0.5',
+                        help='"fixed:S", "uniform:LOW:HIGH", "exp:MEAN" or "lognormal:MEDIAN:SIGMA", in seconds')
+    parser.add_argument('--apns-latency', type=parse_latency, default='lognormal:0.01:0.5')
+    parser.add_argument('--fcm-error', action='append', help='per-token error rate, e.g. NotRegistered=0.01. repeatable')
+    parser.add_argument('--apns-error', action='append', help='per-token error rate, e.g. Unregistered=0.01. repeatable')
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--unavailable-rate', type=float, default=0)
+    parser.add_argument('--reset-rate', type=float, default=0)
+    parser.add_argument('--canonical-rate', type=float, default=0, help='share of FCM tokens answered with a canonical id')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(levelname)s %(message)s')
+
+    def behavior(latency, errors):
+        return Behavior(latency=latency, errors=parse_rates(errors), throttle_rate=args.throttle_rate,
+                        unavailable_rate=args.unavailable_rate, reset_rate=args.reset_rate,
+                        canonical_rate=args.canonical_rate, seed=args.seed)
+
+    apns = args.apns_port or args.feedback_port or args.apns_http2_port
+    # the apns library always connects over TLS, and pontiac checks APNS certificates in any case
+    certs = generate_certs(args.cert_dir) if args.tls or apns else None
+    tls_context = server_context(certs) if args.tls else None
+    lines = []
+    feedback = deque()
+    if args.fcm_port:
+        server = FCMSimulator((args.host, args.fcm_port), behavior(args.fcm_latency, args.fcm_error), ssl_context=tls_context)
+        serve(server, 'fcm')
+        lines.append("FCM['endpoint'] = '{}://{}:{}/fcm/send'".format('https' if args.tls else 'http', args.host, server.server_address[1]))
+        if args.tls:
+            lines.append("FCM['ca'] = '{}'".format(os.path.abspath(certs['ca.pem'])))
+    apns_behavior = behavior(args.apns_latency, args.apns_error)
+    if args.apns_port:
+        server = APNSSimulator((args.host, args.apns_port), APNSGatewayHandler, apns_behavior,
+                               ssl_context=server_context(certs), feedback=feedback)
+        serve(server, 'apns-gateway')
+        lines.append("APNS['gateway'] = '{}:{}'".format(args.host, server.server_address[1]))
+    if args.feedback_port:
+        server = APNSSimulator((args.host, args.feedback_port), APNSFeedbackHandler, apns_behavior,
+                               ssl_context=server_context(certs), feedback=feedback)
+        serve(server, 'apns-feedback')
+        lines.append("APNS['feedback'] = '{}:{}'".format(args.host, server.server_address[1]))
+    if args.apns_http2_port and h2 is None:
+        logger.warning('h2 package is not installed. not starting APNS HTTP/2 simulator')
+    elif args.apns_http2_port:
+        server = APNSSimulator((args.host, args.apns_http2_port), APNSHTTP2Handler, apns_behavior,
+                               ssl_context=server_context(certs, alpn=['h2']) if args.tls else None)
+        serve(server, 'apns-http2')
+        lines.extend(["APNS['host'] = '{}'".format(args.host), "APNS['port'] = {}".format(server.server_address[1]),
+                      "APNS['secure'] = {}".format(args.tls)])
+        if args.tls:
+            lines.append("APNS['ca'] = '{}'".format(os.path.abspath(certs['ca.pem'])))
+    if apns:
+        lines.extend(["APNS['cert'] = '{}'".format(os.path.abspath(certs['client.pem'])),
+                      "APNS['key'] = '{}'".format(os.path.abspath(certs['client.key']))])
+    print('simulators are running. point pontiac at them with these settings:\n    ' + '\n    '.join(lines))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
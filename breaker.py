@@ -0,0 +1,144 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+import settings
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+STATES = (CLOSED, HALF_OPEN, OPEN)
+
+
+class Permit(object):
+    """A call let through by a circuit breaker, to record the outcome of"""
+    __slots__ = ('generation',)
+
+    def __init__(self, generation):
+        self.generation = generation
+
+
+class CircuitBreaker(object):
+    """Circuit breaker of calls to a notification service.
+    Closed, it lets all calls through and keeps their outcomes over the last BREAKER['window'] seconds.
+    It opens once enough of them failed, or were slower than BREAKER['slow_call'] seconds, and lets no
+    call through for BREAKER['open_timeout'] seconds. Then it is half open, and lets through up to
+    BREAKER['probes'] calls at once: it closes on a successful one, and opens again on a failed one.
+    Every call let through by allow() has to be followed by a record() of its outcome, with the permit
+    allow() gave. Outcomes of calls let through before the last change of state are left out, so that
+    calls which were in flight when the breaker opened do not pass for probes. Thread safe.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self.generation = 0  # counts changes of state
+        self.permit = Permit(self.generation)  # shared by calls let through while closed
+        self.calls = deque()  # (time, failed) of calls recorded while closed
+        self.failures = 0
+        self.opened_at = 0
+        self.probes = 0
+        self.probed_at = 0
+        self.lock = threading.Lock()
+        metrics.BREAKER_STATE.set(STATES.index(CLOSED), provider=name)
+
+    def allow(self):
+        """Return a permit to make a call now, or None if no call may be made"""
+        if self.state == CLOSED:
+            return self.permit
+        with self.lock:
+            if self.state == OPEN and time.time() - self.opened_at >= settings.BREAKER['open_timeout']:
+                self.transition(HALF_OPEN)
+            if self.state == HALF_OPEN and time.time() - self.probed_at >= settings.BREAKER['open_timeout']:
+                # probes which never had their outcome recorded do not hold probing up for good
+                self.probes = 0
+            if self.state == HALF_OPEN and self.probes < settings.BREAKER['probes']:
+                self.probes += 1
+                self.probed_at = time.time()
+                return self.permit
+            return self.permit if self.state == CLOSED else None
+
+    def reopens_at(self):
+        """Time at which an open breaker starts letting probes through"""
+        return self.opened_at + settings.BREAKER['open_timeout']
+
+    def record(self, permit, ok, latency=0):
+        """Record the outcome of a call let through with the given permit. Slow calls count as failures."""
+        failed = not ok or latency > settings.BREAKER['slow_call']
+        now = time.time()
+        with self.lock:
+            if permit.generation != self.generation or self.state == OPEN:
+                # let through before the breaker last changed state
+                return
+            if self.state == HALF_OPEN:
+                self.probes = max(0, self.probes - 1)
+                self.transition(OPEN if failed else CLOSED)
+                return
+            self.calls.append((now, failed))
+            self.failures += failed
+            while self.calls and self.calls[0][0] < now - settings.BREAKER['window']:
+                self.failures -= self.calls.popleft()[1]
+            if len(self.calls) >= settings.BREAKER['min_calls'] and \
+                    self.failures >= settings.BREAKER['failure_rate'] * len(self.calls):
+                self.transition(OPEN)
+
+    def transition(self, state):
+        """Change state. Has to be called holding the lock."""
+        if state == self.state:
+            if state == OPEN:
+                self.opened_at = time.time()
+            return
+        logger.warning('circuit breaker of {} is {} (was {})'.format(self.name, state, self.state))
+        if state == OPEN:
+            self.opened_at = time.time()
+            metrics.BREAKER_TRIPS.inc(provider=self.name)
+        elif state == CLOSED:
+            self.calls.clear()
+            self.failures = 0
+        if state != HALF_OPEN:
+            self.probes = 0
+        self.state = state
+        self.generation += 1
+        self.permit = Permit(self.generation)
+        metrics.BREAKER_STATE.set(STATES.index(state), provider=self.name)
+
+
+class NullBreaker(object):
+    """Breaker which lets all calls through, used when BREAKER['enabled'] is not set"""
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+
+    def allow(self):
+        return Permit(0)
+
+    def reopens_at(self):
+        return time.time()
+
+    def record(self, permit, ok, latency=0):
+        pass
+
+
+_breakers = {}
+_breakers_pid = None
+_breakers_lock = threading.Lock()
+
+
+def breaker(provider):
+    """Return the circuit breaker of the given notification service, shared by all threads of this process"""
+    global _breakers, _breakers_pid
+    with _breakers_lock:
+        if _breakers_pid != os.getpid():
+            _breakers = {}
+            _breakers_pid = os.getpid()
+        if provider not in _breakers:
+            cls = CircuitBreaker if settings.BREAKER.get('enabled') else NullBreaker
+            _breakers[provider] = cls(provider)
+        return _breakers[provider]
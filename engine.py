@@ -0,0 +1,341 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import io
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from twisted.internet import reactor as global_reactor, defer, threads, task
+from twisted.python import threadpool, failure
+from twisted.web import client
+from twisted.web.http_headers import Headers
+
+try:
+    from twisted.internet import ssl
+except ImportError:
+    ssl = None
+
+import errors
+import settings
+import metrics
+import notifier
+import ratelimit
+import retry
+import breaker
+import fcm_service
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncNotifier(notifier.Notifier):
+    """Notifier whose calls return Deferreds, so that many sends can be in flight at once.
+
+    FCM is called with a non-blocking http client over a pool of persistent connections,
+    with at most one request in flight per connection (FCM http API is HTTP/1.1).
+    Services without a non-blocking client (APNS, and FCM through a proxy) are called
+    through blocking Notifier objects, one per thread of the given thread pool.
+    Has to be used on the thread running the given reactor.
+    """
+    def __init__(self, pool, reactor=global_reactor, retrier=None):
+        self.retrier = retrier
+        self.reactor = reactor
+        self.pool = pool
+        self.local = threading.local()
+        self.fcm_native = not settings.FCM.get('proxy')
+        pool_size = settings.FCM.get('pool_size', 10)
+        connection_pool = client.HTTPConnectionPool(self.reactor, persistent=True)
+        connection_pool.maxPersistentPerHost = pool_size
+        if settings.FCM.get('pool_idle_timeout'):
+            connection_pool.cachedConnectionTimeout = settings.FCM['pool_idle_timeout']
+        agent_params = {}
+        if settings.FCM.get('ca'):
+            if ssl is None:
+                raise errors.ConfigurationError('pyOpenSSL is needed to verify FCM with a CA bundle')
+            with open(settings.FCM['ca'], 'rb') as ca_file:
+                trust_root = ssl.Certificate.loadPEM(ca_file.read())
+            agent_params['contextFactory'] = client.BrowserLikePolicyForHTTPS(trustRoot=trust_root)
+        self.agent = client.Agent(self.reactor, pool=connection_pool, connectTimeout=settings.FCM.get('timeout', 10),
+                                  **agent_params)
+        self.fcm_slots = defer.DeferredSemaphore(pool_size)
+
+    def blocking_notify(self, msg, dequeued=None):
+        """Send a message with a blocking notifier of a pool thread"""
+        def call():
+            if not hasattr(self.local, 'notifier'):
+                # connects only to the services it gets messages for
+                self.local.notifier = notifier.Notifier(providers=(), retrier=self.retrier)
+            return self.local.notifier.notify(msg=msg, dequeued=dequeued)
+        return threads.deferToThreadPool(self.reactor, self.pool, call)
+
+    def notify(self, *args, **kwargs):
+        """Send a notification message. Returns a Deferred firing with the result of Notifier.notify"""
+        d = self.dispatch([kwargs.pop('msg')])[0][1]
+        return d.addCallback(lambda done: done[0])
+
+    def notify_many(self, msgs):
+        """Send a list of notification messages. Returns a Deferred firing with the result
+        of Notifier.notify_many.
+        """
+        parts = self.dispatch(msgs)
+
+        def collect(results):
+            done = [True] * len(msgs)
+            for (indexes, _), group_done in zip(parts, results):
+                for i, ok in zip(indexes, group_done):
+                    done[i] = ok
+            return done
+
+        return defer.gatherResults([d for _, d in parts], consumeErrors=True).addCallback(collect)
+
+    def dispatch(self, msgs, dequeued=None):
+        """Start sending a list of messages, taken off the queue at the given dequeued time, if any.
+        FCM messages with identical content are sent together.
+        Returns a list of (indexes of messages, Deferred firing with whether each of them is done).
+        """
+        parts = []
+        groups = OrderedDict()
+        for i, msg in enumerate(msgs):
+            try:
+                if self.expired(msg):
+                    parts.append(([i], defer.succeed([True])))
+                    continue
+            except errors.DataValidationError as e:
+                logger.error('Data Validation Error: {}'.format(e))
+                parts.append(([i], defer.succeed([True])))
+                continue
+            if self.fcm_native and msg.get('type', '').lower() == 'fcm':
+                msg.pop('type')
+                groups.setdefault(notifier.fingerprint(msg), []).append(i)
+            else:
+                parts.append(([i], self.blocking_notify(msg, dequeued).addCallback(lambda ok: [ok])))
+        for indexes in groups.values():
+            parts.append((indexes, self.handle_fcm_group([msgs[i] for i in indexes], dequeued)))
+        for _, d in parts:
+            d.addErrback(self._failed)
+        return parts
+
+    def _failed(self, err):
+        # same as a notifier thread giving up on a message it can not handle
+        logger.error('failed to send notification message: {}'.format(err.getErrorMessage()))
+        return [True]
+
+    def handle_fcm_group(self, msgs, dequeued=None):
+        """Send FCM messages with identical content, in as few multicasts as possible.
+        Returns a Deferred firing with whether each message is done.
+        """
+        max_tokens = settings.FCM.get('batch_max_tokens', 1000)
+        targets = self.fcm_targets(msgs)
+        chunks = [targets[offset:offset + max_tokens] for offset in range(0, len(targets), max_tokens)]
+
+        def collect(outcomes):
+            done = [True] * len(msgs)
+            sent = set()
+            for chunk, outcome in zip(chunks, outcomes):
+                if outcome is None:
+                    self.park_fcm(msgs, chunk, done)
+                else:
+                    notifier.observe_sent('fcm', dequeued, self.newly_sent(chunk, sent))
+                    self.map_fcm_results(msgs, chunk, outcome[0], outcome[1], done)
+            return done
+
+        payload = self.fcm_payload(msgs[0])
+        if not self.payload_fits('fcm', payload):
+            return defer.succeed([True] * len(msgs))
+        sends = []
+        for chunk in chunks:
+            permit = breaker.breaker('fcm').allow()
+            if permit:
+                sends.append(self.send_fcm([token for _, token in chunk], payload, permit, app=msgs[0].get('app')))
+            else:
+                # parked once all sends of the group are done
+                sends.append(defer.succeed(None))
+        return defer.gatherResults(sends, consumeErrors=True).addCallback(collect)
+
+    def send_fcm(self, tokens, payload, permit, app=None):
+        """Send an encoded FCM payload to the given tokens, once rate limits allow, with a permit of the circuit breaker.
+        Returns a Deferred firing with whether the request was handled, and the list of per-token results if available.
+        """
+        body = payload.body(tokens)
+        d = self.rate_limit('fcm', len(tokens), app=app)
+        d.addCallback(lambda _: self._send_fcm(body, len(tokens), permit))
+        return d
+
+    def rate_limit(self, provider, cost, app=None):
+        """Return a Deferred firing once a send of cost tokens is allowed by rate limits.
+        Taking tokens may need redis calls, so it is done on the thread pool.
+        """
+        limiter = ratelimit.limiter()
+        if not limiter.enabled:
+            return defer.succeed(None)
+        d = threads.deferToThreadPool(self.reactor, self.pool, limiter.reserve, provider, cost, app)
+        d.addCallback(lambda wait: task.deferLater(self.reactor, wait, lambda: None) if wait > 0 else None)
+        return d
+
+    def _send_fcm(self, body, count, permit):
+        start = time.time()
+        d = self.fcm_slots.run(self._post_fcm, body)
+        d.addBoth(self._fcm_sent, count, start, permit)
+        return d
+
+    def _post_fcm(self, body):
+        headers = Headers({
+            b'Authorization': ['key={}'.format(settings.FCM['api_key']).encode('utf-8')],
+            b'Content-Type': [b'application/json'],
+        })
+        url = settings.FCM.get('endpoint', fcm_service.ENDPOINT).encode('ascii')
+        d = self.agent.request(b'POST', url, headers, client.FileBodyProducer(io.BytesIO(body)))
+        d.addCallback(lambda response: client.readBody(response).addCallback(lambda content: (response.code, content)))
+        d.addTimeout(settings.FCM.get('timeout', 10), self.reactor)
+        return d
+
+    def _fcm_sent(self, response, count, start, permit):
+        latency = time.time() - start
+        metrics.SEND_LATENCY.observe(latency, provider='fcm')
+        if isinstance(response, failure.Failure):
+            metrics.SENDS.inc(provider='fcm', result='failure')
+            metrics.RECONNECTS.inc(provider='fcm')
+            logger.error('Lost connection to FCM: {}'.format(response.getErrorMessage()))
+            breaker.breaker('fcm').record(permit, False, latency)
+            return False, None
+        results = None
+        try:
+            results = fcm_service.parse_response(response[0], response[1], count)
+            metrics.SENDS.inc(provider='fcm', result='success')
+        except fcm_service.ResultError as e:
+            metrics.SENDS.inc(provider='fcm', result='failure')
+            logger.error('Caught FCM error: {}'.format(e))
+            results = e.results
+        except fcm_service.UnavailableError as e:
+            metrics.SENDS.inc(provider='fcm', result='failure')
+            logger.error('Caught FCM error: {}'.format(e))
+            breaker.breaker('fcm').record(permit, False, latency)
+            return False, None
+        except fcm_service.FCMError as e:
+            metrics.SENDS.inc(provider='fcm', result='failure')
+            logger.error('Caught FCM error: {}'.format(e))
+        breaker.breaker('fcm').record(permit, True, latency)
+        return True, results
+
+
+class Engine(object):
+    """Take messages off a queue and send them with an AsyncNotifier, keeping up to
+    NOTIFIER['max_in_flight'] messages being sent at once. While the limit is reached,
+    no more messages are taken off the queue.
+    Runs on the reactor. Queue calls are done on a single thread of its own, as reliable
+    queues expect messages to be acknowledged by the thread which took them.
+    """
+    def __init__(self, queue, heartbeat=None, reactor=global_reactor):
+        self.reactor = reactor
+        self.queue = queue
+        self.heartbeat = heartbeat
+        self.max_in_flight = settings.NOTIFIER['max_in_flight']
+        self.in_flight = 0
+        self.polling = False
+        self.stopping = False
+        self.ready = threading.Event()
+        self.stopped = defer.Deferred()
+        self.queue_pool = threadpool.ThreadPool(minthreads=1, maxthreads=1, name='engine-queue')
+        self.blocking_pool = threadpool.ThreadPool(minthreads=1, maxthreads=settings.NOTIFIER['blocking_threads'], name='engine-blocking')
+        self.notifr = None
+        self.retrier = retry.Retrier(queue)
+
+    def start(self):
+        logger.info('notifier engine started')
+        self.queue_pool.start()
+        self.blocking_pool.start()
+        self.notifr = AsyncNotifier(self.blocking_pool, reactor=self.reactor, retrier=self.retrier)
+        self.ready.set()
+        self.poll()
+
+    def stop(self):
+        """Stop taking messages off the queue. Returns a Deferred firing once sends in flight are done."""
+        self.stopping = True
+        self._check_stopped()
+        return self.stopped
+
+    def _check_stopped(self):
+        if self.stopping and not self.polling and not self.in_flight and not self.stopped.called:
+            self.queue_pool.stop()
+            self.blocking_pool.stop()
+            logger.info('notifier engine finished')
+            self.stopped.callback(None)
+
+    def poll(self):
+        if self.polling or self.stopping:
+            return
+        room = self.max_in_flight - self.in_flight
+        if room <= 0:
+            # resumed by _sent when sends complete
+            return
+        if self.heartbeat is not None:
+            self.heartbeat.value = time.time()
+        self.polling = True
+        d = threads.deferToThreadPool(self.reactor, self.queue_pool, self.queue.get_many,
+                                      min(room, settings.NOTIFIER['batch_size']), timeout=settings.NOTIFIER['poll_timeout'])
+        d.addCallbacks(self._received, self._poll_failed)
+
+    def _poll_failed(self, err):
+        self.polling = False
+        logger.error('failed to take messages off the queue: {}'.format(err.getErrorMessage()))
+        self.reactor.callLater(settings.NOTIFIER['poll_timeout'], self.poll)
+        self._check_stopped()
+
+    def _received(self, msgs):
+        self.polling = False
+        if msgs:
+            logger.debug('received {} new messages on notification queue'.format(len(msgs)))
+            self.in_flight += len(msgs)
+            for indexes, d in self.notifr.dispatch(msgs, dequeued=time.time()):
+                d.addCallback(self._sent, [msgs[i] for i in indexes])
+        self._check_stopped()
+        self.poll()
+
+    def _sent(self, done, msgs):
+        self.in_flight -= len(msgs)
+        # messages which were not done are left unacknowledged to be redelivered (by reliable queues)
+        acked = [msg for msg, ok in zip(msgs, done) if ok]
+        if acked:
+            d = threads.deferToThreadPool(self.reactor, self.queue_pool, self._flush_and_ack, acked)
+            d.addErrback(lambda err: logger.error('failed to acknowledge messages: {}'.format(err.getErrorMessage())))
+        self._check_stopped()
+        self.poll()
+
+    def _flush_and_ack(self, msgs):
+        # retries of the messages are queued before the messages are gone from the queue
+        self.retrier.flush()
+        self.queue.ack_many(msgs)
+
+
+def start_engine(queue, heartbeat=None, reactor=global_reactor):
+    """Create an engine on the given queue, to be started once the reactor runs.
+    Safe to call from any thread, before or after the reactor is started.
+    """
+    eng = Engine(queue, heartbeat=heartbeat, reactor=reactor)
+    reactor.callFromThread(eng.start)
+    return eng
+
+
+def stop_engines(engines):
+    """Stop the given engines, and their reactor once their sends in flight are done.
+    Has to be called on the reactor thread.
+    """
+    d = defer.gatherResults([eng.stop() for eng in engines])
+    d.addBoth(lambda _: engines[0].reactor.stop())
+    return d
+
+
+def new_reactor():
+    """Create a reactor of the same type as the global one, but not sharing its state.
+    A forked child process can not use the reactor it got from its parent, as its
+    file descriptors (and the event loop) are shared with the parent.
+    """
+    return type(global_reactor)()
+
+
+def reactor_func(*args, **kwargs):
+    """Run a reactor, for processes which run no webservice to run it"""
+    logger.info('reactor thread started')
+    kwargs.get('reactor', global_reactor).run(installSignalHandlers=0)
+    logger.info('reactor thread finished')
@@ -1,13 +1,18 @@
 from __future__ import unicode_literals, print_function, division, absolute_import
 from pprint import pprint
+import os
+import time
 import logging
-import copy
+import threading
 
-import pyfcm
+import simplejson as json
+import requests
 
 
 logger = logging.getLogger(__name__)
 
+ENDPOINT = 'https://fcm.googleapis.com/fcm/send'
+
 
 class FCMError(Exception):
     """Base class for FCM exceptions"""
@@ -19,14 +24,128 @@ class NotConnectedError(FCMError):
     pass
 
 
+class UnavailableError(FCMError):
+    """FCM failed to handle a request for now (5xx or 429 response). It can be sent again later."""
+    pass
+
+
 class ProxyError(FCMError):
     """Error in proxy configuration"""
     pass
 
 
 class ResultError(FCMError):
-    """Error in result object returned from FCM"""
-    pass
+    """Error in result object returned from FCM. Per-token results are kept in results."""
+    def __init__(self, *args, **kwargs):
+        self.results = kwargs.pop('results', None)
+        FCMError.__init__(self, *args, **kwargs)
+
+
+class KeepAliveAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter keeping a bounded pool of persistent connections to FCM.
+
+    A pooled connection is only reused if it is still open (checked by urllib3 on checkout),
+    and the whole pool is dropped after being idle for idle_timeout seconds, as the server
+    or proxies in between would have closed idle connections by then anyway.
+    With block set, callers wait for a free connection instead of opening more than maxsize.
+    """
+    def __init__(self, maxsize=10, idle_timeout=None, block=True, retries=0):
+        self.idle_timeout = idle_timeout
+        self.last_used = time.time()
+        requests.adapters.HTTPAdapter.__init__(self, pool_connections=1, pool_maxsize=maxsize, pool_block=block,
+                                               max_retries=retries)
+
+    def send(self, request, **kwargs):
+        now = time.time()
+        if self.idle_timeout and now - self.last_used > self.idle_timeout:
+            logger.debug('fcm connection pool was idle for {:.0f} seconds. dropping its connections'.format(now - self.last_used))
+            self.reset()
+        self.last_used = now
+        return requests.adapters.HTTPAdapter.send(self, request, **kwargs)
+
+    def reset(self):
+        """Close pooled connections, direct and through proxies. Connections in use are closed when they are released."""
+        self.poolmanager.clear()
+        for manager in list(self.proxy_manager.values()):
+            manager.clear()
+
+
+_shared_adapter = None
+_shared_adapter_pid = None
+_shared_adapter_lock = threading.Lock()
+
+
+def shared_adapter(**kwargs):
+    """Return the connection pool shared by all FCM objects of this process, creating it
+    with the given KeepAliveAdapter arguments on first call.
+    Child processes get a pool of their own, as sockets can not be shared after a fork.
+    """
+    global _shared_adapter, _shared_adapter_pid
+    with _shared_adapter_lock:
+        if _shared_adapter is None or _shared_adapter_pid != os.getpid():
+            _shared_adapter = KeepAliveAdapter(**kwargs)
+            _shared_adapter_pid = os.getpid()
+        return _shared_adapter
+
+
+class Payload(object):
+    """Content of an FCM message (everything but its recipients), encoded to json once.
+    FCM calls accept it in place of a payload dict, so that sending the same content
+    in many requests, or again after a failure, does not encode it again.
+    """
+    def __init__(self, payload):
+        payload = dict(payload)
+        content = {
+            'priority': 'high',
+        }
+        notification = {}
+        message_title = payload.pop('message_title', None)
+        message_body = payload.pop('message_body', None)
+        if message_title is not None:
+            notification['title'] = message_title
+        if message_body is not None:
+            notification['body'] = message_body
+        if notification:
+            content['notification'] = notification
+        if payload:
+            content['data'] = payload
+        self._data = json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    @property
+    def data(self):
+        """json encoded content, as bytes"""
+        return self._data
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    def body(self, registration_ids):
+        """Encode a request sending this content to the given registration ids"""
+        recipients = json.dumps(registration_ids, separators=(',', ':')).encode('utf-8')
+        return b'{"registration_ids":' + recipients + b',' + self._data[1:]
+
+
+def parse_response(status, content, count):
+    """Check an FCM http response to a request for count tokens, the way FCM.notify_multiple does.
+    Returns per-token results.
+    """
+    if status == 401:
+        raise FCMError('FCM rejected the api key')
+    if status >= 500 or status == 429:
+        raise UnavailableError('FCM is unavailable, responded with status {}'.format(status))
+    if status != 200:
+        raise FCMError('FCM responded with status {}'.format(status))
+    try:
+        result = json.loads(content.decode('utf-8'))
+    except ValueError:
+        raise FCMError('FCM responded with an invalid json document')
+    if int(result['success']) + int(result['failure']) != count:
+        raise FCMError('This should not happen')
+    if result['success'] != count:
+        raise ResultError('Some messages failed to be processed by FCM. {} expected, {} failed'.format(
+            int(result['success']) + int(result['failure']), int(result['failure'])), results=result['results'])
+    return result['results']
 
 
 class FCM(object):
@@ -39,13 +158,16 @@ class FCM(object):
     Data messages let developers send up to 4KB of custom key-value pairs.
     Use notification messages when you want FCM to handle displaying a notification on your app's behalf.
     Use data messages when you just want to process the messages only in your app.
-    PyFCM can send a message including both notification and data payloads.
+    A message can include both notification and data payloads.
     In such cases, FCM handles displaying the notification payload, and the client app handles the data payload.
     """
     MAX_PAYLOAD_SIZE = 4 * 1024
 
     def __init__(self, **kwargs):
-        params = {'api_key': kwargs['api_key']}
+        self.api_key = kwargs['api_key']
+        self.endpoint = kwargs.get('endpoint') or ENDPOINT
+        self.timeout = kwargs.get('timeout', 10)
+        self.session = requests.Session()
         if 'proxy' in kwargs and kwargs['proxy']:
             proxies = kwargs['proxy'] if isinstance(kwargs['proxy'], list) else [kwargs['proxy']]
             proxy_dict = {}
@@ -56,70 +178,44 @@ class FCM(object):
                     proxy_dict.update({'https': proxy})
                 else:
                     raise ProxyError('proxy type not supported')
-            if bool(proxy_dict):
-                params.update({'proxy_dict': proxy_dict})
-        self.service = pyfcm.FCMNotification(**params)
-
-    def notify_single(self, **kwargs):
-        registration_ids = kwargs['registration_id']
-        payload = copy.deepcopy(kwargs['payload'])
-        message_title = payload.pop('message_title', None)
-        message_body = payload.pop('message_body', None)
-
-        params = {
-            'registration_id': kwargs['registration_id'],
-            'message_title': message_title,
-            'message_body': message_body,
-            'data_message': payload,
-            'low_priority': False,
-            'delay_while_idle': False,
-            'time_to_live': None,
-            'dry_run': False
-        }
-        # TODO: ensure that payload size is not larger than max FCM notification payload size
-
+            self.session.proxies.update(proxy_dict)
+        self.session.headers.update({
+            'Authorization': 'key={}'.format(self.api_key),
+            'Content-Type': 'application/json',
+        })
+        # passed on every request, as the session setting is overridden by REQUESTS_CA_BUNDLE
+        self.ca = kwargs.get('ca')
+        # send over the given pool of connections, if any
+        self.adapter = kwargs.get('adapter')
+        if self.adapter is not None:
+            self.session.mount('https://', self.adapter)
+            self.session.mount('http://', self.adapter)
+
+    def reset(self):
+        """Drop pooled connections, to have new ones made on the next call"""
+        if self.adapter is not None:
+            self.adapter.reset()
+
+    def send(self, registration_ids, payload):
+        """Send payload (a dict or a Payload) to the given registration ids, and return per-token results"""
+        if not isinstance(payload, Payload):
+            payload = Payload(payload)
+        params = {'verify': self.ca} if self.ca else {}
         try:
-            result = self.service.notify_single_device(**params)
-        except pyfcm.errors.FCMError as e:
+            response = self.session.post(self.endpoint, data=payload.body(registration_ids), timeout=self.timeout, **params)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            raise NotConnectedError(e)
+        except requests.exceptions.RequestException as e:
             raise FCMError(e)
+        return parse_response(response.status_code, response.content, len(registration_ids))
 
-        if result['success'] != 1:
-            raise ResultError('Message failed to be processed by FCM. {} expected, {} failed'.format(
-                int(result['success']) + int(result['failure']), int(result['failure'])))
-        return result['results']
+    def notify_single(self, **kwargs):
+        return self.send([kwargs['registration_id']], kwargs['payload'])
 
     def notify_multiple(self, **kwargs):
         # Send to multiple devices by passing a list of ids.
         assert isinstance(kwargs['registration_ids'], list)
-        registration_ids = kwargs['registration_ids']
-        payload = copy.deepcopy(kwargs['payload'])
-        message_title = payload.pop('message_title', None)
-        message_body = payload.pop('message_body', None)
-
-        params = {
-            'registration_ids': kwargs['registration_ids'],
-            'message_title': message_title,
-            'message_body': message_body,
-            'data_message': payload,
-            'low_priority': False,
-            'delay_while_idle': False,
-            'time_to_live': None,
-            'sound': None,
-            'dry_run': False
-        }
-
-        try:
-            result = self.service.notify_multiple_devices(**params)
-        except pyfcm.errors.FCMError as e:
-            raise FCMError(e)
-
-        if int(result['success']) + int(result['failure']) != len(registration_ids):
-            raise FCMError('This should not happen')
-
-        if result['success'] != len(registration_ids):
-            raise ResultError('Some messages failed to be processed by FCM. {} expected, {} failed'.format(
-                int(result['success']) + int(result['failure']), int(result['failure'])))
-        return result['results']
+        return self.send(kwargs['registration_ids'], kwargs['payload'])
 
     @staticmethod
     def result_str(results):
@@ -0,0 +1,208 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import logging
+import socket
+import select
+from collections import deque
+
+import six
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+except ImportError:
+    h2 = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class HTTP2Error(Exception):
+    """Base class for HTTP/2 client exceptions"""
+    pass
+
+
+class NotConnectedError(HTTP2Error):
+    """Connection to the server failed or was closed"""
+    pass
+
+
+class Response(object):
+    def __init__(self, tag, status, headers, body):
+        self.tag = tag
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class Connection(object):
+    """A client HTTP/2 connection, sending queued requests as concurrent streams.
+    This is a non-blocking building block: submit() queues requests, pump() opens as many
+    streams as the server and flow control allow, and receive() reads what is available
+    on the socket and returns completed responses. Use perform() to drive one or more
+    connections until all of their requests are done.
+    """
+    def __init__(self, host, port, ssl_context=None, proxy=None, timeout=10, max_streams=1000):
+        if h2 is None:
+            raise HTTP2Error('h2 package is needed for HTTP/2 connections')
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.proxy = proxy  # (host, port) of an http proxy supporting CONNECT
+        self.timeout = timeout
+        self.max_streams = max_streams
+        self.sock = None
+        self.conn = None
+        self.queued = deque()
+        self.streams = {}
+
+    def connect(self):
+        addr = self.proxy or (self.host, self.port)
+        try:
+            sock = socket.create_connection(addr, self.timeout)
+            if self.proxy:
+                self._tunnel(sock)
+            if self.ssl_context is not None:
+                sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+                if sock.selected_alpn_protocol() not in (None, 'h2'):
+                    raise NotConnectedError('server does not support HTTP/2')
+            conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=True, header_encoding='utf-8'))
+            conn.initiate_connection()
+            sock.sendall(conn.data_to_send())
+        except (socket.error, IOError) as e:
+            raise NotConnectedError('failed to connect to {}:{}: {}'.format(self.host, self.port, e))
+        self.sock = sock
+        self.conn = conn
+
+    def _tunnel(self, sock):
+        request = 'CONNECT {0}:{1} HTTP/1.1\r\nHost: {0}:{1}\r\n\r\n'.format(self.host, self.port)
+        sock.sendall(request.encode('ascii'))
+        response = b''
+        while b'\r\n\r\n' not in response:
+            data = sock.recv(4096)
+            if not data:
+                raise NotConnectedError('proxy closed the connection')
+            response += data
+        status_line = response.split(b'\r\n', 1)[0].split()
+        if len(status_line) < 2 or status_line[1] != b'200':
+            raise NotConnectedError('proxy refused to connect: {}'.format(response.split(b'\r\n', 1)[0]))
+
+    def close(self):
+        """Close the connection, dropping queued and open requests. Next pump() reconnects."""
+        if self.sock is not None:
+            try:
+                self.conn.close_connection()
+                self.sock.sendall(self.conn.data_to_send())
+            except (socket.error, IOError, h2.exceptions.ProtocolError):
+                pass
+            self.sock.close()
+        self.sock = None
+        self.conn = None
+        self.queued.clear()
+        self.streams = {}
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    @property
+    def busy(self):
+        return bool(self.queued or self.streams)
+
+    def pending(self):
+        """Whether there is already decrypted data waiting to be read"""
+        return hasattr(self.sock, 'pending') and self.sock.pending() > 0
+
+    def submit(self, method, path, headers, body, tag=None):
+        """Queue a request. tag is returned with its response."""
+        self.queued.append((method, path, headers, body, tag))
+
+    def pump(self):
+        """Open streams for queued requests, as far as the server and flow control allow"""
+        if self.conn is None:
+            self.connect()
+        max_streams = min(self.max_streams, self.conn.remote_settings.max_concurrent_streams)
+        while self.queued and len(self.streams) < max_streams:
+            method, path, headers, body, tag = self.queued[0]
+            if len(body) > self.conn.outbound_flow_control_window:
+                break
+            self.queued.popleft()
+            stream_id = self.conn.get_next_available_stream_id()
+            request_headers = [
+                (':method', method),
+                (':scheme', 'https' if self.ssl_context is not None else 'http'),
+                (':authority', '{}:{}'.format(self.host, self.port)),
+                (':path', path),
+                ('content-length', str(len(body))),
+            ] + list(headers)
+            self.conn.send_headers(stream_id, request_headers)
+            frame_size = self.conn.max_outbound_frame_size
+            for offset in range(0, len(body), frame_size):
+                self.conn.send_data(stream_id, body[offset:offset + frame_size])
+            self.conn.end_stream(stream_id)
+            self.streams[stream_id] = {'tag': tag, 'status': None, 'headers': [], 'body': []}
+        self._flush()
+
+    def _flush(self):
+        data = self.conn.data_to_send()
+        if data:
+            try:
+                self.sock.sendall(data)
+            except (socket.error, IOError) as e:
+                raise NotConnectedError('failed to send to {}:{}: {}'.format(self.host, self.port, e))
+
+    def receive(self):
+        """Read available data from the socket, and return the list of completed responses"""
+        try:
+            data = self.sock.recv(65535)
+        except (socket.error, IOError) as e:
+            raise NotConnectedError('failed to receive from {}:{}: {}'.format(self.host, self.port, e))
+        if not data:
+            raise NotConnectedError('connection closed by {}:{}'.format(self.host, self.port))
+
+        done = []
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError as e:
+            raise NotConnectedError('protocol error: {}'.format(e))
+        for event in events:
+            stream = self.streams.get(getattr(event, 'stream_id', None))
+            if isinstance(event, h2.events.ResponseReceived) and stream is not None:
+                headers = [(six.text_type(k), six.text_type(v)) for k, v in event.headers]
+                stream['headers'] = headers
+                stream['status'] = int(dict(headers).get(':status', 0))
+            elif isinstance(event, h2.events.DataReceived):
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                if stream is not None:
+                    stream['body'].append(event.data)
+            elif isinstance(event, h2.events.StreamEnded) and stream is not None:
+                del self.streams[event.stream_id]
+                done.append(Response(stream['tag'], stream['status'], stream['headers'], b''.join(stream['body'])))
+            elif isinstance(event, h2.events.StreamReset) and stream is not None:
+                del self.streams[event.stream_id]
+                done.append(Response(stream['tag'], None, [], b''))
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                raise NotConnectedError('connection terminated by {}:{}, error code {}'.format(self.host, self.port, event.error_code))
+        self._flush()
+        return done
+
+
+def perform(connections, timeout=10):
+    """Drive the given connections until all of their queued requests are answered.
+    Yields responses in order of completion, so that the ones received before a failure are known.
+    """
+    while True:
+        busy = [conn for conn in connections if conn.busy]
+        if not busy:
+            return
+        for conn in busy:
+            conn.pump()
+        readable = [conn for conn in busy if conn.pending()]
+        if not readable:
+            readable = select.select(busy, [], [], timeout)[0]
+            if not readable:
+                raise NotConnectedError('timed out waiting for responses')
+        for conn in readable:
+            for response in conn.receive():
+                yield response
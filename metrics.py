@@ -0,0 +1,352 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import os
+import glob
+import time
+import logging
+import bisect
+import threading
+from collections import OrderedDict
+
+import six
+from six.moves import _thread
+import simplejson as json
+
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Registry(object):
+    """Collection of metrics which can be rendered as a dict or in Prometheus text format.
+    Once shared through a directory, values of this process are written to a snapshot file of its own
+    there, and rendered values add up those of all processes sharing it: counters and histograms of
+    processes which exited included, gauges of the ones still publishing only.
+    """
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.directory = None
+        self.path = None  # snapshot file of this process
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('duplicate metric name: {}'.format(metric.name))
+        self.metrics[metric.name] = metric
+
+    def reset(self):
+        """Forget values recorded so far, which a forked process got from its parent"""
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def share(self, directory):
+        """Share values of this process through the given directory, in a new snapshot file"""
+        self.directory = directory
+        # restarted processes may get the pid of one which exited, and must not overwrite its counts
+        self.path = os.path.join(directory, '{}-{}.json'.format(os.getpid(), int(time.time() * 1000)))
+
+    def snapshot(self):
+        return {
+            'time': time.time(),
+            'metrics': dict((name, [[list(key), value] for key, value in metric.collect().items()])
+                            for name, metric in self.metrics.items()),
+        }
+
+    def publish(self):
+        """Write the snapshot file of this process, if shared"""
+        if self.path is None:
+            return
+        temp_path = '{}.tmp'.format(self.path)
+        with open(temp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        # readers never see a partly written snapshot
+        os.rename(temp_path, self.path)
+
+    def snapshots(self):
+        """Snapshots of other processes sharing the directory"""
+        if self.directory is None:
+            return []
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            if path == self.path:
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (IOError, OSError, ValueError) as e:
+                logger.warning('failed to read metrics snapshot {}: {}'.format(path, e))
+        return snapshots
+
+    def collect(self):
+        """Values of all metrics, added up with the ones of other processes sharing the directory"""
+        values = OrderedDict((name, metric.collect()) for name, metric in self.metrics.items())
+        stale = time.time() - 3 * settings.METRICS['share_interval']
+        for snapshot in self.snapshots():
+            for name, pairs in snapshot['metrics'].items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.kind == 'gauge' and snapshot['time'] < stale):
+                    continue
+                for key, value in pairs:
+                    metric.merge(values[name], tuple(key), value)
+        return values
+
+    def as_dict(self):
+        values = self.collect()
+        return OrderedDict((name, metric.as_dict(values[name])) for name, metric in self.metrics.items())
+
+    def exposition(self):
+        values = self.collect()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append('# HELP {} {}'.format(name, metric.doc))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            lines.extend(metric.exposition(values[name]))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(n, six.text_type(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """Base class for metrics, optionally split by a fixed set of label names.
+    Values are kept in per-thread shards, so that updating a metric never takes a lock:
+    each thread only ever writes to its own shard, and readers add the shards up.
+    """
+    kind = None
+
+    def __init__(self, name, doc, labels=(), registry=REGISTRY):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.shards = {}
+        if registry is not None:
+            registry.register(self)
+
+    def shard(self):
+        ident = _thread.get_ident()
+        shard = self.shards.get(ident)
+        if shard is None:
+            shard = self.shards.setdefault(ident, {})
+        return shard
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def reset(self):
+        self.shards = {}
+
+    def collect(self):
+        """Return a dict of label values tuple to metric value, summed over all shards"""
+        raise NotImplementedError()
+
+    def merge(self, values, key, value):
+        """Add a value collected in another process to a dict of collected values"""
+        raise NotImplementedError()
+
+    def as_dict(self, values=None):
+        values = self.collect() if values is None else values
+        values = [{'labels': dict(zip(self.labels, key)), 'value': value} for key, value in sorted(values.items())]
+        return {'type': self.kind, 'help': self.doc, 'values': values}
+
+    def exposition(self, values=None):
+        values = self.collect() if values is None else values
+        return ['{}{} {}'.format(self.name, format_labels(self.labels, key), format_value(value))
+                for key, value in sorted(values.items())]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        shard = self.shard()
+        key = self.key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def collect(self):
+        result = {}
+        for shard in list(self.shards.values()):
+            for key, value in list(shard.items()):
+                result[key] = result.get(key, 0) + value
+        return result
+
+    def merge(self, values, key, value):
+        values[key] = values.get(key, 0) + value
+
+    def total(self):
+        return sum(self.collect().values())
+
+
+class Gauge(Metric):
+    """A value which is set, rather than accumulated. Last write wins.
+    Values of several processes are added up with merge "sum", and the highest one is kept with "max".
+    """
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        self.merge_mode = kwargs.pop('merge', 'max')
+        Metric.__init__(self, *args, **kwargs)
+        self.values = {}
+
+    def reset(self):
+        self.values = {}
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def get(self, default=None, **labels):
+        return self.values.get(self.key(labels), default)
+
+    def collect(self):
+        return dict(self.values)
+
+    def merge(self, values, key, value):
+        if key not in values:
+            values[key] = value
+        elif self.merge_mode == 'sum':
+            values[key] += value
+        else:
+            values[key] = max(values[key], value)
+
+
+class Histogram(Metric):
+    """Distribution of observed values over a fixed set of bucket upper bounds"""
+    kind = 'histogram'
+
+    def __init__(self, *args, **kwargs):
+        self.buckets = tuple(kwargs.pop('buckets', LATENCY_BUCKETS))
+        Metric.__init__(self, *args, **kwargs)
+
+    def observe(self, value, **labels):
+        shard = self.shard()
+        key = self.key(labels)
+        counts = shard.get(key)
+        if counts is None:
+            # one slot per bucket, one for +Inf, then the sum of observed values
+            counts = shard[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def collect(self):
+        result = {}
+        for shard in list(self.shards.values()):
+            for key, counts in list(shard.items()):
+                if key in result:
+                    result[key] = [a + b for a, b in zip(result[key], counts)]
+                else:
+                    result[key] = list(counts)
+        return result
+
+    def merge(self, values, key, value):
+        if key in values:
+            values[key] = [a + b for a, b in zip(values[key], value)]
+        else:
+            values[key] = list(value)
+
+    def summary(self, counts):
+        """Cumulative bucket counts, total count and sum of values, from collected counts"""
+        cumulative = []
+        running = 0
+        for count in counts[:-1]:
+            running += count
+            cumulative.append(running)
+        return cumulative, running, counts[-1]
+
+    def as_dict(self, values=None):
+        collected = self.collect() if values is None else values
+        values = []
+        for key, counts in sorted(collected.items()):
+            cumulative, count, total = self.summary(counts)
+            bounds = [format_value(b) for b in self.buckets + (float('inf'),)]
+            values.append({
+                'labels': dict(zip(self.labels, key)),
+                'count': count,
+                'sum': total,
+                'buckets': OrderedDict(zip(bounds, cumulative)),
+            })
+        return {'type': self.kind, 'help': self.doc, 'values': values}
+
+    def exposition(self, values=None):
+        values = self.collect() if values is None else values
+        lines = []
+        for key, counts in sorted(values.items()):
+            cumulative, count, total = self.summary(counts)
+            for bound, value in zip(self.buckets + (float('inf'),), cumulative):
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(self.labels, key, [('le', format_value(bound))]), value))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(self.labels, key), count))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(self.labels, key), format_value(total)))
+        return lines
+
+
+REQUESTS = Counter('pontiac_requests_total', 'Notification requests received over http, by result', ('result',))
+REJECTIONS = Counter('pontiac_requests_rejected_total', 'Rejected notification requests, by reason', ('reason',))
+ENQUEUED = Counter('pontiac_notifications_enqueued_total', 'Notification messages put in the queue')
+QUEUE_DEPTH = Gauge('pontiac_queue_depth', 'Number of pending messages, by queue key', ('queue',))
+LANE_DEPTH = Gauge('pontiac_lane_depth', 'Number of pending messages, by queue key and priority lane', ('queue', 'priority'))
+DEQUEUE_TO_SEND = Histogram('pontiac_dequeue_to_send_seconds', 'Time from taking a message off the queue to handing it to its service, by provider. Messages dropped or parked are left out', ('provider',))
+SEND_LATENCY = Histogram('pontiac_send_seconds', 'Duration of notification service calls, by provider', ('provider',))
+SENDS = Counter('pontiac_sends_total', 'Notification service calls, by provider and result', ('provider', 'result'))
+RECONNECTS = Counter('pontiac_reconnects_total', 'Reconnections to notification services, by provider', ('provider',))
+DEAD_TOKENS = Counter('pontiac_dead_tokens_total', 'Tokens recorded as dead, by provider', ('provider',))
+DEAD_TOKENS_SKIPPED = Counter('pontiac_dead_tokens_skipped_total', 'Tokens left out of sends for being dead, by provider', ('provider',))
+CANONICAL_IDS = Counter('pontiac_canonical_ids_total', 'FCM registration ids recorded with a canonical id')
+DUPLICATE_TOKENS_SKIPPED = Counter('pontiac_duplicate_tokens_skipped_total', 'FCM tokens left out of sends for being the same device as another token')
+OVERSIZED = Counter('pontiac_oversized_payloads_total', 'Messages dropped before sending for payloads over the service limit, by provider', ('provider',))
+SCHEDULED = Counter('pontiac_scheduled_total', 'Messages accepted with a send time in the future')
+PROMOTED = Counter('pontiac_promoted_total', 'Scheduled messages put in their queue once due, by queue key', ('queue',))
+EXPIRED = Counter('pontiac_expired_total', 'Messages dropped for having expired, by stage (ingestion, purge or dequeue)', ('stage',))
+RETRIES = Counter('pontiac_retries_total', 'Messages scheduled to be sent again to the tokens which failed, by provider and reason', ('provider', 'reason'))
+DEAD_LETTERS = Counter('pontiac_dead_letters_total', 'Messages given up on after too many failed sends, by provider', ('provider',))
+BREAKER_STATE = Gauge('pontiac_breaker_state', 'State of circuit breakers, by provider (0 closed, 1 half open, 2 open)', ('provider',))
+BREAKER_TRIPS = Counter('pontiac_breaker_trips_total', 'Circuit breakers opening, by provider', ('provider',))
+PARKED = Counter('pontiac_parked_total', 'Messages put back in the queue while the circuit breaker of their service was open, by provider', ('provider',))
+TRUNCATED = Counter('pontiac_truncated_payloads_total', 'Messages with body truncated at ingestion to fit the service limit')
+POOL_THREADS = Gauge('pontiac_pool_threads', 'Number of threads of a thread pool, by pool name', ('pool',), merge='sum')
+RATE_LIMIT_WAIT = Histogram('pontiac_rate_limit_wait_seconds', 'Time sends were held back by rate limits, by provider', ('provider',))
+NOTIFIERS = Gauge('pontiac_notifier_workers', 'Number of notifier workers kept running by the autoscaler, by provider', ('provider',), merge='sum')
+
+
+def update_queue_depths(qs):
+    """Refresh queue depth gauges of the given dict of task queues. Does blocking queue calls."""
+    for q in qs.values():
+        if hasattr(q, 'sizes'):
+            sizes = q.sizes()
+            for priority, size in sizes.items():
+                LANE_DEPTH.set(size, queue=q.key, priority=priority)
+            QUEUE_DEPTH.set(sum(sizes.values()), queue=q.key)
+        else:
+            QUEUE_DEPTH.set(q.size(), queue=q.key)
+        if getattr(q, 'dead_letters', None) is not None:
+            QUEUE_DEPTH.set(q.dead_letters.size(), queue=q.dead_letters.key)
+
+
+def publisher_func(registry):
+    """Write snapshots of a shared registry every METRICS['share_interval'] seconds"""
+    while True:
+        try:
+            registry.publish()
+        except (IOError, OSError) as e:
+            logger.error('failed to write metrics snapshot: {}'.format(e))
+        time.sleep(settings.METRICS['share_interval'])
+
+
+def share(directory):
+    """Share metrics of this process with other processes through directory, from a thread of its own"""
+    REGISTRY.share(directory)
+    thread = threading.Thread(target=publisher_func, kwargs={'registry': REGISTRY}, name='metrics')
+    thread.daemon = True
+    thread.start()
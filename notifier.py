@@ -1,8 +1,12 @@
 from __future__ import unicode_literals, print_function, division, absolute_import
 from pprint import pprint
+import os
 import string
 import logging
 import datetime
+import time
+import itertools
+from collections import OrderedDict
 
 import six
 import simplejson as json
@@ -11,17 +15,55 @@ import pem
 
 import settings
 import errors
+import metrics
 import fcm_service
 import apns_service
+import taskq
+import ratelimit
+import breaker
+import tokens as tokens_registry
 
 
 logger = logging.getLogger(__name__)
 
+# per-token errors which mean the token will never work again
+FCM_DEAD_TOKEN_ERRORS = ('NotRegistered', 'InvalidRegistration')
+APNS_DEAD_TOKEN_REASONS = ('BadDeviceToken', 'Unregistered')
+# per-token errors which may not happen on another try. None is a stream reset, or no answer at all
+FCM_RETRY_ERRORS = ('Unavailable', 'InternalServerError', 'DeviceMessageRateExceeded', 'TopicsMessageRateExceeded')
+APNS_RETRY_STATUSES = (None, 429, 500, 503)
+TRUNCATION_MARK = '\u2026'
+# fields of a message about its delivery rather than its content
+DELIVERY_FIELDS = ('tokens', 'expires_at', 'send_at', 'attempt', 'priority')
+
+
+def fingerprint(msg):
+    """A string identifying the content of a notification message, regardless of its tokens and delivery"""
+    return json.dumps(dict((k, v) for k, v in msg.items() if k not in DELIVERY_FIELDS), sort_keys=True)
+
+
+_pem_checks = {}
+
 
 def validate_pem_file(pem_file, header=None):
     """Validate a PEM encoded certificate or key
     Optionally check if it contains a particular header line.
+    Results are kept until the file changes, as services are reconnected to often while they fail.
     """
+    try:
+        stat = os.stat(pem_file)
+        check = (pem_file, header, stat.st_mtime, stat.st_size)
+    except OSError:
+        check = None
+    if check is not None and check in _pem_checks:
+        return _pem_checks[check]
+    valid = _validate_pem_file(pem_file, header)
+    if check is not None:
+        _pem_checks[check] = valid
+    return valid
+
+
+def _validate_pem_file(pem_file, header=None):
     pem_parsed = pem.parse_file(pem_file)
     if not isinstance(pem_parsed, list) or len(pem_parsed) != 1:
         return False
@@ -49,6 +91,69 @@ def validate_json(json_str, schema=None):
     return True
 
 
+def max_payload_size(provider):
+    """Max size of encoded payloads accepted by the given notification service"""
+    if provider == 'fcm':
+        return fcm_service.FCM.MAX_PAYLOAD_SIZE
+    if settings.APNS.get('backend', 'binary') == 'http2':
+        return apns_service.APNSHTTP2.MAX_PAYLOAD_SIZE
+    return apns_service.APNS.MAX_PAYLOAD_SIZE
+
+
+def encode_payload(msg):
+    """Encoded payload of a notification message, as its service gets it"""
+    if msg.get('type', '').lower() == 'fcm':
+        return Notifier.fcm_payload(msg)
+    return Notifier.apns_payload(msg)
+
+
+def fit_payload(msg, truncate=False):
+    """Check whether the encoded payload of a notification message fits the limit of its service.
+    With truncate, the body of an oversized message is shortened to fit, on a utf-8 character
+    boundary, and marked with an ellipsis. Returns whether the message fits.
+    """
+    limit = max_payload_size(msg.get('type', '').lower())
+    size = encode_payload(msg).size
+    if size <= limit:
+        return True
+    if not truncate:
+        return False
+    # escaping in json makes the room a body takes differ from its length. search for the longest prefix which fits.
+    encoded = msg['body'].encode('utf-8')
+    fitting = None
+    low, high = 0, len(encoded) - 1
+    while low <= high:
+        keep = (low + high) // 2
+        body = encoded[:keep].decode('utf-8', 'ignore') + TRUNCATION_MARK
+        if encode_payload(dict(msg, body=body)).size <= limit:
+            fitting = body
+            low = keep + 1
+        else:
+            high = keep - 1
+    if fitting is None:
+        return False
+    msg['body'] = fitting
+    return True
+
+
+def parse_expiry(expiry_time):
+    """Epoch time of an expiry_time field of a notification message (local time)"""
+    try:
+        expiry = datetime.datetime.strptime(expiry_time, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise errors.DataValidationError('expiry time is not in a valid format')
+    return time.mktime(expiry.timetuple())
+
+
+def observe_sent(provider, dequeued, count=1):
+    """Observe the time count messages taken off the queue at dequeued (if known) took to be handed to their service"""
+    if dequeued is None:
+        return
+    latency = time.time() - dequeued
+    for _ in range(count):
+        metrics.DEQUEUE_TO_SEND.observe(latency, provider=provider)
+
+
 def validate_apns_token(token_str):
     """Validate an APNS token
     These are 32 byte identifiers encoded as a hex string.
@@ -64,22 +169,49 @@ def validate_apns_token(token_str):
 
 class Notifier(object):
     """Abstraction for various types of notification service
+    Connects to the given services up front, and to others on their first message.
+    Tokens which fail for a transient reason are handed to the given retry.Retrier, if any.
+    Otherwise their messages are reported as not done, to be delivered again.
+    Messages to a service whose circuit breaker is open are parked with the retrier the same way.
     """
 
-    def __init__(self):
-        self.connect_fcm()
-        self.connect_apns()
+    def __init__(self, providers=taskq.PROVIDERS, retrier=None):
+        self.retrier = retrier
+        self.fcm_obj = None
+        self.apns_obj = None
+        self.dequeued = None  # time the messages being sent were taken off the queue, if known
+        for provider in providers:
+            self.connect(provider)
+
+    def connect(self, provider):
+        if provider == 'fcm':
+            self.connect_fcm()
+        else:
+            self.connect_apns()
+
+    def ensure_connected(self, provider):
+        if getattr(self, '{}_obj'.format(provider)) is None:
+            self.connect(provider)
 
     def connect_fcm(self):
         params = {
             'api_key': settings.FCM['api_key'],
+            'endpoint': settings.FCM.get('endpoint'),
+            'timeout': settings.FCM.get('timeout', 10),
+            'ca': settings.FCM.get('ca'),
+            'adapter': fcm_service.shared_adapter(
+                maxsize=settings.FCM.get('pool_size', 10),
+                idle_timeout=settings.FCM.get('pool_idle_timeout'),
+                retries=settings.FCM.get('pool_retries', 0),
+            ),
         }
         if 'proxy' in settings.FCM and settings.FCM['proxy']:
             params.update({'proxy': settings.FCM['proxy']})
         logger.debug('connecting to fcm service')
         self.fcm_obj = fcm_service.FCM(**params)
 
-    def connect_apns(self):
+    @staticmethod
+    def apns_params():
         for pem_file in [settings.APNS['cert'], settings.APNS['key']]:
             if not validate_pem_file(pem_file):
                 raise errors.ConfigurationError('APNS PEM file is not valid: {}'.format(pem_file))
@@ -91,40 +223,185 @@ class Notifier(object):
         }
         if 'proxy' in settings.APNS and settings.APNS['proxy']:
             params.update({'proxy': settings.APNS['proxy']})
+        for key in ['gateway', 'feedback']:
+            if settings.APNS.get(key):
+                params[key] = settings.APNS[key]
+        return params
+
+    def connect_apns(self):
+        params = self.apns_params()
         logger.debug('connecting to apns service')
-        self.apns_obj = apns_service.APNS(**params)
+        if settings.APNS.get('backend', 'binary') == 'http2':
+            for key in ['topic', 'host', 'port', 'secure', 'ca', 'pool_size', 'max_concurrent_streams', 'timeout']:
+                if settings.APNS.get(key) is not None:
+                    params[key] = settings.APNS[key]
+            self.apns_obj = apns_service.APNSHTTP2(**params)
+        else:
+            self.apns_obj = apns_service.APNS(**params)
+
+    def expired(self, msg):
+        """Check whether expiry time of the message has passed"""
+        expiry_time = msg.pop('expiry_time', None)
+        if expiry_time and 'expires_at' not in msg:
+            # not parsed at ingestion, if put in the queue by something other than the webservice
+            msg['expires_at'] = parse_expiry(expiry_time)
+        expires_at = msg.get('expires_at')
+        if expires_at is not None and expires_at < time.time():
+            logger.info('notification message is expired. dropped.')
+            metrics.EXPIRED.inc(stage='dequeue')
+            return True
+        return False
 
     def notify(self, *args, **kwargs):
+        """Send a notification message, taken off the queue at the given dequeued time, if any.
+        Returns False if the message could not be handed to the notification service and
+        should be delivered again, True otherwise.
+        """
         msg = kwargs.pop('msg')
-        expiry_time = msg.pop('expiry_time', None)
-        if expiry_time:
-            try:
-                expiry = datetime.datetime.strptime(expiry_time, '%Y-%m-%d %H:%M:%S')
-            except ValueError:
-                raise errors.DataValidationError('expiry time is not in a valid format')
-            if expiry < datetime.datetime.now():
-                logger.info('notification message is expired. dropped.')
-                return
+        self.dequeued = kwargs.pop('dequeued', None)
+        if self.expired(msg):
+            return True
 
         srv_type = msg.pop('type', '')
         if srv_type.lower() == 'fcm':
-            self.handle_fcm(*args, **msg)
+            self.ensure_connected('fcm')
+            return self.handle_fcm(*args, **msg)
         elif srv_type.lower() == 'apns':
-            self.handle_apns(*args, **msg)
+            self.ensure_connected('apns')
+            return self.handle_apns(*args, **msg)
         else:
             raise errors.ConfigurationError('invalid notification service type: {}'.format(srv_type))
 
+    def notify_many(self, msgs, dequeued=None):
+        """Send a list of notification messages, taken off the queue at the given dequeued time, if any,
+        returning the result of notify for each one. FCM messages with identical content are sent together as multicasts.
+        """
+        done = [True] * len(msgs)
+        groups = OrderedDict()
+        for i, msg in enumerate(msgs):
+            try:
+                if self.expired(msg):
+                    continue
+            except errors.DataValidationError as e:
+                logger.error('Data Validation Error: {}'.format(e))
+                continue
+            if msg.get('type', '').lower() == 'fcm':
+                msg.pop('type')
+                groups.setdefault(fingerprint(msg), []).append(i)
+            else:
+                done[i] = self.notify(msg=msg, dequeued=dequeued)
+
+        self.dequeued = dequeued
+        if groups:
+            self.ensure_connected('fcm')
+        for indexes in groups.values():
+            for i, ok in zip(indexes, self.handle_fcm_group([msgs[i] for i in indexes])):
+                done[i] = ok
+        return done
+
+    def handle_fcm_group(self, msgs):
+        """Send FCM messages with identical content, in as few multicasts as possible.
+        Returns whether each message is done.
+        """
+        max_tokens = settings.FCM.get('batch_max_tokens', 1000)
+        done = [True] * len(msgs)
+        targets = self.fcm_targets(msgs)
+        payload = self.fcm_payload(msgs[0])
+        if not self.payload_fits('fcm', payload):
+            return done
+        sent = set()  # indexes of messages handed to FCM
+        for offset in range(0, len(targets), max_tokens):
+            chunk = targets[offset:offset + max_tokens]
+            permit = breaker.breaker('fcm').allow()
+            if not permit:
+                self.park_fcm(msgs, chunk, done)
+                continue
+            ok, results = self.send_fcm([token for _, token in chunk], payload, permit, app=msgs[0].get('app'))
+            observe_sent('fcm', self.dequeued, self.newly_sent(chunk, sent))
+            self.map_fcm_results(msgs, chunk, ok, results, done)
+        return done
+
+    @staticmethod
+    def newly_sent(chunk, sent):
+        """Add the indexes of messages of a sent multicast to the sent set, returning the number of ones not in it yet"""
+        indexes = set(i for i, _ in chunk) - sent
+        sent.update(indexes)
+        return len(indexes)
+
+    def park_fcm(self, msgs, chunk, done):
+        """Park the (message index, token) targets of a multicast which is not allowed by the circuit breaker"""
+        for i, pairs in itertools.groupby(chunk, key=lambda pair: pair[0]):
+            parked = self.park('fcm', msgs[i], [token for _, token in pairs])
+            done[i] = done[i] and parked
+
+    def map_fcm_results(self, msgs, chunk, ok, results, done):
+        """Hand the outcome of a multicast to the messages its (message index, token) targets came from"""
+        if not ok:
+            for i, pairs in itertools.groupby(chunk, key=lambda pair: pair[0]):
+                # only the tokens of this multicast are sent again, not all tokens of the message
+                retried = self.retry('fcm', msgs[i], [token for _, token in pairs], 'unavailable')
+                done[i] = done[i] and retried
+        if results:
+            for i, pairs in itertools.groupby(zip(chunk, results), key=lambda pair: pair[0][0]):
+                pairs = list(pairs)
+                self.handle_fcm_results(msgs[i], [token for (_, token), _ in pairs], [result for _, result in pairs])
+
+    def fcm_targets(self, msgs):
+        """(message index, token) pairs to send FCM messages with identical content to.
+        Tokens are replaced with their canonical ids, and dead or duplicate ones are left out.
+        """
+        targets = []
+        seen = set()
+        for i, msg in enumerate(msgs):
+            tokens = tokens_registry.canonical_cache().rewrite(msg['tokens'])
+            if len(tokens) < len(msg['tokens']):
+                metrics.DUPLICATE_TOKENS_SKIPPED.inc(len(msg['tokens']) - len(tokens))
+            for token in self.live_tokens('fcm', tokens):
+                if token not in seen:
+                    seen.add(token)
+                    targets.append((i, token))
+        return targets
+
     def handle_fcm(self, *args, **kwargs):
-        try:
-            tokens = kwargs['tokens']
-            payload = {
-                'message_body': kwargs['body'],
-            }
-            if 'title' in kwargs:
-                payload.update({'message_title': kwargs['title']})
-            if 'custom_data' in kwargs:
-                payload.update({'payload': kwargs['custom_data']})
+        tokens = [token for _, token in self.fcm_targets([kwargs])]
+        if not tokens:
+            return True
+        payload = self.fcm_payload(kwargs)
+        if not self.payload_fits('fcm', payload):
+            return True
+        permit = breaker.breaker('fcm').allow()
+        if not permit:
+            return self.park('fcm', kwargs, tokens)
+        ok, results = self.send_fcm(tokens, payload, permit, app=kwargs.get('app'))
+        observe_sent('fcm', self.dequeued)
+        if not ok:
+            return self.retry('fcm', kwargs, tokens, 'unavailable')
+        if results:
+            self.handle_fcm_results(kwargs, tokens, results)
+        return True
+
+    @staticmethod
+    def fcm_payload(fields):
+        """Build encoded FCM payload from fields of a notification message"""
+        payload = {
+            'message_body': fields['body'],
+        }
+        if 'title' in fields:
+            payload.update({'message_title': fields['title']})
+        if 'custom_data' in fields:
+            payload.update({'payload': fields['custom_data']})
+        return fcm_service.Payload(payload)
 
+    def send_fcm(self, tokens, payload, permit, app=None):
+        """Send an encoded FCM payload to the given tokens, once rate limits allow, with a permit of the circuit breaker.
+        Returns whether the request was handled (False if it should be sent again), and the list
+        of per-token results if available.
+        """
+        ratelimit.limiter().acquire('fcm', len(tokens), app=app)
+        start = time.time()
+        results = None
+        ok = False
+        try:
             if len(tokens) > 1:
                 results = self.fcm_obj.notify_multiple(registration_ids=tokens, payload=payload)
             else:
@@ -132,34 +409,196 @@ class Notifier(object):
 
             # if args.verbosity > 1:
             #     print(fcm_service.FCM.result_str(results))
+            metrics.SENDS.inc(provider='fcm', result='success')
+            ok = True
         except fcm_service.NotConnectedError as e:
-            self.connect_fcm()
+            metrics.SENDS.inc(provider='fcm', result='failure')
+            metrics.RECONNECTS.inc(provider='fcm')
+            logger.error('Lost connection to FCM: {}'.format(e))
+            self.fcm_obj.reset()
+            return False, None
+        except fcm_service.UnavailableError as e:
+            metrics.SENDS.inc(provider='fcm', result='failure')
+            logger.error('Caught FCM error: {}'.format(e))
+            return False, None
+        except fcm_service.ResultError as e:
+            metrics.SENDS.inc(provider='fcm', result='failure')
+            logger.error('Caught FCM error: {}'.format(e))
+            results = e.results
+            ok = True
         except fcm_service.FCMError as e:
+            metrics.SENDS.inc(provider='fcm', result='failure')
             logger.error('Caught FCM error: {}'.format(e))
+            ok = True
+        finally:
+            metrics.SEND_LATENCY.observe(time.time() - start, provider='fcm')
+            # FCM answering with an error is up, as far as the breaker is concerned
+            breaker.breaker('fcm').record(permit, ok, time.time() - start)
+        return True, results
+
+    def handle_fcm_results(self, msg, tokens, results):
+        """Process per-token FCM results of a message"""
+        failed = [(token, result.get('error')) for token, result in zip(tokens, results) if result.get('error')]
+        if failed:
+            logger.info('FCM failed for {} of {} tokens of a message: {}'.format(len(failed), len(tokens), failed))
+            self.add_dead_tokens('fcm', [token for token, error in failed if error in FCM_DEAD_TOKEN_ERRORS])
+            retryable = [token for token, error in failed if error in FCM_RETRY_ERRORS]
+            if retryable:
+                self.retry('fcm', msg, retryable, 'token_error')
+        canonical_ids = dict((token, result['registration_id']) for token, result in zip(tokens, results)
+                             if result.get('registration_id') and result['registration_id'] != token)
+        if canonical_ids:
+            try:
+                tokens_registry.canonical_cache().add(canonical_ids)
+                metrics.CANONICAL_IDS.inc(len(canonical_ids))
+            except errors.DependencyError as e:
+                logger.error('failed to record canonical ids: {}'.format(e))
+
+    @staticmethod
+    def apns_payload(fields):
+        """Build encoded APNS payload from fields of a notification message"""
+        payload = {
+            'alert': fields['body'],
+        }
+        if 'badge' in fields:
+            payload.update({'badge': fields['badge']})
+        if 'sound' in fields:
+            payload.update({'sound': fields['sound']})
+        if 'category' in fields:
+            payload.update({'category': fields['category']})
+        if 'silent' in fields:
+            payload.update({'content-available': fields['silent']})
+        return apns_service.Payload(payload)
 
     def handle_apns(self, *args, **kwargs):
+        tokens = self.live_tokens('apns', kwargs['tokens'])
+        if not tokens:
+            return True
+        payload = self.apns_payload(kwargs)
+        if not self.payload_fits('apns', payload):
+            return True
+        apns_breaker = breaker.breaker('apns')
+        permit = apns_breaker.allow()
+        if not permit:
+            return self.park('apns', kwargs, tokens)
+        ratelimit.limiter().acquire('apns', len(tokens), app=kwargs.get('app'))
+        start = time.time()
+        ok = False
         try:
-            tokens = kwargs['tokens']
-            payload = {
-                'alert': kwargs['body'],
-            }
-            if 'badge' in kwargs:
-                payload.update({'badge': kwargs['badge']})
-            if 'sound' in kwargs:
-                payload.update({'sound': kwargs['sound']})
-            if 'category' in kwargs:
-                payload.update({'category': kwargs['category']})
-            if 'silent' in kwargs:
-                payload.update({'content_available': kwargs['silent']})
-
             if len(tokens) > 1:
-                self.apns_obj.notify_multiple(token=tokens, payload=payload)
+                self.apns_obj.notify_multiple(token=tokens, payload=payload, expiry=kwargs.get('expires_at'))
             else:
-                self.apns_obj.notify_single(token=tokens[0], payload=payload)
+                self.apns_obj.notify_single(token=tokens[0], payload=payload, expiry=kwargs.get('expires_at'))
+            metrics.SENDS.inc(provider='apns', result='success')
+            ok = True
         except apns_service.NotConnectedError as e:
+            metrics.SENDS.inc(provider='apns', result='failure')
+            metrics.RECONNECTS.inc(provider='apns')
+            logger.error('Lost connection to APNS: {}'.format(e))
             self.connect_apns()
+            if self.retrier is not None and e.results and any(e.results):
+                # tokens answered before the connection was lost are not sent again
+                self.handle_apns_results(kwargs, tokens, [result or {'status': None} for result in e.results])
+                return True
+            return self.retry('apns', kwargs, tokens, 'not_connected')
+        except apns_service.ResultError as e:
+            metrics.SENDS.inc(provider='apns', result='failure')
+            logger.error('Caught APNS error: {}'.format(e))
+            self.handle_apns_results(kwargs, tokens, e.results)
+            # HTTP/2 APNS reports being down per stream, rather than for the whole call
+            ok = not self.apns_unavailable(e.results)
         except apns_service.APNSError as e:
+            metrics.SENDS.inc(provider='apns', result='failure')
             logger.error('Caught APNS error: {}'.format(e))
+        finally:
+            metrics.SEND_LATENCY.observe(time.time() - start, provider='apns')
+            apns_breaker.record(permit, ok, time.time() - start)
+            observe_sent('apns', self.dequeued)
 
         # if args.verbosity > 1:
         #     print(apns_service.APNS.feedback_messages_str(self.apns_obj.feedback_messages()))
+        return True
+
+    @staticmethod
+    def apns_unavailable(results):
+        """Check whether most per-token APNS results are statuses of the service being unavailable,
+        rather than of the tokens, so that the circuit breaker counts the call as failed
+        """
+        results = results or []
+        unavailable = sum(1 for result in results if result['status'] in APNS_RETRY_STATUSES)
+        return unavailable * 2 > len(results)
+
+    def handle_apns_results(self, msg, tokens, results):
+        """Process per-token APNS results of a message, as reported by the HTTP/2 backend"""
+        failed = [(token, result['status'], result.get('reason')) for token, result in zip(tokens, results) if result['status'] != 200]
+        if failed:
+            logger.info('APNS failed for {} of {} tokens of a message: {}'.format(len(failed), len(tokens), failed))
+            self.add_dead_tokens('apns', [token for token, status, reason in failed
+                                          if status == 410 or reason in APNS_DEAD_TOKEN_REASONS])
+            if any(reason == 'DeviceTokenNotForTopic' for _, _, reason in failed):
+                # tokens are fine, but not for the configured topic
+                logger.error("APNS rejected tokens as not for topic '{}', check APNS['topic']".format(settings.APNS.get('topic')))
+            retryable = [token for token, status, reason in failed if status in APNS_RETRY_STATUSES]
+            if retryable:
+                self.retry('apns', msg, retryable, 'token_error')
+
+    def retry(self, provider, msg, tokens, reason):
+        """Hand tokens of a message which failed for a transient reason to the retrier.
+        Returns whether the message is done, which it is not without a retrier.
+        """
+        if self.retrier is None:
+            return False
+        self.retrier.add(provider, msg, tokens, reason)
+        return True
+
+    def park(self, provider, msg, tokens):
+        """Hand tokens of a message to the retrier, to be sent once the circuit breaker of
+        the service lets calls through again. Returns whether the message is done.
+        """
+        if self.retrier is None:
+            return False
+        self.retrier.park(provider, msg, tokens, breaker.breaker(provider).reopens_at())
+        return True
+
+    @staticmethod
+    def payload_fits(provider, payload):
+        """Check size of an encoded payload. Oversized ones would only be rejected by the service,
+        and with APNS binary protocol, take the connection (and the messages after them) down too.
+        """
+        if payload.size <= max_payload_size(provider):
+            return True
+        logger.error('{} payload of {} bytes is too large. dropped.'.format(provider, payload.size))
+        metrics.OVERSIZED.inc(provider=provider)
+        return False
+
+    @staticmethod
+    def live_tokens(provider, tokens):
+        """Leave out tokens known to be dead"""
+        live = tokens_registry.registry().live(provider, tokens)
+        if len(live) < len(tokens):
+            metrics.DEAD_TOKENS_SKIPPED.inc(len(tokens) - len(live), provider=provider)
+        return live
+
+    @staticmethod
+    def add_dead_tokens(provider, tokens):
+        if not tokens:
+            return
+        try:
+            tokens_registry.registry().add(provider, tokens)
+            metrics.DEAD_TOKENS.inc(len(tokens), provider=provider)
+        except errors.DependencyError as e:
+            logger.error('failed to record dead tokens: {}'.format(e))
+
+
+def poll_apns_feedback():
+    """Record the tokens reported by APNS feedback service as dead. Returns their number."""
+    if settings.APNS.get('backend', 'binary') != 'binary':
+        # HTTP/2 API has no feedback service. dead tokens are known from per-token results
+        return 0
+    try:
+        feedback = apns_service.APNS(**Notifier.apns_params()).feedback_messages()
+    except apns_service.APNSError as e:
+        logger.error('failed to get APNS feedback: {}'.format(e))
+        return 0
+    Notifier.add_dead_tokens('apns', [token for token, fail_time in feedback])
+    return len(feedback)
@@ -9,6 +9,7 @@ import logging.config
 
 import settings
 import threaded
+import processes
 
 try:
     logging.config.dictConfig(settings.LOGGING)
@@ -26,6 +27,11 @@ def main():
     parser.add_argument('--version', action='version', version='%(prog)s {}'.format(__version__))
     parser.add_argument('--queuer', choices=['queue', 'redis'], default='queue')
     parser.add_argument('--executer', choices=['thread', 'process'], default='thread')
+    # internal options, used when starting child processes
+    parser.add_argument('--role', choices=['all', 'webservice'], default='all', help=argparse.SUPPRESS)
+    parser.add_argument('--listen-fd', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--reuse-port', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--metrics-dir', default=None, help=argparse.SUPPRESS)
 
     try:
         args = parser.parse_args()
@@ -34,10 +40,12 @@ def main():
 
     logging.raiseExceptions = 1 if settings.DEBUG else 0  # turn on logging errors while debugging
 
-    if args.executer == 'thread':
+    if args.role == 'webservice':
+        processes.run_webservice(args)
+    elif args.executer == 'thread':
         threaded.run_multi_thread(args)
     else:
-        raise NotImplementedError('currently only threaded task execution is supported')
+        processes.run_multi_process(args)
 
 
 if __name__ == '__main__':
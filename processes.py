@@ -0,0 +1,299 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import os
+import sys
+import glob
+import time
+import shutil
+import signal
+import socket
+import atexit
+import tempfile
+import logging
+import functools
+import threading
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+
+import errors
+import settings
+import metrics
+import taskq
+import webservice
+import threaded
+import engine
+
+
+logger = logging.getLogger(__name__)
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pontiac-server.py')
+
+
+def is_alive(proc):
+    """Whether a subprocess.Popen or multiprocessing.Process object is still running"""
+    if hasattr(proc, 'poll'):
+        return proc.poll() is None
+    return proc.is_alive()
+
+
+def exit_code(proc):
+    return proc.returncode if hasattr(proc, 'returncode') else proc.exitcode
+
+
+class Supervisor(object):
+    """Keep a set of child processes running, restarting the ones which exit
+    """
+    def __init__(self):
+        self.spawners = OrderedDict()
+        self.heartbeats = {}
+        self.children = {}
+        self.started = {}
+        self.sockets = []  # sockets inherited by children, kept open for their whole lifetime
+        self.stop_flag = threading.Event()
+
+    def add(self, name, spawn, heartbeat=None):
+        """Register a child process. spawn is a callable which starts the child and
+        returns its subprocess.Popen or multiprocessing.Process object.
+        If a heartbeat (a shared multiprocessing.Value) is given, the child is expected to
+        keep it updated with current time, and is restarted when it stops doing so.
+        """
+        self.spawners[name] = spawn
+        if heartbeat is not None:
+            self.heartbeats[name] = heartbeat
+
+    def start_child(self, name):
+        logger.info('starting child process "{}"'.format(name))
+        if name in self.heartbeats:
+            self.heartbeats[name].value = time.time()
+        self.children[name] = self.spawners[name]()
+        self.started[name] = time.time()
+
+    def check(self):
+        """Start children which are not running. Returns names of the started children."""
+        started = []
+        for name in self.spawners:
+            proc = self.children.get(name)
+            if proc is not None:
+                if is_alive(proc):
+                    heartbeat = self.heartbeats.get(name)
+                    if heartbeat is not None and time.time() - heartbeat.value > settings.PROCESS['heartbeat_timeout']:
+                        logger.error('child process "{}" stopped making progress. terminating it'.format(name))
+                        proc.terminate()
+                    continue
+                if time.time() - self.started[name] < settings.PROCESS['restart_delay']:
+                    # crashing right after start. wait a bit not to spin on restarts
+                    continue
+                logger.error('child process "{}" exited with code {}'.format(name, exit_code(proc)))
+            self.start_child(name)
+            started.append(name)
+        return started
+
+    def run(self, *args, **kwargs):
+        atexit.register(self.stop)
+        while not self.stop_flag.is_set():
+            try:
+                self.check()
+            except (OSError, errors.PontiacError) as e:
+                logger.error('failed to start child process: {}'.format(e))
+            self.stop_flag.wait(settings.PROCESS['monitor_interval'])
+
+    def stop(self, timeout=10):
+        """Terminate all children, killing the ones which do not exit in time"""
+        self.stop_flag.set()
+        procs = [proc for proc in self.children.values() if is_alive(proc)]
+        for proc in procs:
+            proc.terminate()
+        deadline = time.time() + timeout
+        while any(is_alive(proc) for proc in procs) and time.time() < deadline:
+            time.sleep(0.1)
+        for proc in procs:
+            if is_alive(proc):
+                logger.warning('killing child process {}'.format(proc.pid))
+                os.kill(proc.pid, signal.SIGKILL)
+        self.children = {}
+
+
+def share_metrics():
+    """Share metrics of this process with its child processes, through METRICS['share_dir'],
+    or a temporary directory removed on exit. Returns the directory.
+    """
+    if metrics.REGISTRY.directory is not None:
+        return metrics.REGISTRY.directory
+    directory = settings.METRICS.get('share_dir')
+    if directory:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # counts of a previous run are not added up
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            os.remove(path)
+    else:
+        directory = tempfile.mkdtemp(prefix='pontiac-metrics-')
+        atexit.register(shutil.rmtree, directory, True)
+    metrics.share(directory)
+    return directory
+
+
+def spawn_webservice(args, listen_fd=None):
+    cmd = [sys.executable, SERVER_SCRIPT, '--queuer', args.queuer, '--role', 'webservice']
+    cmd += ['--verbose'] * (args.verbosity - 1)
+    if metrics.REGISTRY.directory is not None:
+        cmd += ['--metrics-dir', metrics.REGISTRY.directory]
+    if listen_fd is not None:
+        cmd += ['--listen-fd', str(listen_fd)]
+    else:
+        cmd += ['--reuse-port']
+    return subprocess.Popen(cmd, close_fds=False)
+
+
+def add_webservices(supervisor, args, count):
+    """Register count webservice child processes, all serving the configured http port,
+    and metrics of all processes
+    """
+    share_metrics()
+    listen_fd = None
+    if not (settings.HTTP_SOCKET.get('reuse_port') and hasattr(socket, 'SO_REUSEPORT')):
+        # without SO_REUSEPORT, children accept on a single listening socket created here
+        sock = webservice.listen_socket()
+        supervisor.sockets.append(sock)
+        listen_fd = sock.fileno()
+        if hasattr(os, 'set_inheritable'):
+            os.set_inheritable(listen_fd, True)
+    for i in range(count):
+        supervisor.add('webservice{}'.format(i + 1), functools.partial(spawn_webservice, args, listen_fd))
+
+
+def run_webservice(args):
+    """Entry point of a webservice child process"""
+    logger.info('webservice process {} started'.format(os.getpid()))
+    if args.metrics_dir:
+        metrics.share(args.metrics_dir)
+    try:
+        srv = webservice.Service(qs=taskq.make_queues(args.queuer), listen_fd=args.listen_fd,
+                                 reuse_port=args.reuse_port, local_notifiers=False, watch_parent=True)
+        srv.run()
+    except errors.PontiacError as e:
+        print('Pontiac Error. type: "{}", {}'.format(type(e), e))
+    logger.info('webservice process {} finished'.format(os.getpid()))
+
+
+def notifier_process(qs, heartbeat, ready):
+    """Entry point of a notifier child process"""
+    logger.info('notifier process {} started'.format(os.getpid()))
+    stop_flag = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_flag.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # interrupts are handled by the parent
+    parent_pid = os.getppid()
+    # values recorded by the parent before forking are counted there
+    metrics.REGISTRY.reset()
+    if metrics.REGISTRY.directory is not None:
+        metrics.share(metrics.REGISTRY.directory)
+
+    workers = []
+    engines = []
+    if settings.NOTIFIER['engine'] == 'async':
+        reactor = engine.new_reactor()
+        engines = [engine.start_engine(q, heartbeat=heartbeat, reactor=reactor) for q in qs.values()]
+        worker = threading.Thread(target=engine.reactor_func, kwargs={'reactor': reactor}, name='reactor')
+        worker.daemon = True
+        worker.start()
+        workers.extend((worker, eng.ready) for eng in engines)
+    else:
+        # each notification service has threads of its own, so a slow one does not hold up the others
+        for provider, q in qs.items():
+            for i in range(settings.PROCESS['notifier_threads']):
+                worker_ready = threading.Event()
+                kwargs = {'queue': q, 'provider': provider, 'stop_flag': stop_flag, 'heartbeat': heartbeat, 'ready': worker_ready}
+                worker = threading.Thread(target=threaded.notifier_func, kwargs=kwargs, name='{}-notifier{}'.format(provider, i + 1))
+                worker.daemon = True
+                worker.start()
+                workers.append((worker, worker_ready))
+    # retries scheduled by this process in memory of its own are promoted by itself
+    local_qs = dict((provider, q) for provider, q in qs.items() if not q.shared_schedule)
+    if local_qs:
+        worker = threading.Thread(target=threaded.promoter_func, kwargs={'qs': local_qs, 'stop_flag': stop_flag}, name='promoter')
+        worker.daemon = True
+        worker.start()
+
+    while not stop_flag.is_set():
+        if not ready.is_set() and all(worker_ready.is_set() for _, worker_ready in workers):
+            ready.set()
+        if not any(worker.is_alive() for worker, _ in workers):
+            logger.error('all notifier threads of process {} finished'.format(os.getpid()))
+            sys.exit(1)
+        if os.getppid() != parent_pid:
+            logger.warning('parent process {} is gone. stopping notifier'.format(parent_pid))
+            break
+        stop_flag.wait(settings.PROCESS['monitor_interval'])
+
+    stop_flag.set()
+    if engines:
+        # let sends in flight finish, then stop the reactor
+        engines[0].reactor.callFromThread(engine.stop_engines, engines)
+    for worker, _ in workers:
+        worker.join(settings.PROCESS['shutdown_timeout'])
+    try:
+        metrics.REGISTRY.publish()
+    except (IOError, OSError) as e:
+        logger.error('failed to write metrics snapshot: {}'.format(e))
+    logger.info('notifier process {} finished'.format(os.getpid()))
+
+
+def spawn_notifier(qs, heartbeat):
+    ready = multiprocessing.Event()
+    proc = multiprocessing.Process(target=notifier_process, args=(qs, heartbeat, ready))
+    proc.daemon = True
+    proc.start()
+    proc.ready = ready
+    return proc
+
+
+def run_multi_process(args):
+    """Run notification processors (notifiers) in a pool of supervised processes,
+    and the notification receiver (webservice) in this process or in its own processes.
+    """
+    logger.info('running in multi-process mode')
+    # queues have to exist before forking to be shared with notifier processes
+    qs = taskq.make_queues(args.queuer, executer='process')
+    # notifier processes send, and this one or webservice processes serve metrics
+    share_metrics()
+    if settings.TOKENS['registry'] != 'redis':
+        logger.warning('canonical ids are kept in memory of notifier processes, and not served on /canonical')
+
+    supervisor = Supervisor()
+    for i in range(settings.PROCESS['notifiers']):
+        heartbeat = multiprocessing.Value('d', time.time(), lock=False)
+        supervisor.add('notifier{}'.format(i + 1), functools.partial(spawn_notifier, qs, heartbeat), heartbeat=heartbeat)
+    logger.info('creating {} notifier processes'.format(settings.PROCESS['notifiers']))
+    supervisor.check()
+
+    # do not accept notifications before notifiers are up and connected
+    deadline = time.time() + settings.PROCESS['startup_timeout']
+    for name, proc in supervisor.children.items():
+        if not proc.ready.wait(max(0, deadline - time.time())):
+            logger.warning('notifier process "{}" did not get ready in time'.format(name))
+
+    threads = []
+    stop_flag = threading.Event()
+    webservice_count = settings.THREAD_COUNT['WEBSERVICE']
+    if webservice_count > 1 and args.queuer == 'redis':
+        logger.info('creating {} webservice processes'.format(webservice_count))
+        add_webservices(supervisor, args, webservice_count)
+    else:
+        kwargs = {'qs': qs, 'local_notifiers': False}
+        threads.append(threading.Thread(target=threaded.webservice_func, kwargs=kwargs, name='webservice'))
+    threads.append(threading.Thread(target=threaded.housekeeper_func, kwargs={'qs': qs, 'stop_flag': stop_flag}, name='housekeeper'))
+    threads.append(threading.Thread(target=threaded.promoter_func, kwargs={'qs': qs, 'stop_flag': stop_flag}, name='promoter'))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    def shutdown(signum, frame):
+        logger.info('received signal {}. shutting down'.format(signum))
+        supervisor.stop_flag.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    supervisor.run()
+    stop_flag.set()
+    supervisor.stop(timeout=settings.PROCESS['shutdown_timeout'])
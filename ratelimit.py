@@ -0,0 +1,154 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import os
+import time
+import logging
+import threading
+
+import redis
+
+import settings
+import metrics
+import taskq
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """Token bucket refilled at rate tokens per second, holding up to burst tokens.
+    Reservations always succeed, taking the bucket into debt if it has not enough tokens,
+    and return how long to wait before using them. So concurrent senders queue up behind
+    each other, and sends go out at the rate on average, whatever their sizes.
+    """
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+    def reserve(self, cost=1):
+        """Take cost tokens, and return the number of seconds to wait before using them"""
+        raise NotImplementedError()
+
+
+class MemoryTokenBucket(TokenBucket):
+    """Bucket of the threads of a single process"""
+    def __init__(self, *args, **kwargs):
+        TokenBucket.__init__(self, *args, **kwargs)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self, cost=1):
+        with self.lock:
+            now = time.time()
+            if now > self.last:
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+            self.tokens -= cost
+            return max(0, -self.tokens / self.rate)
+
+
+class RedisTokenBucket(TokenBucket):
+    """Bucket shared by all processes, as a redis hash of its tokens and the time they were counted.
+    Time comes from the clocks of the processes, and is never taken back, so a process with a clock
+    running behind only gets refills late.
+    """
+    # KEYS: bucket. ARGV: rate, burst, cost, now
+    RESERVE_SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now = tonumber(ARGV[4])
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+        local tokens = tonumber(state[1]) or burst
+        local last = tonumber(state[2]) or now
+        if now > last then
+            tokens = math.min(burst, tokens + (now - last) * rate)
+        else
+            now = last
+        end
+        tokens = tokens - tonumber(ARGV[3])
+        redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'time', tostring(now))
+        redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+        if tokens >= 0 then
+            return '0'
+        end
+        return tostring(-tokens / rate)
+    """
+
+    def __init__(self, *args, **kwargs):
+        TokenBucket.__init__(self, *args, **kwargs)
+        self.conn = taskq.redis_connection()
+        self.key = '{}:{}'.format(settings.RATE_LIMIT['redis_key'], self.name)
+        self.reserve_script = self.conn.register_script(RedisTokenBucket.RESERVE_SCRIPT)
+
+    def reserve(self, cost=1):
+        try:
+            wait = self.reserve_script(keys=[self.key], args=[self.rate, self.burst, cost, time.time()])
+        except redis.RedisError as e:
+            # better to risk going over the limit than to stop sending
+            logger.error('failed to take tokens of rate limit {} on redis: {}'.format(self.name, e))
+            return 0
+        return float(wait)
+
+
+class Limiter(object):
+    """Rate limits of sends, by provider and by the app messages are tagged with.
+    Costs are in number of device tokens sent to.
+    """
+    def __init__(self):
+        self.backend = settings.RATE_LIMIT.get('backend')
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.backend)
+
+    def bucket(self, name, limit):
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            with self.lock:
+                bucket = self.buckets.get(name)
+                if bucket is None:
+                    cls = RedisTokenBucket if self.backend == 'redis' else MemoryTokenBucket
+                    bucket = self.buckets[name] = cls(name, limit['rate'], limit.get('burst', limit['rate']))
+        return bucket
+
+    def reserve(self, provider, cost=1, app=None):
+        """Take tokens for a send from every limit it falls under, and return the number
+        of seconds to wait before sending
+        """
+        if not self.enabled:
+            return 0
+        wait = 0
+        limit = settings.RATE_LIMIT['providers'].get(provider)
+        if limit:
+            wait = self.bucket(provider, limit).reserve(cost)
+        limit = settings.RATE_LIMIT.get('apps', {}).get(app) if app else None
+        if limit:
+            wait = max(wait, self.bucket('app:{}'.format(app), limit).reserve(cost))
+        metrics.RATE_LIMIT_WAIT.observe(wait, provider=provider)
+        return wait
+
+    def acquire(self, provider, cost=1, app=None):
+        """Block until a send is allowed by rate limits"""
+        wait = self.reserve(provider, cost, app=app)
+        if wait > 0:
+            logger.debug('{} send to {} tokens is rate limited. waiting {:.3f} seconds'.format(provider, cost, wait))
+            time.sleep(wait)
+
+
+_limiter = None
+_limiter_pid = None
+_limiter_lock = threading.Lock()
+
+
+def limiter():
+    """Return the rate limiter of this process"""
+    global _limiter, _limiter_pid
+    with _limiter_lock:
+        if _limiter is None or _limiter_pid != os.getpid():
+            _limiter = Limiter()
+            _limiter_pid = os.getpid()
+        return _limiter
@@ -0,0 +1,88 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import time
+import random
+import logging
+import threading
+
+import simplejson as json
+
+import settings
+import errors
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def backoff(attempt):
+    """Delay before the given retry attempt (1 for the first retry): exponential, capped at
+    RETRY['max_delay'], of which a random half is taken off so that retries of messages which
+    failed together do not all come back at once
+    """
+    delay = min(settings.RETRY['max_delay'], settings.RETRY['base_delay'] * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class Retrier(object):
+    """Collect tokens of messages which failed for a transient reason, to be sent again later.
+    Retries are copies of their message with just the failed tokens, put back in the queue with a
+    send_at time after a backoff. Messages which failed RETRY['max_attempts'] times go to the dead
+    letter queue of the queue if it has one, and to the log otherwise.
+    Retries are only collected by add() and park(), and put in the queue by flush(), which should be called
+    before acknowledging the messages they came from. Thread safe.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+        self.dead_letters = getattr(queue, 'dead_letters', None)
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def add(self, provider, msg, tokens, reason):
+        attempt = msg.get('attempt', 1)
+        task = dict(msg, type=provider, tokens=list(tokens), attempt=attempt)
+        task.pop('send_at', None)
+        if attempt >= settings.RETRY['max_attempts']:
+            task['failure'] = reason
+            metrics.DEAD_LETTERS.inc(provider=provider)
+            logger.warning('{} message to {} tokens failed {} times ({}). giving up'.format(provider, len(tokens), attempt, reason))
+        else:
+            task['attempt'] = attempt + 1
+            task['send_at'] = time.time() + backoff(attempt)
+            metrics.RETRIES.inc(provider=provider, reason=reason)
+        with self.lock:
+            self.pending.append(task)
+
+    def park(self, provider, msg, tokens, until):
+        """Collect tokens of a message to be sent again after the given time, without counting
+        an attempt. Parked messages are spread over BREAKER['open_timeout'] seconds after it,
+        so that they do not all come back while the service is only being probed.
+        """
+        task = dict(msg, type=provider, tokens=list(tokens))
+        task['send_at'] = until + random.uniform(0, settings.BREAKER['open_timeout'])
+        metrics.PARKED.inc(provider=provider)
+        with self.lock:
+            self.pending.append(task)
+
+    def flush(self):
+        """Put collected retries in the queue, and given up messages in the dead letter queue, or in
+        the log if there is none. Does blocking queue calls. If they fail, the messages are kept for
+        the next flush, and DependencyError is raised.
+        """
+        with self.lock:
+            tasks, self.pending = self.pending, []
+        retries = [task for task in tasks if 'failure' not in task]
+        dead = [task for task in tasks if 'failure' in task]
+        try:
+            if retries:
+                self.queue.put_many(retries)
+                retries = []
+            if dead and self.dead_letters is not None:
+                self.dead_letters.put_many(dead)
+                dead = []
+        except errors.DependencyError:
+            with self.lock:
+                self.pending = retries + dead + self.pending
+            raise
+        for task in dead:
+            logger.error('dead letter: {}'.format(json.dumps(task, sort_keys=True)))
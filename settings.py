@@ -155,22 +155,122 @@ LOGGING = {
 
 HTTP_SOCKET = {
     'host': '0.0.0.0',
-    'port': 1234
+    'port': 1234,
+    'backlog': 128,
+    # with several webservice processes, let each bind its own socket (SO_REUSEPORT), when supported.
+    # a single webservice never sets it, so a second server started on the same port fails to bind
+    'reuse_port': True,
+}
+
+WEBSERVICE = {
+    'queue_threads': 10,  # max number of threads doing blocking queue operations for http requests
+    # requests are refused with 429 while the queue holds more messages than this. 0 disables.
+    # keep it under QUEUE_MAX_SIZE, as memory queues drop messages once they are full
+    'queue_high_water': 900000,
+    'depth_interval': 1,  # in seconds. how often queue depth is checked against the high water mark
+    'retry_after': 5,  # in seconds. how long refused clients are asked to wait
+}
+
+METRICS = {
+    # with several processes (webservice or notifier processes), each one writes its metrics to a file in
+    # share_dir every share_interval seconds, and /stat and /metrics add up the ones of all processes.
+    # None shares them through a temporary directory removed on exit
+    'share_dir': None,
+    'share_interval': 5,  # in seconds
 }
 
 SCHEMA = {
     'NOTIFICATION': 'schemas/notification.schema.json',
 }
 
+PAYLOAD = {
+    # what to do with messages which do not fit in the payload size limit of their service.
+    # "reject" the request, or "truncate" message body to fit (rejecting if that is not enough)
+    'oversize': 'reject',
+}
+
 QUEUE_MAX_SIZE = 1000000
 
+PRIORITY = {
+    # share of notifier batches each priority lane gets while all of them have messages waiting
+    'weights': {'high': 8, 'normal': 4, 'low': 1},
+    # in seconds. idle notifiers wait on the normal lane, checking the others after poll_interval,
+    # then twice as long each time up to max_poll_interval, for queues whose lanes can not be waited on together
+    'poll_interval': 0.05,
+    'max_poll_interval': 1,
+}
+
 REDIS = {
     'host': 'localhost',
     'port': 6379,
     'password': '',  # empty string or None disables
     'db': 0,
     'max_size': 0,  # 0 disables
-    'expires': 300  # in seconds
+    'expires': 300,  # in seconds
+    'reliable': False,  # keep taken messages in a processing list until they are acknowledged
+    'visibility_timeout': 60,  # in seconds. unacknowledged messages are requeued after this
+    'requeue_batch': 100,  # number of messages requeued per round trip
+    'purge_batch': 1000,  # number of expired messages purged per round trip
+    'purge_scan': 100000,  # max number of queued messages searched for expired ones per round trip
+}
+
+SCHEDULE = {
+    # messages with a send_at time are kept aside until it comes, then put in their queue by a promoter.
+    # due messages are promoted at this rate per queue, so that many scheduled for the same time
+    # reach notifiers at a steady pace rather than all at once
+    'rate': 5000,  # messages per second
+    'interval': 0.5,  # in seconds. how often due messages are promoted
+    'batch': 1000,  # max number of messages promoted per round trip, with redis
+}
+
+RETRY = {
+    # tokens which failed for a transient reason (service unavailable, lost connection, rate exceeded)
+    # are sent again in a copy of their message, scheduled after an exponential backoff with jitter.
+    # messages failing max_attempts times are put in the dead letter queue of their queue (e.g. notif:fcm:dead)
+    'max_attempts': 5,  # sends of a message, including the first one
+    'base_delay': 1,  # in seconds. backoff before the first retry, doubled on every retry
+    'max_delay': 300,  # in seconds
+}
+
+QUEUE_HOUSEKEEPING_INTERVAL = 5  # in seconds. also how often expired messages are purged from queues
+
+TOKENS = {
+    'registry': 'memory',  # where dead tokens and canonical ids are kept. "memory" or "redis" (shared by all processes)
+    'redis_key': 'dead_tokens',  # prefix of redis sets, one per provider
+    'providers': ['fcm', 'apns'],
+    'bloom_capacity': 1000000,  # number of dead tokens the in-memory filter is sized for, per provider
+    'bloom_error_rate': 0.001,  # ratio of live tokens which need a lookup of the authoritative set
+    'sync_interval': 60,  # in seconds. how often tokens added by other processes are loaded, with redis registry
+    'changelog_size': 100000,  # number of additions kept for processes to load incrementally. ones further behind load everything
+    'feedback_interval': 3600,  # in seconds. how often APNS feedback service is polled. 0 disables
+    'canonical_max_size': 100000,  # max number of FCM canonical id mappings cached in memory
+    'canonical_redis_key': 'canonical_ids',  # redis hash of all FCM canonical id mappings, with redis registry
+}
+
+RATE_LIMIT = {
+    'backend': None,  # None disables. "memory" limits each process on its own, "redis" shares limits among all processes
+    'redis_key': 'rate_limit',  # prefix of redis hashes, one per limit
+    # limits in device tokens sent to per second, and burst (max tokens sent at once after being idle)
+    'providers': {
+        'fcm': {'rate': 1000, 'burst': 2000},
+        'apns': {'rate': 1000, 'burst': 2000},
+    },
+    # per-app limits, for messages tagged with an "app" field, on top of provider limits.
+    # e.g. {'myapp': {'rate': 100, 'burst': 200}}
+    'apps': {},
+}
+
+BREAKER = {
+    # a circuit breaker per notification service and process. while a service is failing (connection
+    # errors, unavailable responses or slow calls), its messages are parked in their queue until the
+    # breaker lets probes through, instead of holding notifiers up on timeouts
+    'enabled': True,
+    'window': 30,  # in seconds. outcomes of calls considered
+    'min_calls': 20,  # no tripping on fewer calls in the window
+    'failure_rate': 0.5,  # share of failed (or slow) calls in the window to trip at
+    'slow_call': 5,  # in seconds. calls slower than this count as failed
+    'open_timeout': 10,  # in seconds. time before probing a service again
+    'probes': 2,  # max number of calls at once while probing
 }
 
 try:
@@ -179,14 +279,56 @@ except NotImplementedError:
     CPU_COUNT = 1
 
 THREAD_COUNT = {
-    'WEBSERVICE': 1,
-    'NOTIFICATION': CPU_COUNT * 2,
+    'WEBSERVICE': 1,  # more than one runs each webservice in a separate process. needs redis queuer.
+    # max number of notifier threads per notification service, with thread executer. see AUTOSCALE.
+    # each service has a pool of its own, so one which is slow or hanging does not hold the other up
+    'FCM': CPU_COUNT * 4,
+    'APNS': CPU_COUNT * 4,
+}
+
+AUTOSCALE = {
+    # notifier threads kept running per notification service when there is no backlog. max is in THREAD_COUNT.
+    # defaults to the number of notifiers started before autoscaling, and backlog adds up to THREAD_COUNT
+    'min_notifiers': CPU_COUNT * 2,
+    'interval': 2,  # in seconds. how often the backlog is checked
+    'drain_target': 5,  # in seconds. enough notifiers are run to clear the backlog in this time, at observed send latency
+    'initial_latency': 0.1,  # in seconds. send latency assumed before any sends are observed
+    'cooldown': 30,  # in seconds. min time between retiring notifiers, once they are not needed
+    'idle_timeout': 30,  # in seconds. threads left without a task for this long exit
+}
+
+PROCESS = {
+    'monitor_interval': 1,  # in seconds
+    'restart_delay': 5,  # in seconds. min time between restarts of a child process which keeps exiting
+    'notifiers': CPU_COUNT,  # number of notifier processes, with process executer
+    'notifier_threads': 2,  # number of notifier threads per notification service in each notifier process
+    'startup_timeout': 30,  # in seconds. how long to wait for notifier processes to connect before serving http
+    'shutdown_timeout': 10,  # in seconds. how long to wait for children to finish before killing them
+    'heartbeat_timeout': 300,  # in seconds. notifier processes not making progress for this long are restarted
+}
+
+NOTIFIER = {
+    'batch_size': 100,  # max number of messages a notifier worker takes off the queue at once
+    'poll_timeout': 1,  # in seconds. how long an idle notifier worker blocks before checking whether to stop
+    # "thread": each notifier thread sends one message at a time.
+    # "async": a single event loop keeps up to max_in_flight messages being sent, replacing notifier threads
+    'engine': 'thread',
+    'max_in_flight': 1000,  # async engine. messages being sent at once per notification service, before taking more off its queue
+    'blocking_threads': 4,  # async engine. threads calling services without a non-blocking client (APNS)
 }
 
 FCM = {
     #'proxy': 'http://localhost:8000',
     'api_key': '-api-key-',
     'proto': 'xmpp',
+    'batch_linger': 0.02,  # in seconds. how long to wait for more messages with the same content to send together
+    'batch_max_tokens': 1000,  # max number of tokens in a multicast
+    'pool_size': 10,  # max number of connections to FCM, shared by all notifier threads of a process
+    'pool_idle_timeout': 120,  # in seconds. pooled connections are dropped after being idle for this long
+    'pool_retries': 2,  # retries on failures to connect
+    'timeout': 10,  # in seconds
+    'endpoint': 'https://fcm.googleapis.com/fcm/send',  # http api url. point at a stand-in server (e.g. bench/simulators.py) to test
+    'ca': None,  # CA bundle to verify the endpoint certificate with. None uses system defaults
     # low_priority
     # delay_while_idle
     # time_to_live
@@ -199,4 +341,17 @@ APNS = {
     'cert': 'path/to/cert.pem',
     'key': 'path/to/key.pem',
     'dist': False,
+    'backend': 'binary',  # "binary" for the legacy binary protocol, "http2" for the HTTP/2 provider API
+    # options of binary backend. "host:port" of stand-in servers, None uses apple servers
+    'gateway': None,
+    'feedback': None,
+    # options of http2 backend
+    'topic': None,  # usually the bundle id of the app
+    'host': None,  # None uses apple servers. set host and port to use a stand-in server
+    'port': None,
+    'secure': True,  # False talks plain HTTP/2 (h2c), only useful with a stand-in server
+    'ca': None,  # CA bundle to verify server certificate. None uses system defaults
+    'pool_size': 2,  # number of connections per notifier
+    'max_concurrent_streams': 500,  # per connection, also limited by the server
+    'timeout': 10,  # in seconds
 }
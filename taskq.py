@@ -1,6 +1,13 @@
 from __future__ import unicode_literals, print_function, division, absolute_import
 from pprint import pprint
 import logging
+import math
+import heapq
+import itertools
+import os
+import multiprocessing
+import socket
+import threading
 import time
 from six.moves import queue
 
@@ -13,6 +20,9 @@ import errors
 
 logger = logging.getLogger(__name__)
 
+PROVIDERS = ('fcm', 'apns')  # notification services, each with a queue of its own
+PRIORITIES = ('high', 'normal', 'low')  # lanes of laned queues, highest first
+
 
 class TaskQueue(object):
     """Basic interface to be implemented by a keyed task queuer class.
@@ -23,16 +33,81 @@ class TaskQueue(object):
     easily serialized to json or other formats.
     If a task queue is full, put requests should be dropped silently.
     If a task queue is empty, get requests should block.
+    Batched gets should block only while the queue is empty, up to the given
+    timeout (None blocks indefinitely, 0 does not block at all), and return
+    whatever is available, up to the requested number of tasks.
     """
+    scheduled = {}
+    schedule_lock = threading.Lock()
+    schedule_counter = itertools.count()  # orders tasks due at the same time, as dicts do not compare
+    shared_schedule = False  # whether tasks scheduled by any process can be promoted by any other
+
     def __init__(self, *args, **kwargs):
         self.key = kwargs.pop('key')
 
     def put(self, task):
         raise NotImplementedError()
 
+    def put_many(self, tasks):
+        """Put a list of tasks in the queue, and return the queue size afterwards.
+        Implementations are expected to do this in a single round trip if possible.
+        """
+        for task in tasks:
+            self.put(task)
+        return self.size()
+
     def get(self):
         raise NotImplementedError()
 
+    def get_many(self, max_items, timeout=None):
+        """Get a list of at most max_items tasks, oldest first. Empty list on timeout."""
+        raise NotImplementedError()
+
+    def ack(self, task):
+        """Acknowledge that a task taken from the queue has been fully processed.
+        Queues without delivery guarantees can ignore this.
+        """
+        pass
+
+    def ack_many(self, tasks):
+        for task in tasks:
+            self.ack(task)
+
+    def requeue_expired(self):
+        """Put tasks whose processing lease has expired back in the queue.
+        Returns the number of requeued tasks.
+        """
+        return 0
+
+    def purge_expired(self):
+        """Remove tasks whose expires_at time (epoch seconds) has passed, if the queue
+        keeps an index of them. Returns the number of removed tasks.
+        """
+        return 0
+
+    def schedule_many(self, tasks):
+        """Keep tasks until their send_at time (epoch seconds), for promote_due to put them in the queue.
+        This implementation keeps them in a heap in memory, so they have to be promoted by the same process.
+        """
+        with TaskQueue.schedule_lock:
+            heap = TaskQueue.scheduled.setdefault(self.key, [])
+            for task in tasks:
+                heapq.heappush(heap, (task['send_at'], next(TaskQueue.schedule_counter), task))
+
+    def promote_due(self, max_items):
+        """Put up to max_items scheduled tasks which are due in the queue, earliest first.
+        Returns the number of promoted tasks.
+        """
+        now = time.time()
+        due = []
+        with TaskQueue.schedule_lock:
+            heap = TaskQueue.scheduled.get(self.key, [])
+            while heap and len(due) < max_items and heap[0][0] <= now:
+                due.append(heapq.heappop(heap)[2])
+        if due:
+            self.put_many(due)
+        return len(due)
+
     def size(self):
         raise NotImplementedError()
 
@@ -41,44 +116,211 @@ class TaskQueue(object):
         raise NotImplementedError()
 
 
+class LeasedTask(dict):
+    """A task dict which remembers the raw queue entry it was taken from,
+    so that it can be acknowledged after being processed.
+    """
+    def __init__(self, raw, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.raw = raw
+
+
+def queue_class(queuer, executer='thread'):
+    """Return the TaskQueue implementation for queuer and executer names given on command line"""
+    if queuer == 'queue':
+        return ProcessQueue if executer == 'process' else MemoryQueue
+    elif queuer == 'redis':
+        return ReliableRedisQueue if settings.REDIS.get('reliable') else RedisQueue
+    raise NotImplementedError()
+
+
+def make_queues(queuer, executer='thread'):
+    """Create the dict of task queues used by the application: a notification queue per
+    notification service, so that a slow service does not hold up messages to the others
+    """
+    q_class = queue_class(queuer, executer)
+    return dict((provider, LanedQueue(key='notif:{}'.format(provider), queue_class=q_class)) for provider in PROVIDERS)
+
+
 class MemoryQueue(TaskQueue):
-    """TaskQueue implementation using python builtin Queue module"""
+    """TaskQueue implementation using python builtin Queue module
+    Tasks with an expiry time are also kept in a heap, ordered by it, to find expired ones.
+    Entries of tasks taken off the queue are left in the heap, and dropped once they make up most of it.
+    """
     queues = {}
+    expiry_heaps = {}
+    expiring = {}  # ids of queued tasks with an expiry time, per queue
+    expiry_lock = threading.Lock()
+    expiry_counter = itertools.count()  # orders tasks expiring at the same time, as dicts do not compare
 
     def __init__(self, *args, **kwargs):
         TaskQueue.__init__(self, *args, **kwargs)
         if self.key not in MemoryQueue.queues:
             MemoryQueue.queues[self.key] = queue.Queue(maxsize=settings.QUEUE_MAX_SIZE)
+            MemoryQueue.expiry_heaps[self.key] = []
+            MemoryQueue.expiring[self.key] = set()
+
+    def index(self, task):
+        if 'expires_at' in task:
+            with MemoryQueue.expiry_lock:
+                heapq.heappush(MemoryQueue.expiry_heaps[self.key], (task['expires_at'], next(MemoryQueue.expiry_counter), task))
+                MemoryQueue.expiring[self.key].add(id(task))
+
+    def unindex(self, tasks):
+        """Forget tasks taken off the queue. Their heap entries keep them alive, so their ids are not reused until dropped."""
+        expiring = [id(task) for task in tasks if 'expires_at' in task]
+        if not expiring:
+            return
+        with MemoryQueue.expiry_lock:
+            ids = MemoryQueue.expiring[self.key]
+            ids.difference_update(expiring)
+            heap = MemoryQueue.expiry_heaps[self.key]
+            if len(heap) > 2 * len(ids) + 1000:
+                heap[:] = [entry for entry in heap if id(entry[2]) in ids]
+                heapq.heapify(heap)
 
     def put(self, task):
         q = MemoryQueue.queues[self.key]
         try:
             q.put(task, False)
+            self.index(task)
         except (queue.Empty, queue.Full) as e:
             logger.warning('Queue operation failed: {}'.format(e))
 
+    def put_many(self, tasks):
+        q = MemoryQueue.queues[self.key]
+        dropped = 0
+        for task in tasks:
+            try:
+                q.put(task, False)
+                self.index(task)
+            except queue.Full:
+                dropped += 1
+        if dropped:
+            logger.warning('Queue operation failed: {} tasks dropped on full queue'.format(dropped))
+        return q.qsize()
+
     def get(self):
         q = MemoryQueue.queues[self.key]
         try:
             item = q.get(True)
             q.task_done()
+            self.unindex([item])
             return item
         except (queue.Empty, queue.Full) as e:
             logger.warning('Queue operation failed: {}'.format(e))
 
+    def get_many(self, max_items, timeout=None):
+        q = MemoryQueue.queues[self.key]
+        try:
+            items = [q.get(timeout != 0, timeout or None)]
+        except queue.Empty:
+            return []
+        q.task_done()
+        while len(items) < max_items:
+            try:
+                items.append(q.get(False))
+            except queue.Empty:
+                break
+            q.task_done()
+        self.unindex(items)
+        return items
+
+    def purge_expired(self):
+        heap = MemoryQueue.expiry_heaps[self.key]
+        now = time.time()
+        expired = {}
+        with MemoryQueue.expiry_lock:
+            ids = MemoryQueue.expiring[self.key]
+            while heap and heap[0][0] <= now:
+                task = heapq.heappop(heap)[2]
+                if id(task) in ids:
+                    expired[id(task)] = task
+            ids.difference_update(expired)
+        if not expired:
+            return 0
+        q = MemoryQueue.queues[self.key]
+        with q.mutex:
+            kept = [task for task in q.queue if id(task) not in expired]
+            removed = len(q.queue) - len(kept)
+            if removed:
+                q.queue.clear()
+                q.queue.extend(kept)
+                q.unfinished_tasks -= removed
+                q.not_full.notify_all()
+        return removed
+
     def size(self):
         q = MemoryQueue.queues[self.key]
         return q.qsize()
 
     def close(self):
         del MemoryQueue.queues[self.key]
+        MemoryQueue.expiry_heaps.pop(self.key, None)
+        MemoryQueue.expiring.pop(self.key, None)
 
 
-class RedisQueue(TaskQueue):
-    conn = None
+class ProcessQueue(TaskQueue):
+    """TaskQueue implementation using multiprocessing queues, to be shared with child processes.
+    Queues should be created before starting the children.
+    Tasks can not be removed from the middle of these queues, so expired ones are only
+    dropped once they are taken off the queue.
+    """
+    queues = {}
 
     def __init__(self, *args, **kwargs):
         TaskQueue.__init__(self, *args, **kwargs)
+        if self.key not in ProcessQueue.queues:
+            ProcessQueue.queues[self.key] = multiprocessing.Queue(maxsize=settings.QUEUE_MAX_SIZE)
+        # keep a reference on the instance, so the queue goes along when this object is passed to a child
+        self.queue = ProcessQueue.queues[self.key]
+
+    def put(self, task):
+        try:
+            self.queue.put(task, False)
+        except queue.Full as e:
+            logger.warning('Queue operation failed: {}'.format(e))
+
+    def put_many(self, tasks):
+        dropped = 0
+        for task in tasks:
+            try:
+                self.queue.put(task, False)
+            except queue.Full:
+                dropped += 1
+        if dropped:
+            logger.warning('Queue operation failed: {} tasks dropped on full queue'.format(dropped))
+        return self.size()
+
+    def get(self):
+        return self.queue.get(True)
+
+    def get_many(self, max_items, timeout=None):
+        try:
+            items = [self.queue.get(timeout != 0, timeout or None)]
+        except queue.Empty:
+            return []
+        while len(items) < max_items:
+            try:
+                items.append(self.queue.get(False))
+            except queue.Empty:
+                break
+        return items
+
+    def size(self):
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            # qsize is not available on some platforms, like macOS
+            return 0
+
+    def close(self):
+        ProcessQueue.queues.pop(self.key, None)
+
+
+def redis_connection():
+    """Return the redis connection shared by queues and other redis backed stores"""
+    if RedisQueue.conn is None:
         params = {
             'host': settings.REDIS['host'],
             'port': settings.REDIS.get('port', 6379),
@@ -86,15 +328,71 @@ class RedisQueue(TaskQueue):
         }
         if settings.REDIS.get('password'):
             params.update({'password': settings.REDIS['password']})
+        try:
+            RedisQueue.conn = redis.Redis(**params)  # redis.StrictRedis(**params)
+        except redis.RedisError as e:
+            raise errors.DependencyError('failed to connect to redis server: {}'.format(e))
+    return RedisQueue.conn
 
-        if RedisQueue.conn is None:
-            try:
-                RedisQueue.conn = redis.Redis(**params)  # redis.StrictRedis(**params)
-            except redis.RedisError as e:
-                raise errors.DependencyError('failed to connect to redis server: {}'.format(e))
 
+class RedisQueue(TaskQueue):
+    """TaskQueue implementation using redis lists.
+    Tasks with an expiry time are also kept in a sorted set by it, to find expired ones.
+    """
+    conn = None
+    # KEYS: queue, expiry index. ARGV: now, count, max number of list entries searched
+    PURGE_SCRIPT = """
+        local items = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+        local budget = tonumber(ARGV[3])
+        local length = redis.call('LLEN', KEYS[1])
+        local removed = 0
+        local done = 0
+        for i = 1, #items do
+            local reach = math.min(budget, length)
+            local pos = nil
+            if reach > 0 then
+                -- expired tasks are mostly old ones, near the tail where a negative rank starts searching
+                pos = redis.call('LPOS', KEYS[1], items[i], 'RANK', -1, 'MAXLEN', reach)
+            end
+            if pos then
+                budget = budget - 2 * (length - pos)
+                removed = removed + redis.call('LREM', KEYS[1], -1, items[i])
+                length = length - 1
+            elseif reach < length and budget < tonumber(ARGV[3]) then
+                -- out of budget, the rest is searched on the next call
+                break
+            end
+            -- tasks not found are gone (trimmed, or taken by a consumer which died before unindexing them),
+            -- or further than a whole call searches, and are dropped when taken
+            redis.call('ZREM', KEYS[2], items[i])
+            done = done + 1
+        end
+        return {done, removed}
+    """
+
+    # KEYS: scheduled, queue, expiry index. ARGV: now, count
+    PROMOTE_SCRIPT = """
+        local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+        for i = 1, #items do
+            redis.call('ZREM', KEYS[1], items[i])
+            redis.call('LPUSH', KEYS[2], items[i])
+            local ok, task = pcall(cjson.decode, items[i])
+            if ok and type(task) == 'table' and type(task['expires_at']) == 'number' then
+                redis.call('ZADD', KEYS[3], task['expires_at'], items[i])
+            end
+        end
+        return #items
+    """
+
+    def __init__(self, *args, **kwargs):
+        TaskQueue.__init__(self, *args, **kwargs)
+        redis_connection()
         self.max_size = int(settings.REDIS.get('max_size', 0))
-        # TODO: implement redis pipeline interface to increase performance
+        self.shared_schedule = True
+        self.expiry_key = '{}:expiry'.format(self.key)
+        self.scheduled_key = '{}:scheduled'.format(self.key)
+        self.purge_script = RedisQueue.conn.register_script(RedisQueue.PURGE_SCRIPT)
+        self.promote_script = RedisQueue.conn.register_script(RedisQueue.PROMOTE_SCRIPT)
 
     def serialize(self, task):
         """Serialize the task object to a string to be able to put it in redis"""
@@ -104,19 +402,108 @@ class RedisQueue(TaskQueue):
         return json.loads(task)
 
     def put(self, task):
+        self.put_many([task])
+
+    def put_many(self, tasks):
+        """Push all tasks with a single multi-value LPUSH, trimming and indexing expiry times in the same pipeline"""
+        if not tasks:
+            return self.size()
+        items = [self.serialize(task) for task in tasks]
+        expiring = dict((item, task['expires_at']) for item, task in zip(items, tasks) if 'expires_at' in task)
         try:
-            RedisQueue.conn.lpush(self.key, self.serialize(task))
+            pipe = RedisQueue.conn.pipeline(transaction=False)
+            pipe.lpush(self.key, *items)
             if self.max_size:
-                RedisQueue.conn.ltrim(self.key, 0, self.max_size - 1)
+                pipe.ltrim(self.key, 0, self.max_size - 1)
+            if expiring:
+                pipe.zadd(self.expiry_key, expiring)
+            sz = int(pipe.execute()[0])
         except redis.RedisError as e:
             raise errors.DependencyError('failed to push to redis server: {}'.format(e))
+        return min(sz, self.max_size) if self.max_size else sz
 
     def get(self):
         try:
             item = RedisQueue.conn.brpop(self.key)[1]
         except redis.RedisError as e:
             raise errors.DependencyError('failed to pop from redis server: {}'.format(e))
-        return self.deserialize(item)
+        return self.unindex([item])[0]
+
+    def unindex(self, items):
+        """Deserialize raw items taken off the queue, dropping the expiry index entries of the tasks
+        which have one, so that purges do not look for them
+        """
+        tasks = [self.deserialize(item) for item in items]
+        expiring = [item for item, task in zip(items, tasks) if 'expires_at' in task]
+        if expiring:
+            try:
+                RedisQueue.conn.zrem(self.expiry_key, *expiring)
+            except redis.RedisError as e:
+                raise errors.DependencyError('failed to update expiry index on redis server: {}'.format(e))
+        return tasks
+
+    def _pop_many(self, count):
+        """Atomically pop up to count raw items from the tail of the list, oldest first"""
+        if count <= 0:
+            return []
+        pipe = RedisQueue.conn.pipeline(transaction=True)
+        pipe.lrange(self.key, -count, -1)
+        pipe.ltrim(self.key, 0, -count - 1)
+        items = pipe.execute()[0]
+        items.reverse()
+        return items
+
+    def get_many(self, max_items, timeout=None):
+        try:
+            items = self._pop_many(max_items)
+            if not items and timeout != 0:
+                # queue is empty; block for the first item, then grab whatever has piled up behind it
+                item = RedisQueue.conn.brpop(self.key, timeout=int(math.ceil(timeout)) if timeout else 0)
+                if item is None:
+                    return []
+                items = [item[1]] + self._pop_many(max_items - 1)
+        except redis.RedisError as e:
+            raise errors.DependencyError('failed to pop from redis server: {}'.format(e))
+        return self.unindex(items)
+
+    def purge_expired(self):
+        batch = int(settings.REDIS.get('purge_batch', 1000))
+        scan = int(settings.REDIS.get('purge_scan', 100000))
+        total = 0
+        try:
+            while True:
+                found, removed = self.purge_script(keys=[self.key, self.expiry_key], args=[time.time(), batch, scan])
+                total += int(removed)
+                if int(found) < batch:
+                    break
+        except redis.RedisError as e:
+            raise errors.DependencyError('failed to purge expired tasks on redis server: {}'.format(e))
+        return total
+
+    def schedule_many(self, tasks):
+        """Keep tasks in a sorted set by their send_at time, shared by all processes.
+        Identical tasks scheduled more than once are kept once.
+        """
+        if not tasks:
+            return
+        try:
+            RedisQueue.conn.zadd(self.scheduled_key, dict((self.serialize(task), task['send_at']) for task in tasks))
+        except redis.RedisError as e:
+            raise errors.DependencyError('failed to schedule tasks on redis server: {}'.format(e))
+
+    def promote_due(self, max_items):
+        batch = int(settings.SCHEDULE.get('batch', 1000))
+        total = 0
+        try:
+            while total < max_items:
+                count = min(batch, max_items - total)
+                promoted = int(self.promote_script(keys=[self.scheduled_key, self.key, self.expiry_key], args=[time.time(), count]))
+                total += promoted
+                if promoted < count:
+                    break
+        except redis.RedisError as e:
+            raise errors.DependencyError('failed to promote scheduled tasks on redis server: {}'.format(e))
+        return total
 
     def size(self):
         try:
@@ -128,5 +515,335 @@ class RedisQueue(TaskQueue):
     def close(self):
         try:
             RedisQueue.conn.ltrim(self.key, 0, 0)
+            RedisQueue.conn.delete(self.expiry_key, self.scheduled_key)
         except redis.RedisError as e:
             raise errors.DependencyError('failed to delete list from redis server: {}'.format(e))
+
+
+class ReliableRedisQueue(RedisQueue):
+    """RedisQueue which does not lose tasks taken by a consumer that dies before finishing them.
+    Taken tasks are atomically moved to a processing list owned by the consuming thread,
+    and stay there until acknowledged. Every taken task gets a lease, in a sorted set along
+    its processing list, and requeue_expired() pushes tasks whose lease has passed the
+    visibility timeout back to the front of the queue, whether their consumer died or just
+    left them unacknowledged.
+    """
+    # KEYS: queue, processing list, leases, consumers. ARGV: count, lease deadline, items already moved to be leased
+    POP_MANY_SCRIPT = """
+        local items = {}
+        for i = 1, tonumber(ARGV[1]) do
+            local item = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+            if not item then break end
+            items[#items + 1] = item
+            redis.call('ZADD', KEYS[3], ARGV[2], item)
+        end
+        for i = 3, #ARGV do
+            redis.call('ZADD', KEYS[3], ARGV[2], ARGV[i])
+        end
+        if #items > 0 or #ARGV > 2 then
+            redis.call('SADD', KEYS[4], KEYS[2])
+        end
+        return items
+    """
+    # KEYS: processing list, leases. ARGV: raw items
+    ACK_SCRIPT = """
+        for i = 1, #ARGV do
+            redis.call('LREM', KEYS[1], -1, ARGV[i])
+        end
+        if redis.call('LLEN', KEYS[1]) == 0 then
+            redis.call('DEL', KEYS[2])
+            return 0
+        end
+        for i = 1, #ARGV do
+            -- identical tasks taken more than once share a lease, kept while any of them is left
+            if not redis.call('LPOS', KEYS[1], ARGV[i]) then
+                redis.call('ZREM', KEYS[2], ARGV[i])
+            end
+        end
+        return 0
+    """
+    # KEYS: processing list, leases, queue, consumers. ARGV: count, now, lease deadline for unleased tasks
+    REQUEUE_SCRIPT = """
+        local head = redis.call('LINDEX', KEYS[1], 0)
+        if not head then
+            redis.call('DEL', KEYS[2])
+            redis.call('SREM', KEYS[4], KEYS[1])
+            return {0, 0}
+        end
+        -- a task moved by a blocking pop is leased right after; if its consumer died in between, lease it now
+        if not redis.call('ZSCORE', KEYS[2], head) then
+            redis.call('ZADD', KEYS[2], ARGV[3], head)
+        end
+        -- newest first, as each batch is pushed behind the previous ones
+        local items = redis.call('ZREVRANGEBYSCORE', KEYS[2], ARGV[2], '-inf', 'LIMIT', 0, tonumber(ARGV[1]))
+        if #items == 0 then
+            return {0, 0}
+        end
+        local expired = {}
+        for i = 1, #items do
+            expired[items[i]] = true
+            redis.call('ZREM', KEYS[2], items[i])
+        end
+        -- walk the processing list newest first, so that the oldest task ends up first in the queue
+        local taken = redis.call('LRANGE', KEYS[1], 0, -1)
+        local n = 0
+        redis.call('DEL', KEYS[1])
+        for i = 1, #taken do
+            if expired[taken[i]] then
+                redis.call('RPUSH', KEYS[3], taken[i])
+                n = n + 1
+            else
+                redis.call('RPUSH', KEYS[1], taken[i])
+            end
+        end
+        if n == #taken then
+            redis.call('DEL', KEYS[2])
+            redis.call('SREM', KEYS[4], KEYS[1])
+        end
+        return {#items, n}
+    """
+
+    def __init__(self, *args, **kwargs):
+        RedisQueue.__init__(self, *args, **kwargs)
+        self.visibility_timeout = int(settings.REDIS.get('visibility_timeout', 60))
+        self.requeue_batch = int(settings.REDIS.get('requeue_batch', 100))
+        self.consumers_key = '{}:consumers'.format(self.key)
+        self.local = threading.local()
+        self.pop_many_script = RedisQueue.conn.register_script(ReliableRedisQueue.POP_MANY_SCRIPT)
+        self.ack_script = RedisQueue.conn.register_script(ReliableRedisQueue.ACK_SCRIPT)
+        self.requeue_script = RedisQueue.conn.register_script(ReliableRedisQueue.REQUEUE_SCRIPT)
+
+    @property
+    def processing_key(self):
+        """Name of the processing list of the calling thread"""
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            self.local.pid = pid
+            self.local.processing_key = '{}:processing:{}:{}:{}'.format(
+                self.key, socket.gethostname(), pid, threading.current_thread().ident)
+        return self.local.processing_key
+
+    @staticmethod
+    def leases_key(processing_key):
+        """Name of the sorted set of leases of tasks in a processing list, by deadline"""
+        return '{}:leases'.format(processing_key)
+
+    def deserialize(self, task):
+        return LeasedTask(task, json.loads(task))
+
+    def _pop_many(self, count, moved=()):
+        """Move up to count raw items to the processing list, and lease them along with the given
+        items already moved there
+        """
+        if count <= 0 and not moved:
+            return []
+        processing_key = self.processing_key
+        keys = [self.key, processing_key, self.leases_key(processing_key), self.consumers_key]
+        return self.pop_many_script(keys=keys, args=[max(count, 0), time.time() + self.visibility_timeout] + list(moved))
+
+    def get(self):
+        return self.get_many(1)[0]
+
+    def get_many(self, max_items, timeout=None):
+        try:
+            items = self._pop_many(max_items)
+            if not items and timeout != 0:
+                # the processing list is registered first, so that the reaper finds a task moved to it
+                pipe = RedisQueue.conn.pipeline(transaction=False)
+                pipe.sadd(self.consumers_key, self.processing_key)
+                pipe.brpoplpush(self.key, self.processing_key, timeout=int(math.ceil(timeout)) if timeout else 0)
+                item = pipe.execute()[1]
+                if item is None:
+                    return []
+                items = [item] + self._pop_many(max_items - 1, moved=[item])
+        except redis.RedisError as e:
+            raise errors.DependencyError('failed to pop from redis server: {}'.format(e))
+        return self.unindex(items)
+
+    def ack(self, task):
+        self.ack_many([task])
+
+    def ack_many(self, tasks):
+        if not tasks:
+            return
+        processing_key = self.processing_key
+        try:
+            self.ack_script(keys=[processing_key, self.leases_key(processing_key)], args=[task.raw for task in tasks])
+        except redis.RedisError as e:
+            raise errors.DependencyError('failed to acknowledge tasks on redis server: {}'.format(e))
+
+    def requeue_expired(self):
+        total = 0
+        try:
+            for processing_key in RedisQueue.conn.smembers(self.consumers_key):
+                processing_key = processing_key.decode('utf-8')
+                keys = [processing_key, self.leases_key(processing_key), self.key, self.consumers_key]
+                while True:
+                    now = time.time()
+                    found, n = self.requeue_script(keys=keys, args=[self.requeue_batch, now, now + self.visibility_timeout])
+                    total += int(n)
+                    if int(found) < self.requeue_batch:
+                        break
+        except redis.RedisError as e:
+            raise errors.DependencyError('failed to requeue expired tasks on redis server: {}'.format(e))
+        if total:
+            logger.warning('requeued {} tasks with expired processing lease'.format(total))
+        return total
+
+
+class LanedQueue(TaskQueue):
+    """TaskQueue made of a queue per priority (lane), of the given TaskQueue class.
+    Tasks go to the lane of their "priority" field, "normal" by default, which is kept
+    under the key of the laned queue itself; other lanes have the priority appended.
+    Tasks with a send_at time (epoch seconds) in the future are scheduled on their lane instead.
+    Batches are shared among lanes by smooth weighted round robin on PRIORITY['weights'],
+    carrying over calls, so that busy lanes get slots in proportion to their weights
+    whatever the batch sizes. Slots of empty lanes go to the others, highest first.
+    """
+    def __init__(self, *args, **kwargs):
+        q_class = kwargs.pop('queue_class')
+        TaskQueue.__init__(self, *args, **kwargs)
+        self.lanes = [q_class(key=self.lane_key(priority)) for priority in PRIORITIES]
+        self.shared_schedule = self.lanes[0].shared_schedule
+        # messages given up on after RETRY['max_attempts'] sends, kept for inspection. only redis lists
+        # can be read by anything else, so other queues have none, and dead letters are logged instead
+        self.dead_letters = q_class(key='{}:dead'.format(self.key)) if issubclass(q_class, RedisQueue) else None
+        self.weights = [settings.PRIORITY['weights'][priority] for priority in PRIORITIES]
+        self.credits = [0] * len(self.lanes)
+        self.lock = threading.Lock()
+        # plain redis lists can be waited on all at once
+        self.multi_key_pop = q_class is RedisQueue
+
+    def lane_key(self, priority):
+        return self.key if priority == 'normal' else '{}:{}'.format(self.key, priority)
+
+    def lane(self, task):
+        """Lane a task is put in, or was taken from"""
+        index = getattr(task, 'lane', None)
+        if index is None:
+            priority = task.get('priority', 'normal')
+            index = PRIORITIES.index(priority) if priority in PRIORITIES else PRIORITIES.index('normal')
+        return index
+
+    def put(self, task):
+        self.put_many([task])
+
+    def put_many(self, tasks):
+        now = time.time()
+        by_lane = {}
+        scheduled = {}
+        for task in tasks:
+            if task.get('send_at', now) > now:
+                scheduled.setdefault(self.lane(task), []).append(task)
+            else:
+                by_lane.setdefault(self.lane(task), []).append(task)
+        for i, lane_tasks in scheduled.items():
+            self.lanes[i].schedule_many(lane_tasks)
+        sizes = [self.lanes[i].put_many(by_lane[i]) if i in by_lane else self.lanes[i].size() for i in range(len(self.lanes))]
+        return sum(sizes)
+
+    def get(self):
+        return self.get_many(1)[0]
+
+    def shares(self, count):
+        """Split count slots among lanes by smooth weighted round robin"""
+        shares = [0] * len(self.lanes)
+        total = sum(self.weights)
+        with self.lock:
+            for _ in range(count):
+                for i, weight in enumerate(self.weights):
+                    self.credits[i] += weight
+                best = max(range(len(self.lanes)), key=lambda i: self.credits[i])
+                self.credits[best] -= total
+                shares[best] += 1
+        return shares
+
+    def _take(self, index, count, timeout=0):
+        tasks = self.lanes[index].get_many(count, timeout=timeout)
+        for task in tasks:
+            if isinstance(task, LeasedTask):
+                task.lane = index  # to be acknowledged on the lane it came from
+        return tasks
+
+    def _take_many(self, count):
+        """Take up to count tasks from lanes by their shares, without blocking"""
+        tasks = []
+        short = set()
+        for i, share in enumerate(self.shares(count)):
+            if share:
+                taken = self._take(i, share)
+                if len(taken) < share:
+                    short.add(i)
+                tasks.extend(taken)
+        for i in range(len(self.lanes)):
+            if len(tasks) >= count:
+                break
+            if i not in short:
+                tasks.extend(self._take(i, count - len(tasks)))
+        return tasks
+
+    def get_many(self, max_items, timeout=None):
+        tasks = self._take_many(max_items)
+        if tasks or timeout == 0:
+            return tasks
+        if self.multi_key_pop:
+            # BRPOP checks the lists in order, so the first waiting task is taken from the highest lane
+            try:
+                item = RedisQueue.conn.brpop([lane.key for lane in self.lanes],
+                                             timeout=int(math.ceil(timeout)) if timeout else 0)
+            except redis.RedisError as e:
+                raise errors.DependencyError('failed to pop from redis server: {}'.format(e))
+            if item is None:
+                return []
+            index = [lane.key.encode('utf-8') for lane in self.lanes].index(item[0])
+            return self.lanes[index].unindex([item[1]]) + self._take_many(max_items - 1)
+        # lanes of other queues can not be waited on together. wait on the normal lane, where most tasks go,
+        # and check the others in between, less and less often while the queue stays empty
+        normal = PRIORITIES.index('normal')
+        interval = settings.PRIORITY['poll_interval']
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return []
+            tasks = self._take(normal, 1, timeout=interval if remaining is None else min(remaining, interval))
+            tasks += self._take_many(max_items - len(tasks))
+            if tasks:
+                return tasks
+            interval = min(interval * 2, settings.PRIORITY['max_poll_interval'])
+
+    def ack_many(self, tasks):
+        by_lane = {}
+        for task in tasks:
+            by_lane.setdefault(self.lane(task), []).append(task)
+        for i, lane_tasks in by_lane.items():
+            self.lanes[i].ack_many(lane_tasks)
+
+    def ack(self, task):
+        self.ack_many([task])
+
+    def requeue_expired(self):
+        return sum(lane.requeue_expired() for lane in self.lanes)
+
+    def purge_expired(self):
+        return sum(lane.purge_expired() for lane in self.lanes)
+
+    def promote_due(self, max_items):
+        """Promote due tasks of lanes, highest first"""
+        total = 0
+        for lane in self.lanes:
+            if total >= max_items:
+                break
+            total += lane.promote_due(max_items - total)
+        return total
+
+    def size(self):
+        return sum(lane.size() for lane in self.lanes)
+
+    def sizes(self):
+        """Dict of priority to number of tasks in its lane"""
+        return dict(zip(PRIORITIES, [lane.size() for lane in self.lanes]))
+
+    def close(self):
+        for lane in self.lanes:
+            lane.close()
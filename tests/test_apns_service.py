@@ -0,0 +1,42 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import time
+import unittest
+
+import apns_service
+
+
+class PayloadTest(unittest.TestCase):
+    def test_alert(self):
+        payload = apns_service.Payload({'alert': 'hi', 'content-available': True})
+        self.assertEqual((payload.push_type, payload.priority), ('alert', 10))
+
+    def test_silent(self):
+        payload = apns_service.Payload({'content-available': True, 'custom': 1})
+        self.assertEqual((payload.push_type, payload.priority), ('background', 5))
+        self.assertEqual(payload.data, b'{"aps":{"content-available":1},"custom":1}')
+
+
+class APNSHTTP2Test(unittest.TestCase):
+    def setUp(self):
+        # no connections are needed to build headers
+        self.service = apns_service.APNSHTTP2.__new__(apns_service.APNSHTTP2)
+        self.service.topic = 'com.example.app'
+
+    def test_headers_of_silent_notification(self):
+        headers = dict(self.service.headers(apns_service.Payload({'content-available': True}), expiry=1500000000.5))
+        self.assertEqual(headers, {
+            'apns-push-type': 'background',
+            'apns-priority': '5',
+            'apns-expiration': '1500000000',
+            'apns-topic': 'com.example.app',
+        })
+
+    def test_headers_of_alert_without_expiry(self):
+        headers = dict(self.service.headers(apns_service.Payload({'alert': 'hi'})))
+        self.assertEqual((headers['apns-push-type'], headers['apns-priority']), ('alert', '10'))
+        self.assertAlmostEqual(int(headers['apns-expiration']), time.time() + 3600, delta=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import time
+import unittest
+
+import mock
+
+import settings
+import breaker
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(settings.BREAKER, window=30, min_calls=4, failure_rate=0.5, slow_call=5, open_timeout=10, probes=1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = time.time()
+        clock = mock.patch('time.time', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.breaker = breaker.CircuitBreaker('test')
+
+    def trip(self):
+        for ok in (True, False, False, True):
+            self.breaker.record(self.breaker.allow(), ok)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+
+    def test_opens_on_failure_rate(self):
+        for _ in range(3):
+            self.breaker.record(self.breaker.allow(), False)
+        # not before min_calls
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        self.breaker.record(self.breaker.allow(), True)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+        self.assertIsNone(self.breaker.allow())
+        self.assertEqual(self.breaker.reopens_at(), self.now + 10)
+
+    def test_slow_calls_count_as_failures(self):
+        for _ in range(4):
+            self.breaker.record(self.breaker.allow(), True, latency=6)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+
+    def test_old_outcomes_leave_the_window(self):
+        for _ in range(3):
+            self.breaker.record(self.breaker.allow(), False)
+        self.now += 31
+        self.breaker.record(self.breaker.allow(), False)
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+
+    def test_probe_closes(self):
+        self.trip()
+        self.now += 10
+        probe = self.breaker.allow()
+        self.assertTrue(probe)
+        self.assertEqual(self.breaker.state, breaker.HALF_OPEN)
+        # one probe at a time
+        self.assertIsNone(self.breaker.allow())
+        self.breaker.record(probe, True)
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_opens_again(self):
+        self.trip()
+        self.now += 10
+        self.breaker.record(self.breaker.allow(), False)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+        self.assertEqual(self.breaker.reopens_at(), self.now + 10)
+
+    def test_calls_in_flight_when_opened_are_not_probes(self):
+        slow = [self.breaker.allow() for _ in range(3)]
+        self.trip()
+        self.now += 10
+        probe = self.breaker.allow()
+        # timeouts of calls let through while closed come back while half open
+        for permit in slow:
+            self.breaker.record(permit, False, latency=10)
+        self.assertEqual(self.breaker.state, breaker.HALF_OPEN)
+        self.breaker.record(probe, True)
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        # and once closed again, they are not counted either
+        for permit in slow:
+            self.breaker.record(permit, False)
+        self.assertEqual(len(self.breaker.calls), 0)
+
+    def test_lost_probes_expire(self):
+        self.trip()
+        self.now += 10
+        self.assertTrue(self.breaker.allow())
+        self.assertIsNone(self.breaker.allow())
+        self.now += 10
+        self.assertTrue(self.breaker.allow())
+
+
+class BreakerTest(unittest.TestCase):
+    def test_null_breaker_when_disabled(self):
+        with mock.patch.dict(settings.BREAKER, enabled=False), mock.patch.object(breaker, '_breakers_pid', None):
+            null = breaker.breaker('test')
+            self.assertIsInstance(null, breaker.NullBreaker)
+            self.assertTrue(null.allow())
+            self.assertIs(breaker.breaker('test'), null)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import unittest
+
+import mock
+import simplejson as json
+from twisted.internet import defer, task, error
+
+import settings
+import metrics
+import breaker
+import tokens
+import engine
+
+
+class FakeQueue(object):
+    """Queue handing out messages from a list, and recording puts and acks in order"""
+    key = 'fake'
+    dead_letters = None
+
+    def __init__(self, msgs):
+        self.msgs = list(msgs)
+        self.ops = []
+
+    def get_many(self, max_items, timeout=None):
+        msgs, self.msgs = self.msgs[:max_items], self.msgs[max_items:]
+        return msgs
+
+    def put_many(self, tasks):
+        self.ops.append(('put', tasks))
+
+    def ack_many(self, msgs):
+        self.ops.append(('ack', msgs))
+
+    def acked(self):
+        return [msg for op, msgs in self.ops if op == 'ack' for msg in msgs]
+
+
+class FakeNotifier(object):
+    """Notifier whose sends are finished by the test"""
+    def __init__(self):
+        self.sends = []
+
+    def dispatch(self, msgs, dequeued=None):
+        parts = [([i], defer.Deferred()) for i in range(len(msgs))]
+        self.sends.extend((msgs[i], d) for (i,), d in parts)
+        return parts
+
+    def finish(self, n, ok=True):
+        msg, d = self.sends[n]
+        d.callback([ok])
+        return msg
+
+
+class EngineTestCase(unittest.TestCase):
+    """Test case running calls made on thread pools when run_calls is called, on a fake reactor"""
+    def setUp(self):
+        self.calls = []
+        patcher = mock.patch.object(engine.threads, 'deferToThreadPool', self.defer_call)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.clock = task.Clock()
+
+    def defer_call(self, reactor, pool, func, *args, **kwargs):
+        d = defer.Deferred()
+        self.calls.append((d, func, args, kwargs))
+        return d
+
+    def run_calls(self):
+        while self.calls:
+            d, func, args, kwargs = self.calls.pop(0)
+            defer.maybeDeferred(func, *args, **kwargs).chainDeferred(d)
+
+
+class EngineTest(EngineTestCase):
+    def setUp(self):
+        EngineTestCase.setUp(self)
+        patcher = mock.patch.dict(settings.NOTIFIER, max_in_flight=3, batch_size=10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queue = FakeQueue([{'type': 'fcm', 'n': i} for i in range(5)])
+        self.engine = engine.Engine(self.queue, reactor=self.clock)
+        self.engine.notifr = self.notifier = FakeNotifier()
+        self.engine.poll()
+        self.run_calls()
+
+    def test_takes_no_more_than_max_in_flight(self):
+        self.assertEqual(len(self.notifier.sends), 3)
+        self.assertEqual(self.engine.in_flight, 3)
+        self.assertFalse(self.engine.polling)
+        msg = self.notifier.finish(0)
+        self.run_calls()
+        self.assertEqual(self.queue.acked(), [msg])
+        self.assertEqual(len(self.notifier.sends), 4)
+        self.assertEqual(self.engine.in_flight, 3)
+
+    def test_messages_not_done_are_left_for_redelivery(self):
+        self.notifier.finish(0, ok=False)
+        done = self.notifier.finish(1)
+        self.run_calls()
+        self.assertEqual(self.queue.acked(), [done])
+
+    def test_retries_are_queued_before_ack(self):
+        msg, d = self.notifier.sends[0]
+        self.engine.retrier.add('fcm', msg, ['token'], 'unavailable')
+        d.callback([True])
+        self.run_calls()
+        self.assertEqual([op for op, _ in self.queue.ops], ['put', 'ack'])
+        self.assertEqual(self.queue.ops[0][1][0]['tokens'], ['token'])
+
+    def test_stop_waits_for_sends_in_flight(self):
+        stopped = self.engine.stop()
+        self.assertFalse(stopped.called)
+        for i in range(3):
+            self.notifier.finish(i)
+        self.run_calls()
+        self.assertTrue(stopped.called)
+        # no more messages were taken, and the ones sent were acknowledged
+        self.assertEqual(len(self.notifier.sends), 3)
+        self.assertEqual(len(self.queue.acked()), 3)
+
+
+class AsyncNotifierTest(EngineTestCase):
+    def setUp(self):
+        EngineTestCase.setUp(self)
+        patcher = mock.patch.dict(settings.BREAKER, enabled=True, window=30, min_calls=2, failure_rate=0.5, slow_call=5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = breaker.CircuitBreaker('fcm')
+        self.registry = tokens.MemoryTokenRegistry()
+        self.cache = tokens.CanonicalCache(100)
+        for patcher in [
+            mock.patch.object(breaker, 'breaker', lambda provider: self.breaker),
+            mock.patch.object(tokens, 'registry', lambda: self.registry),
+            mock.patch.object(tokens, 'canonical_cache', lambda: self.cache),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.retrier = mock.Mock()
+        self.notifier = engine.AsyncNotifier(None, reactor=self.clock, retrier=self.retrier)
+        self.msg = {'tokens': ['a', 'b', 'c'], 'body': 'hello'}
+
+    def send(self, response, dequeued=None):
+        with mock.patch.object(self.notifier, '_post_fcm', lambda body: response):
+            d = self.notifier.handle_fcm_group([self.msg], dequeued)
+        self.run_calls()
+        results = []
+        d.addCallback(results.append)
+        return results[0]
+
+    def respond(self, results):
+        content = {'success': sum('error' not in result for result in results),
+                   'failure': sum('error' in result for result in results), 'results': results}
+        return defer.succeed((200, json.dumps(content).encode('utf-8')))
+
+    def test_per_token_results(self):
+        done = self.send(self.respond([{'message_id': '1'}, {'error': 'NotRegistered'}, {'error': 'Unavailable'}]))
+        self.assertEqual(done, [True])
+        self.assertEqual(self.registry.sets['fcm'], {'b'})
+        self.retrier.add.assert_called_once_with('fcm', self.msg, ['c'], 'token_error')
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_unavailable_is_retried_and_counted_as_failure(self):
+        self.assertEqual(self.send(defer.succeed((503, b''))), [True])
+        self.retrier.add.assert_called_once_with('fcm', self.msg, ['a', 'b', 'c'], 'unavailable')
+        self.assertEqual(self.breaker.failures, 1)
+
+    def test_lost_connection_is_retried_and_opens_the_breaker(self):
+        for _ in range(2):
+            self.assertEqual(self.send(defer.fail(error.ConnectionLost())), [True])
+        self.assertEqual(self.retrier.add.call_count, 2)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+        # then messages are parked without a call
+        self.assertEqual(self.send(self.respond([{'message_id': '1'}] * 3)), [True])
+        self.retrier.park.assert_called_once_with('fcm', self.msg, ['a', 'b', 'c'], self.breaker.reopens_at())
+
+    def test_dequeue_to_send_of_sent_messages_only(self):
+        def sent():
+            counts = metrics.DEQUEUE_TO_SEND.collect().get(('fcm',))
+            return sum(counts[:-1]) if counts else 0
+        before = sent()
+        self.send(defer.succeed((503, b'')), dequeued=self.clock.seconds())
+        self.assertEqual(sent(), before + 1)
+        self.breaker.transition(breaker.OPEN)
+        self.send(defer.succeed((503, b'')), dequeued=self.clock.seconds())
+        self.assertEqual(sent(), before + 1)
+
+    def test_not_done_without_retrier(self):
+        self.notifier.retrier = None
+        self.assertEqual(self.send(defer.succeed((503, b''))), [False])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import unittest
+
+import mock
+
+import fcm_service
+
+
+class KeepAliveAdapterTest(unittest.TestCase):
+    def test_reset_closes_proxied_connections(self):
+        adapter = fcm_service.KeepAliveAdapter(maxsize=2)
+        adapter.poolmanager.connection_from_url(fcm_service.ENDPOINT)
+        proxy_manager = adapter.proxy_manager_for('http://proxy:3128')
+        proxy_manager.connection_from_url(fcm_service.ENDPOINT)
+        adapter.reset()
+        self.assertEqual(len(adapter.poolmanager.pools), 0)
+        self.assertEqual(len(proxy_manager.pools), 0)
+
+    def test_idle_pool_is_reset_before_sending(self):
+        adapter = fcm_service.KeepAliveAdapter(maxsize=2, idle_timeout=60)
+        adapter.last_used -= 61
+        with mock.patch.object(adapter, 'reset') as reset, \
+                mock.patch('requests.adapters.HTTPAdapter.send') as send:
+            adapter.send(mock.Mock())
+        self.assertTrue(reset.called)
+        self.assertTrue(send.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import unittest
+
+import http2
+import apns_service
+from bench import simulators
+
+
+class TokenBehavior(simulators.Behavior):
+    """Latency of the stream last decided on: resets wait for the other streams to be answered"""
+    latency = 0
+
+    def delay(self):
+        return self.latency
+
+
+class TokenHandler(simulators.APNSHTTP2Handler):
+    """HTTP/2 provider API answering each token as it says: "dead", "down", "reset" or anything else for success"""
+    @staticmethod
+    def decide(behavior, path):
+        token = path.rsplit('/', 1)[-1]
+        behavior.latency = 0.2 if token == 'reset' else 0
+        return {'dead': (410, 'Unregistered'), 'down': (503, 'ServiceUnavailable'), 'reset': (None, None)}.get(token, (200, None))
+
+
+@unittest.skipIf(http2.h2 is None, 'h2 package is not installed')
+class HTTP2TestCase(unittest.TestCase):
+    """Test case with a local plaintext HTTP/2 APNS stand-in"""
+    def setUp(self):
+        self.server = simulators.APNSSimulator(('127.0.0.1', 0), TokenHandler, TokenBehavior())
+        simulators.serve(self.server, 'apns-http2')
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.port = self.server.server_address[1]
+
+
+class ConnectionTest(HTTP2TestCase):
+    def test_concurrent_streams(self):
+        conn = http2.Connection('127.0.0.1', self.port, max_streams=2)
+        self.addCleanup(conn.close)
+        for i, token in enumerate(['a', 'dead', 'b', 'c']):
+            conn.submit('POST', '/3/device/{}'.format(token), [], b'{}', tag=i)
+        responses = list(http2.perform([conn], timeout=5))
+        self.assertEqual(sorted((response.tag, response.status) for response in responses), [(0, 200), (1, 410), (2, 200), (3, 200)])
+        self.assertFalse(conn.busy)
+
+
+class APNSHTTP2Test(HTTP2TestCase):
+    def setUp(self):
+        HTTP2TestCase.setUp(self)
+        self.service = apns_service.APNSHTTP2(cert=None, key=None, host='127.0.0.1', port=self.port, secure=False, pool_size=1, timeout=5)
+        self.payload = apns_service.Payload({'alert': 'hello'})
+
+    def test_all_accepted(self):
+        self.assertEqual(self.service.send(['a', 'b'], self.payload), [{'status': 200}, {'status': 200}])
+
+    def test_per_token_statuses(self):
+        with self.assertRaises(apns_service.ResultError) as raised:
+            self.service.send(['a', 'dead', 'down'], self.payload)
+        self.assertEqual(raised.exception.results, [
+            {'status': 200},
+            {'status': 410, 'reason': 'Unregistered'},
+            {'status': 503, 'reason': 'ServiceUnavailable'},
+        ])
+
+    def test_reset_keeps_results_answered_before(self):
+        with self.assertRaises(apns_service.NotConnectedError) as raised:
+            self.service.send(['a', 'dead', 'reset'], self.payload)
+        self.assertEqual(raised.exception.results, [{'status': 200}, {'status': 410, 'reason': 'Unregistered'}, None])
+        # the next send connects again
+        self.assertEqual(self.service.send(['b'], self.payload), [{'status': 200}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import time
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import settings
+import metrics
+
+
+def make_registry():
+    """Registry with a metric of each kind, standing for the one of a process"""
+    registry = metrics.Registry()
+    metrics.Counter('sends', 'Sends', ('provider',), registry=registry)
+    metrics.Histogram('latency', 'Latency', ('provider',), buckets=(0.1, 1), registry=registry)
+    metrics.Gauge('state', 'State', ('provider',), registry=registry)
+    metrics.Gauge('workers', 'Workers', ('provider',), merge='sum', registry=registry)
+    return registry
+
+
+class SharedRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.now = time.time()
+        clock = mock.patch('time.time', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.parent, self.child = make_registry(), make_registry()
+        self.parent.share(self.directory)
+        self.child.share(self.directory)
+        self.child.path = self.child.path.replace('.json', '-child.json')
+
+    def record(self, registry, latency, state):
+        registry.metrics['sends'].inc(provider='fcm')
+        registry.metrics['latency'].observe(latency, provider='fcm')
+        registry.metrics['state'].set(state, provider='fcm')
+        registry.metrics['workers'].set(2, provider='fcm')
+
+    def test_values_of_other_processes_are_added_up(self):
+        self.record(self.parent, 0.05, 0)
+        self.record(self.child, 0.5, 2)
+        self.child.publish()
+        values = self.parent.collect()
+        self.assertEqual(values['sends'], {('fcm',): 2})
+        self.assertEqual(values['latency'], {('fcm',): [1, 1, 0, 0.55]})
+        self.assertEqual(values['state'], {('fcm',): 2})
+        self.assertEqual(values['workers'], {('fcm',): 4})
+        self.assertIn('sends{provider="fcm"} 2', self.parent.exposition())
+        self.assertEqual(self.parent.as_dict()['latency']['values'][0]['count'], 2)
+        # values of this process are not read back from its own snapshot
+        self.parent.publish()
+        self.assertEqual(self.parent.collect()['sends'], {('fcm',): 2})
+
+    def test_gauges_of_processes_which_stopped_publishing_are_left_out(self):
+        self.record(self.child, 0.5, 2)
+        self.child.publish()
+        self.now += 3 * settings.METRICS['share_interval'] + 1
+        values = self.parent.collect()
+        self.assertEqual(values['sends'], {('fcm',): 1})
+        self.assertEqual(values['state'], {})
+
+    def test_reset_forgets_values(self):
+        self.record(self.parent, 0.05, 0)
+        self.parent.reset()
+        self.assertEqual(self.parent.collect(), {'sends': {}, 'latency': {}, 'state': {}, 'workers': {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import time
+import unittest
+
+import mock
+
+import settings
+import metrics
+import breaker
+import apns_service
+import notifier
+import tokens
+
+
+class NotifierTestCase(unittest.TestCase):
+    """Test case with a notifier connected to mock services, and circuit breakers and a dead token registry of its own"""
+    def setUp(self):
+        patcher = mock.patch.dict(settings.BREAKER, enabled=True, window=30, min_calls=4, failure_rate=0.5, slow_call=5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breakers = {'fcm': breaker.CircuitBreaker('fcm'), 'apns': breaker.CircuitBreaker('apns')}
+        patcher = mock.patch.object(breaker, 'breaker', self.breakers.get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.registry = tokens.MemoryTokenRegistry()
+        patcher = mock.patch.object(tokens, 'registry', lambda: self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.retrier = mock.Mock()
+        self.notifier = notifier.Notifier(providers=(), retrier=self.retrier)
+        self.notifier.fcm_obj = mock.Mock()
+        self.notifier.apns_obj = mock.Mock()
+
+
+class HandleAPNSTest(NotifierTestCase):
+    tokens = ['{:064x}'.format(i) for i in range(4)]
+
+    def send(self, statuses):
+        results = [{'status': status} for status in statuses]
+        self.notifier.apns_obj.notify_multiple.side_effect = apns_service.ResultError('rejected', results=results)
+        return self.notifier.handle_apns(tokens=self.tokens, body='hello')
+
+    def test_unavailable_streams_open_the_breaker(self):
+        for _ in range(4):
+            self.assertTrue(self.send([503, 503, 503, 200]))
+        self.assertEqual(self.breakers['apns'].state, breaker.OPEN)
+        self.assertEqual(self.retrier.add.call_count, 4)
+        self.retrier.add.assert_called_with('apns', mock.ANY, self.tokens[:3], 'token_error')
+        # further messages are parked without a call
+        self.assertTrue(self.send([503] * 4))
+        self.assertEqual(self.notifier.apns_obj.notify_multiple.call_count, 4)
+        self.assertEqual(self.retrier.park.call_count, 1)
+
+    def test_rejected_tokens_do_not_open_the_breaker(self):
+        for _ in range(4):
+            self.assertTrue(self.send([400, 400, 503, 200]))
+        self.assertEqual(self.breakers['apns'].state, breaker.CLOSED)
+
+
+class DequeueToSendTest(NotifierTestCase):
+    def sent(self, provider):
+        counts = metrics.DEQUEUE_TO_SEND.collect().get((provider,))
+        return sum(counts[:-1]) if counts else 0
+
+    def test_only_messages_handed_to_a_service_are_observed(self):
+        self.registry.add('apns', ['{:064x}'.format(0)])
+        self.notifier.fcm_obj.notify_multiple.return_value = [{'message_id': '1'}, {'message_id': '2'}]
+        before = dict((provider, self.sent(provider)) for provider in ('fcm', 'apns'))
+        msgs = [
+            {'type': 'fcm', 'tokens': ['a'], 'body': 'hello'},
+            {'type': 'fcm', 'tokens': ['b'], 'body': 'hello'},
+            {'type': 'fcm', 'tokens': ['c'], 'body': 'expired', 'expires_at': time.time() - 1},
+            {'type': 'fcm', 'tokens': ['d'], 'body': 'x' * 5000},
+            {'type': 'apns', 'tokens': ['{:064x}'.format(0)], 'body': 'dead token'},
+            {'type': 'apns', 'tokens': ['{:064x}'.format(1)], 'body': 'hello'},
+        ]
+        self.assertEqual(self.notifier.notify_many(msgs, dequeued=time.time()), [True] * 6)
+        self.assertEqual(self.sent('fcm') - before['fcm'], 2)
+        self.assertEqual(self.sent('apns') - before['apns'], 1)
+        # parked while the breaker is open
+        self.breakers['apns'].transition(breaker.OPEN)
+        self.notifier.notify_many([{'type': 'apns', 'tokens': ['{:064x}'.format(1)], 'body': 'hello'}], dequeued=time.time())
+        self.assertEqual(self.sent('apns') - before['apns'], 1)
+        self.assertEqual(self.retrier.park.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
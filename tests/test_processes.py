@@ -0,0 +1,64 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+import mock
+
+import settings
+import metrics
+import taskq
+import fcm_service
+import processes
+
+
+class FakeFCM(fcm_service.FCM):
+    """FCM accepting every token, without network calls"""
+    def __init__(self, **kwargs):
+        pass
+
+    def notify_single(self, registration_id, payload):
+        return [{'message_id': '1'}]
+
+
+class NotifierProcessTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for patcher in [
+            mock.patch.dict(settings.PROCESS, notifier_threads=1, monitor_interval=0.1, shutdown_timeout=5),
+            mock.patch.dict(settings.NOTIFIER, engine='thread', poll_timeout=0.1),
+            mock.patch.dict(settings.METRICS, share_interval=0.1),
+            mock.patch.object(metrics.REGISTRY, 'directory', directory),
+            mock.patch.object(metrics.REGISTRY, 'path', None),
+            # forked children get the fake service too
+            mock.patch.object(fcm_service, 'FCM', FakeFCM),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sends(self):
+        return metrics.REGISTRY.collect()['pontiac_sends_total'].get(('fcm', 'success'), 0)
+
+    def test_sends_of_children_are_counted(self):
+        qs = {'fcm': taskq.make_queues('queue', executer='process')['fcm']}
+        qs['fcm'].put({'type': 'fcm', 'tokens': ['token'], 'body': 'hello'})
+        before = self.sends()
+        heartbeat = multiprocessing.Value('d', time.time(), lock=False)
+        proc = processes.spawn_notifier(qs, heartbeat)
+        try:
+            deadline = time.time() + 10
+            while self.sends() == before and time.time() < deadline:
+                time.sleep(0.1)
+            self.assertEqual(self.sends(), before + 1)
+        finally:
+            proc.terminate()
+            proc.join(10)
+        self.assertEqual(self.sends(), before + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
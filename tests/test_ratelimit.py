@@ -0,0 +1,83 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import time
+import unittest
+
+import mock
+
+import settings
+import ratelimit
+from tests.test_taskq import RedisTestCase
+
+
+class ClockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000000.0
+        clock = mock.patch('time.time', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+
+class MemoryTokenBucketTest(ClockTestCase):
+    def setUp(self):
+        ClockTestCase.setUp(self)
+        self.bucket = ratelimit.MemoryTokenBucket('test', rate=5, burst=10)
+
+    def test_burst_then_debt(self):
+        self.assertEqual(self.bucket.reserve(10), 0)
+        # sends queue up behind each other
+        self.assertEqual(self.bucket.reserve(5), 1)
+        self.assertEqual(self.bucket.reserve(5), 2)
+        self.now += 2
+        self.assertEqual(self.bucket.reserve(5), 1)
+
+    def test_refill_stops_at_burst(self):
+        self.bucket.reserve(10)
+        self.now += 60
+        self.assertEqual(self.bucket.reserve(10), 0)
+        self.assertEqual(self.bucket.reserve(1), 0.2)
+
+
+class RedisTokenBucketTest(RedisTestCase, ClockTestCase):
+    def setUp(self):
+        RedisTestCase.setUp(self)
+        ClockTestCase.setUp(self)
+        self.bucket = ratelimit.RedisTokenBucket('test', rate=5, burst=10)
+
+    def test_burst_then_debt(self):
+        self.assertEqual(self.bucket.reserve(10), 0)
+        self.assertEqual(self.bucket.reserve(5), 1)
+        self.now += 0.5
+        self.assertEqual(self.bucket.reserve(5), 1.5)
+        self.assertEqual(float(self.conn.hget(self.bucket.key, 'tokens')), -7.5)
+
+    def test_expires_once_refilled(self):
+        self.bucket.reserve(10)
+        # 2 seconds to refill, and a second more
+        self.assertAlmostEqual(self.conn.pttl(self.bucket.key), 3000, delta=10)
+        self.bucket.reserve(5)
+        self.assertAlmostEqual(self.conn.pttl(self.bucket.key), 4000, delta=10)
+
+    def test_clock_behind_does_not_refill(self):
+        self.bucket.reserve(10)
+        self.now -= 10
+        self.assertEqual(self.bucket.reserve(5), 1)
+        self.assertEqual(float(self.conn.hget(self.bucket.key, 'time')), self.now + 10)
+
+
+class LimiterTest(ClockTestCase):
+    def test_app_limit_on_top_of_provider_limit(self):
+        limits = {'backend': 'memory', 'providers': {'fcm': {'rate': 100, 'burst': 100}}, 'apps': {'slow': {'rate': 1, 'burst': 1}}}
+        with mock.patch.dict(settings.RATE_LIMIT, limits):
+            limiter = ratelimit.Limiter()
+            self.assertEqual(limiter.reserve('fcm', 2, app='slow'), 1)
+            self.assertEqual(limiter.reserve('fcm', 2), 0)
+            self.assertEqual(limiter.reserve('apns', 1000), 0)
+
+    def test_disabled(self):
+        with mock.patch.dict(settings.RATE_LIMIT, backend=None):
+            self.assertEqual(ratelimit.Limiter().reserve('fcm', 1000000), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
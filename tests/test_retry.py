@@ -0,0 +1,83 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import time
+import unittest
+
+import fakeredis
+import mock
+import simplejson as json
+
+import settings
+import errors
+import taskq
+import retry
+
+
+class BackoffTest(unittest.TestCase):
+    def test_backoff_grows_up_to_max_delay_with_jitter(self):
+        with mock.patch.dict(settings.RETRY, base_delay=1, max_delay=10):
+            for attempt, delay in ((1, 1), (2, 2), (3, 4), (4, 8), (5, 10), (20, 10)):
+                for _ in range(20):
+                    self.assertTrue(delay / 2 <= retry.backoff(attempt) <= delay)
+
+
+class RetrierTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = fakeredis.FakeRedis()
+        for patcher in (mock.patch.object(taskq.RedisQueue, 'conn', self.conn),
+                        mock.patch.dict(settings.RETRY, base_delay=10, max_delay=10, max_attempts=3)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.queue = taskq.LanedQueue(key='retry', queue_class=taskq.RedisQueue)
+        self.retrier = retry.Retrier(self.queue)
+
+    def test_failed_tokens_are_scheduled_again(self):
+        msg = {'type': 'fcm', 'tokens': ['a', 'b', 'c'], 'body': 'x', 'priority': 'high'}
+        self.retrier.add('fcm', msg, ['b'], 'unavailable')
+        self.retrier.flush()
+        self.assertEqual(self.queue.size(), 0)
+        scheduled = self.conn.zrange('retry:high:scheduled', 0, -1, withscores=True)
+        self.assertEqual(len(scheduled), 1)
+        task, send_at = scheduled[0]
+        task = json.loads(task)
+        self.assertEqual(task.pop('send_at'), send_at)
+        self.assertEqual(task, {'type': 'fcm', 'tokens': ['b'], 'body': 'x', 'priority': 'high', 'attempt': 2})
+        self.assertTrue(time.time() + 5 <= send_at <= time.time() + 10)
+
+    def test_messages_go_to_dead_letters_after_max_attempts(self):
+        self.retrier.add('fcm', {'tokens': ['a'], 'attempt': 3, 'send_at': 1}, ['a'], 'unavailable')
+        self.retrier.flush()
+        dead = self.queue.dead_letters.get_many(10, timeout=0)
+        self.assertEqual(dead, [{'type': 'fcm', 'tokens': ['a'], 'attempt': 3, 'failure': 'unavailable'}])
+        self.assertEqual(self.conn.zcard('retry:scheduled'), 0)
+
+    def test_dead_letters_are_logged_without_dead_letter_queue(self):
+        queue = taskq.LanedQueue(key='memory', queue_class=taskq.MemoryQueue)
+        self.addCleanup(queue.close)
+        self.assertIsNone(queue.dead_letters)
+        retrier = retry.Retrier(queue)
+        retrier.add('apns', {'tokens': ['a'], 'attempt': 3}, ['a'], 'token_error')
+        with mock.patch.object(retry.logger, 'error') as log_error:
+            retrier.flush()
+        self.assertIn('"failure": "token_error"', log_error.call_args[0][0])
+        self.assertEqual(retrier.pending, [])
+
+    def test_failed_flush_keeps_retries(self):
+        self.retrier.add('fcm', {'tokens': ['a']}, ['a'], 'unavailable')
+        self.retrier.add('fcm', {'tokens': ['b'], 'attempt': 3}, ['b'], 'unavailable')
+        with mock.patch.object(self.queue.dead_letters, 'put_many', side_effect=errors.DependencyError('down')):
+            self.assertRaises(errors.DependencyError, self.retrier.flush)
+        # the retry was queued, the dead letter is kept
+        self.assertEqual([task['tokens'] for task in self.retrier.pending], [['b']])
+        with mock.patch.object(self.queue, 'put_many', side_effect=errors.DependencyError('down')):
+            self.retrier.add('fcm', {'tokens': ['c']}, ['c'], 'unavailable')
+            self.assertRaises(errors.DependencyError, self.retrier.flush)
+        self.assertEqual(sorted(task['tokens'][0] for task in self.retrier.pending), ['b', 'c'])
+        self.retrier.flush()
+        self.assertEqual(self.retrier.pending, [])
+        self.assertEqual(self.conn.zcard('retry:scheduled'), 2)
+        self.assertEqual(self.queue.dead_letters.size(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import time
+import threading
+import unittest
+
+import fakeredis
+import mock
+
+import settings
+import taskq
+
+
+class RedisTestCase(unittest.TestCase):
+    """Test case running against a fresh fake redis server"""
+    def setUp(self):
+        self.conn = fakeredis.FakeRedis()
+        patcher = mock.patch.object(taskq.RedisQueue, 'conn', self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class MemoryQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = taskq.MemoryQueue(key='memory')
+        self.addCleanup(self.queue.close)
+
+    def test_purge_expired(self):
+        now = time.time()
+        self.queue.put_many([{'n': 0, 'expires_at': now - 1}, {'n': 1}, {'n': 2, 'expires_at': now + 60}, {'n': 3, 'expires_at': now - 2}])
+        self.assertEqual(self.queue.purge_expired(), 2)
+        self.assertEqual([task['n'] for task in self.queue.get_many(10, timeout=0)], [1, 2])
+
+    def test_expiry_index_drops_taken_tasks(self):
+        heap = taskq.MemoryQueue.expiry_heaps[self.queue.key]
+        for _ in range(10):
+            self.queue.put_many([{'expires_at': time.time() + 3600} for _ in range(1000)])
+            self.queue.get_many(1000, timeout=0)
+        self.assertLessEqual(len(heap), 1000)
+        self.queue.put({'expires_at': time.time() - 1})
+        self.assertEqual(self.queue.purge_expired(), 1)
+        self.assertEqual(self.queue.size(), 0)
+
+
+class RedisQueueTest(RedisTestCase):
+    def setUp(self):
+        RedisTestCase.setUp(self)
+        self.queue = taskq.RedisQueue(key='redis')
+
+    def test_put_get_many(self):
+        self.assertEqual(self.queue.put_many([{'n': i} for i in range(5)]), 5)
+        self.assertEqual([task['n'] for task in self.queue.get_many(3, timeout=0)], [0, 1, 2])
+        self.assertEqual(self.queue.size(), 2)
+
+    def test_purge_expired(self):
+        now = time.time()
+        self.queue.put_many([{'n': 0, 'expires_at': now - 1}, {'n': 1}, {'n': 2, 'expires_at': now + 60}])
+        self.assertEqual(self.queue.purge_expired(), 1)
+        self.assertEqual([task['n'] for task in self.queue.get_many(10, timeout=0)], [1, 2])
+        self.assertEqual(self.conn.zcard(self.queue.expiry_key), 0)
+
+    def test_purge_drops_index_entries_of_missing_tasks(self):
+        with mock.patch.dict(settings.REDIS, max_size=2):
+            taskq.RedisQueue(key=self.queue.key).put_many([{'n': i, 'expires_at': time.time() - 1} for i in range(5)])
+        # the oldest three were trimmed off the list
+        self.assertEqual(self.queue.purge_expired(), 2)
+        self.assertEqual(self.conn.zcard(self.queue.expiry_key), 0)
+
+    def test_purge_searches_a_bounded_number_of_entries(self):
+        self.queue.put_many([{'n': i} for i in range(100)])
+        self.queue.put_many([{'n': i, 'expires_at': time.time() - 1} for i in range(100, 110)])
+        with mock.patch.dict(settings.REDIS, purge_scan=50):
+            # newest tasks are searched from the oldest end: out of reach of a whole call, left to be dropped when taken
+            self.assertEqual(self.queue.purge_expired(), 0)
+        self.assertEqual(self.conn.zcard(self.queue.expiry_key), 0)
+        self.assertEqual(self.queue.size(), 110)
+        self.queue.put_many([{'n': i, 'expires_at': time.time() - 1} for i in range(110, 120)])
+        self.queue.get_many(100, timeout=0)
+        with mock.patch.dict(settings.REDIS, purge_scan=50, purge_batch=3):
+            # each removal searches 11 entries, twice
+            self.assertEqual(self.queue.purge_expired(), 2)
+            self.assertEqual(sum(self.queue.purge_expired() for _ in range(4)), 8)
+
+
+class ReliableRedisQueueTest(RedisTestCase):
+    def setUp(self):
+        RedisTestCase.setUp(self)
+        patcher = mock.patch.dict(settings.REDIS, visibility_timeout=60, requeue_batch=2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queue = taskq.ReliableRedisQueue(key='test')
+        self.now = time.time()
+        clock = mock.patch('time.time', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def leases(self):
+        return self.conn.zrange(self.queue.leases_key(self.queue.processing_key), 0, -1, withscores=True)
+
+    def test_get_many_moves_tasks_to_processing_list(self):
+        self.queue.put_many([{'n': i} for i in range(3)])
+        tasks = self.queue.get_many(2, timeout=0)
+        self.assertEqual([task['n'] for task in tasks], [0, 1])
+        self.assertEqual(self.queue.size(), 1)
+        self.assertEqual(self.conn.llen(self.queue.processing_key), 2)
+        self.assertEqual(len(self.leases()), 2)
+
+    def test_ack_removes_tasks_and_their_leases(self):
+        self.queue.put_many([{'n': i} for i in range(3)])
+        tasks = self.queue.get_many(3, timeout=0)
+        self.queue.ack_many(tasks[:2])
+        self.assertEqual(self.conn.lrange(self.queue.processing_key, 0, -1), [tasks[2].raw])
+        self.assertEqual([item for item, _ in self.leases()], [tasks[2].raw])
+        self.queue.ack(tasks[2])
+        self.assertFalse(self.conn.exists(self.queue.processing_key, self.queue.leases_key(self.queue.processing_key)))
+
+    def test_tasks_of_busy_consumer_are_not_requeued(self):
+        # a consumer which keeps taking and acknowledging tasks holds every task for the visibility timeout
+        self.queue.put_many([{'n': i} for i in range(20)])
+        for _ in range(10):
+            tasks = self.queue.get_many(2, timeout=0)
+            self.now += 40
+            self.assertEqual(self.queue.requeue_expired(), 0)
+            self.queue.ack(tasks[0])
+            self.now += 40
+            self.assertEqual(self.queue.requeue_expired(), 1)
+
+    def test_expired_tasks_are_requeued_in_order(self):
+        self.queue.put_many([{'n': i} for i in range(5)])
+        for _ in range(5):
+            self.queue.get_many(1, timeout=0)
+            self.now += 1
+        self.now += 54
+        self.assertEqual(self.queue.requeue_expired(), 0)
+        self.now += 10
+        self.assertEqual(self.queue.requeue_expired(), 5)
+        self.assertEqual([task['n'] for task in self.queue.get_many(10, timeout=0)], [0, 1, 2, 3, 4])
+        self.assertEqual(self.conn.smembers(self.queue.consumers_key), {self.queue.processing_key.encode('utf-8')})
+
+    def test_identical_tasks_share_a_lease(self):
+        self.queue.put_many([{'n': 1}, {'n': 1}])
+        tasks = self.queue.get_many(2, timeout=0)
+        self.queue.ack(tasks[0])
+        self.assertEqual(len(self.leases()), 1)
+        self.now += 61
+        self.assertEqual(self.queue.requeue_expired(), 1)
+        self.assertEqual(self.queue.size(), 1)
+
+    def test_task_moved_by_blocking_pop_is_leased(self):
+        self.queue.put_many([{'n': 1}, {'n': 2}])
+        pop_many = self.queue._pop_many
+        # the queue looks empty on the first try, so the first task is taken by the blocking pop
+        with mock.patch.object(self.queue, '_pop_many', side_effect=lambda count, moved=(): pop_many(count, moved) if moved else []):
+            tasks = self.queue.get_many(2, timeout=1)
+        self.assertEqual([task['n'] for task in tasks], [1, 2])
+        self.assertEqual(len(self.leases()), 2)
+
+    def test_unleased_task_of_dead_consumer_is_requeued(self):
+        self.queue.put({'n': 1})
+        # consumer died between its blocking pop and leasing the task
+        self.conn.sadd(self.queue.consumers_key, self.queue.processing_key)
+        self.conn.rpoplpush(self.queue.key, self.queue.processing_key)
+        self.assertEqual(self.queue.requeue_expired(), 0)
+        self.assertEqual(len(self.leases()), 1)
+        self.now += 61
+        self.assertEqual(self.queue.requeue_expired(), 1)
+        self.assertEqual(self.queue.size(), 1)
+
+    def test_requeue_drops_empty_processing_lists(self):
+        self.queue.put({'n': 1})
+        self.queue.ack(self.queue.get_many(1, timeout=0)[0])
+        self.queue.requeue_expired()
+        self.assertEqual(self.conn.smembers(self.queue.consumers_key), set())
+
+
+class LanedQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = taskq.LanedQueue(key='laned', queue_class=taskq.MemoryQueue)
+        self.addCleanup(self.queue.close)
+
+    def test_batches_are_shared_by_weight(self):
+        self.queue.put_many([{'priority': priority} for priority in taskq.PRIORITIES for _ in range(100)])
+        tasks = self.queue.get_many(13, timeout=0)
+        counts = dict((priority, sum(task['priority'] == priority for task in tasks)) for priority in taskq.PRIORITIES)
+        self.assertEqual(counts, {'high': 8, 'normal': 4, 'low': 1})
+
+    def test_slots_of_empty_lanes_go_to_others(self):
+        self.queue.put_many([{'priority': 'low'} for _ in range(10)])
+        self.assertEqual(len(self.queue.get_many(5, timeout=0)), 5)
+
+    def test_idle_wait_backs_off(self):
+        with mock.patch.object(self.queue, '_take_many', wraps=self.queue._take_many) as take_many:
+            self.assertEqual(self.queue.get_many(10, timeout=1), [])
+        # one check of all lanes before waiting, and one per wait on the normal lane: 0.05, 0.1, 0.2, 0.4, 0.25
+        self.assertLessEqual(take_many.call_count, 7)
+
+    def test_wait_returns_tasks_of_any_lane(self):
+        for priority in ('normal', 'high'):
+            timer = threading.Timer(0.1, self.queue.put, [{'priority': priority}])
+            timer.start()
+            start = time.time()
+            tasks = self.queue.get_many(10, timeout=5)
+            self.assertEqual([task['priority'] for task in tasks], [priority])
+            self.assertLess(time.time() - start, 1)
+            timer.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import time
+import unittest
+
+import mock
+
+import settings
+import threaded
+
+
+class NotifierScalerTest(unittest.TestCase):
+    def setUp(self):
+        for patcher in [
+            mock.patch.dict(settings.THREAD_COUNT, FCM=8),
+            mock.patch.dict(settings.AUTOSCALE, min_notifiers=2, drain_target=5, initial_latency=0.1, cooldown=30),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.now = time.time()
+        clock = mock.patch('time.time', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.pool = mock.Mock()
+        self.queue = mock.Mock()
+        self.scaler = threaded.NotifierScaler(self.pool, self.queue, 'fcm')
+
+    def check(self, backlog):
+        self.queue.size.return_value = backlog
+        self.scaler.check()
+        return len(self.scaler.workers)
+
+    def test_scales_up_on_backlog(self):
+        self.assertEqual(self.check(0), 2)
+        # 200 messages at 0.1 seconds each take 4 notifiers to send in 5 seconds
+        self.assertEqual(self.check(200), 4)
+        self.assertEqual(self.check(10000), 8)
+        self.assertEqual(self.pool.add_task.call_count, 8)
+
+    def test_retires_workers_one_at_a_time_after_cool_down(self):
+        self.check(10000)
+        workers = list(self.scaler.workers)
+        self.now += 10
+        self.assertEqual(self.check(0), 8)
+        self.now += 20
+        self.assertEqual(self.check(0), 7)
+        # the newest worker is told to stop
+        self.assertTrue(workers[-1].is_set())
+        self.assertFalse(any(worker.is_set() for worker in workers[:-1]))
+        self.assertEqual(self.check(0), 7)
+        for _ in range(10):
+            self.now += 30
+            self.check(0)
+        self.assertEqual(len(self.scaler.workers), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import unittest
+
+import fakeredis
+import mock
+import redis
+
+import settings
+import taskq
+import tokens
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = tokens.BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('token-{}'.format(i))
+        self.assertTrue(all('token-{}'.format(i) in bloom for i in range(1000)))
+        false_positives = sum('other-{}'.format(i) in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class RedisTokenRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = fakeredis.FakeRedis()
+        for patcher in (mock.patch.object(taskq.RedisQueue, 'conn', self.conn),
+                        mock.patch.dict(settings.TOKENS, bloom_capacity=1000, sync_interval=60)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_live_skips_dead_tokens_of_other_processes(self):
+        registry = tokens.RedisTokenRegistry()
+        other = tokens.RedisTokenRegistry()
+        other.add('fcm', ['a', 'b'])
+        registry.sync()
+        self.assertEqual(registry.live('fcm', ['a', 'b', 'c']), ['c'])
+        self.assertEqual(registry.live('apns', ['a']), ['a'])
+
+    def test_sync_loads_only_additions(self):
+        self.conn.sadd('dead_tokens:fcm', 'old')
+        registry = tokens.RedisTokenRegistry()
+        self.assertIn('old', registry.filter('fcm'))
+        tokens.RedisTokenRegistry().add('fcm', ['new'])
+        with mock.patch.object(self.conn, 'sscan_iter') as sscan_iter:
+            registry.sync()
+            registry.sync()
+        self.assertFalse(sscan_iter.called)
+        self.assertIn('new', registry.filter('fcm'))
+
+    def test_sync_loads_everything_after_changelog_was_trimmed(self):
+        registry = tokens.RedisTokenRegistry()
+        other = tokens.RedisTokenRegistry()
+        for i in range(5):
+            other.add('fcm', ['t{}'.format(i)])
+        self.conn.xtrim('dead_tokens:fcm:log', maxlen=2)
+        registry.sync()
+        self.assertEqual(registry.live('fcm', ['t{}'.format(i) for i in range(5)]), [])
+        # and incrementally again after that
+        other.add('fcm', ['t5'])
+        with mock.patch.object(self.conn, 'sscan_iter') as sscan_iter:
+            registry.sync()
+        self.assertFalse(sscan_iter.called)
+        self.assertIn('t5', registry.filter('fcm'))
+
+    def test_redis_outage_does_not_fail_lookups(self):
+        with mock.patch.object(self.conn, 'xread', side_effect=redis.ConnectionError('down')), \
+                mock.patch.object(self.conn, 'xrevrange', side_effect=redis.ConnectionError('down')):
+            registry = tokens.RedisTokenRegistry()
+            self.assertEqual(registry.live('fcm', ['a']), ['a'])
+        self.conn.sadd('dead_tokens:fcm', 'a')
+        registry.synced = 0
+        self.assertEqual(registry.live('fcm', ['a', 'b']), ['b'])
+
+
+class CanonicalCacheTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(settings.TOKENS, bloom_capacity=1000, sync_interval=60)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def scan_all(self, cache, count):
+        cursor, found = 0, {}
+        while True:
+            cursor, mappings = cache.scan(cursor, count)
+            self.assertFalse(set(found).intersection(mappings))
+            found.update(mappings)
+            # lookups reorder the LRU cache between pages
+            cache.lookup(list(found))
+            if not cursor:
+                return found
+
+    def test_scan_pages_through_every_mapping_once(self):
+        cache = tokens.CanonicalCache(max_size=100)
+        cache.add(dict(('t{}'.format(i), 'c{}'.format(i)) for i in range(50)))
+        cache.add({'t3': 'c3b'})
+        found = self.scan_all(cache, 7)
+        self.assertEqual(len(found), 50)
+        self.assertEqual(found['t3'], 'c3b')
+
+    def test_scan_leaves_out_evicted_mappings(self):
+        cache = tokens.CanonicalCache(max_size=10)
+        for i in range(3000):
+            cache.add({'t{}'.format(i): 'c{}'.format(i)})
+        self.assertLess(len(cache.added), 1100)
+        self.assertEqual(sorted(self.scan_all(cache, 3)), sorted('t{}'.format(i) for i in range(2990, 3000)))
+
+    def test_rewrite(self):
+        cache = tokens.CanonicalCache(max_size=10)
+        cache.add({'a': 'c', 'b': 'c'})
+        self.assertEqual(cache.rewrite(['a', 'x', 'b', 'c']), ['c', 'x'])
+
+    def test_redis_sync_loads_only_additions(self):
+        conn = fakeredis.FakeRedis()
+        cache = tokens.CanonicalCache(max_size=10, conn=conn)
+        tokens.CanonicalCache(max_size=10, conn=conn).add({'a': 'c'})
+        with mock.patch.object(conn, 'hscan_iter') as hscan_iter:
+            cache.sync()
+        self.assertFalse(hscan_iter.called)
+        self.assertEqual(cache.lookup(['a', 'b']), {'a': 'c'})
+
+
+if __name__ == '__main__':
+    unittest.main()
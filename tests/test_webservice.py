@@ -0,0 +1,106 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import io
+import unittest
+
+import mock
+import simplejson as json
+from twisted.internet import defer
+from twisted.web import server
+from twisted.web.test.requesthelper import DummyRequest
+
+import settings
+import metrics
+import taskq
+import tokens
+import webservice
+
+
+class WebServiceTestCase(unittest.TestCase):
+    """Test case running blocking calls of resources once rendering returns, rather than on a thread pool"""
+    def setUp(self):
+        self.calls = []
+        patcher = mock.patch.object(webservice, 'defer_to_threadpool', self.defer_call)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def defer_call(self, pool, func, *args, **kwargs):
+        d = defer.Deferred()
+        self.calls.append((d, func, args, kwargs))
+        return d
+
+    def run_calls(self):
+        while self.calls:
+            d, func, args, kwargs = self.calls.pop(0)
+            defer.maybeDeferred(func, *args, **kwargs).chainDeferred(d)
+
+    def render(self, resource, request):
+        """Render a request, returning the response body"""
+        result = resource.render(request)
+        self.run_calls()
+        if result == server.NOT_DONE_YET:
+            self.assertTrue(request.finished)
+            return b''.join(request.written)
+        return result
+
+
+class GetCanonicalTest(WebServiceTestCase):
+    def setUp(self):
+        WebServiceTestCase.setUp(self)
+        self.cache = tokens.CanonicalCache(100)
+        patcher = mock.patch.object(tokens, 'canonical_cache', lambda: self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_mappings_of_local_notifiers(self):
+        self.cache.add({'old': 'new'})
+        body = self.render(webservice.GetCanonical(threadpool=None), DummyRequest([b'']))
+        self.assertEqual(json.loads(body)['mappings'], {'old': 'new'})
+
+    def test_refused_without_notifiers_or_shared_registry(self):
+        self.cache.add({'old': 'new'})
+        request = DummyRequest([b''])
+        with mock.patch.dict(settings.TOKENS, registry='memory'):
+            self.render(webservice.GetCanonical(threadpool=None, local_notifiers=False), request)
+        self.assertEqual(request.responseCode, 501)
+
+
+class AddNotifTest(WebServiceTestCase):
+    def setUp(self):
+        WebServiceTestCase.setUp(self)
+        self.qs = dict((provider, taskq.MemoryQueue(key='webservice:{}'.format(provider))) for provider in taskq.PROVIDERS)
+        for q in self.qs.values():
+            self.addCleanup(q.close)
+        for patcher in [
+            mock.patch.dict(settings.WEBSERVICE, queue_high_water=10, retry_after=7),
+            mock.patch.object(metrics.QUEUE_DEPTH, 'values', {}),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.resource = webservice.AddNotif(queues=self.qs, threadpool=None)
+
+    def post(self, msgs):
+        request = DummyRequest([b''])
+        request.method = b'POST'
+        request.content = io.BytesIO(json.dumps(msgs).encode('utf-8'))
+        body = self.render(self.resource, request)
+        return request, body
+
+    def test_accepted(self):
+        request, body = self.post([{'type': 'fcm', 'tokens': ['a'], 'body': 'hello'}])
+        self.assertEqual(request.responseCode, 202)
+        self.assertEqual(self.qs['fcm'].size(), 1)
+
+    def test_refused_over_high_water_mark(self):
+        metrics.QUEUE_DEPTH.set(11, queue=self.qs['apns'].key)
+        request, body = self.post([{'type': 'apns', 'tokens': ['a' * 64], 'body': 'hello'}])
+        self.assertEqual(request.responseCode, 429)
+        self.assertEqual(request.responseHeaders.getRawHeaders(b'retry-after'), [b'7'])
+        self.assertEqual(self.qs['apns'].size(), 0)
+        # messages of other services are still accepted
+        request, body = self.post([{'type': 'fcm', 'tokens': ['a'], 'body': 'hello'}])
+        self.assertEqual(request.responseCode, 202)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,8 @@ from __future__ import unicode_literals, print_function, division, absolute_impo
 from pprint import pprint
 import threading
 import string
+import time
+import math
 import logging
 import multiprocessing
 from six.moves import queue
@@ -11,8 +13,12 @@ import six
 import errors
 import settings
 import taskq
+import metrics
 import webservice
+import processes
 import notifier
+import engine
+import retry
 
 
 logger = logging.getLogger(__name__)
@@ -22,6 +28,7 @@ class Worker(threading.Thread):
     """ Thread executing tasks from a given tasks queue """
     def __init__(self, tasks, *args, **kwargs):
         daemon = kwargs.pop('daemon', False)
+        self.pool = kwargs.pop('pool', None)
         threading.Thread.__init__(self, *args, **kwargs)
         self.daemon = daemon
         self.tasks = tasks
@@ -29,11 +36,15 @@ class Worker(threading.Thread):
         self.start()
 
     def run(self):
+        idle_timeout = self.pool.idle_timeout if self.pool is not None else 10
         while not self.stop_flag.is_set():
             try:
-                task = self.tasks.get(block=True, timeout=10)
+                task = self.tasks.get(block=True, timeout=idle_timeout)
             except queue.Empty:
-                pass
+                if self.pool is not None and self.pool.retire(self):
+                    logger.debug('idle thread retired')
+                    return
+                continue
 
             func, args, kwargs = task['func'], task['args'], task['kwargs']
             options = task.get('options', {})
@@ -48,28 +59,70 @@ class Worker(threading.Thread):
             finally:
                 # Mark this task as done, whether an exception happened or not
                 self.tasks.task_done()
+                if self.pool is not None:
+                    self.pool.set_idle()
         logger.debug('thread was flagged to stop')
 
 
 class ThreadPool(object):
-    """ Pool of threads consuming tasks from a queue """
-    def __init__(self, max_threads):
+    """ Pool of threads consuming tasks from a queue
+
+    Threads are started as tasks are added, up to max_threads, and the ones left without
+    a task for idle_timeout seconds exit, down to min_threads.
+    """
+    def __init__(self, max_threads, min_threads=0, idle_timeout=10, name='worker'):
         self.max_threads = max_threads
-        self.tasks = queue.Queue(maxsize=max_threads)
+        self.min_threads = min(min_threads, max_threads)
+        self.idle_timeout = idle_timeout
+        self.name = name
+        self.tasks = queue.Queue()
         self.pool = []
-        for i in range(min(self.tasks.qsize(), max_threads)):
-            worker = Worker(self.tasks, name='worker{}'.format(i+1))
-            self.pool.append(worker)
+        self.idle = 0  # number of workers waiting for a task, which are not claimed by a queued task
+        self.lock = threading.Lock()
+        self.counter = 0
+        with self.lock:
+            for i in range(self.min_threads):
+                self._add_worker(daemon=True)
+
+    def _add_worker(self, daemon):
+        # called with lock held
+        self.counter += 1
+        worker = Worker(self.tasks, daemon=daemon, pool=self, name='{}{}'.format(self.name, self.counter))
+        self.pool.append(worker)
+        self.idle += 1
+        metrics.POOL_THREADS.set(len(self.pool), pool=self.name)
+        return worker
+
+    def retire(self, worker):
+        """Remove an idle worker from the pool, unless the pool is at its min size. Returns whether it was removed."""
+        with self.lock:
+            if len(self.pool) <= self.min_threads or worker not in self.pool or not self.tasks.empty():
+                return False
+            self.pool.remove(worker)
+            self.idle -= 1
+            metrics.POOL_THREADS.set(len(self.pool), pool=self.name)
+            return True
+
+    def set_idle(self):
+        with self.lock:
+            self.idle += 1
+
+    @property
+    def size(self):
+        return len(self.pool)
 
     def add_task(self, func_signature, **options):
         """ Add a task to the queue """
         func, args, kwargs = func_signature['func'], func_signature['args'], func_signature['kwargs']
         # worker threads should be daemonic, so that they exit when the main program exits, and there be no need for joining.
         daemon = options.pop('daemon', True)
-        self.tasks.put({'func': func, 'args': args, 'kwargs': kwargs, 'options': options})
-        if self.tasks.qsize() > 0 and len(self.pool) < self.max_threads:
-            worker = Worker(self.tasks, daemon=daemon, name='worker{}'.format(len(self.pool)+1))
-            self.pool.append(worker)
+        with self.lock:
+            self.tasks.put({'func': func, 'args': args, 'kwargs': kwargs, 'options': options})
+            if self.idle == 0 and len(self.pool) < self.max_threads:
+                self._add_worker(daemon=daemon)
+            if self.idle > 0:
+                # an idle worker is going to take this task
+                self.idle -= 1
 
     def map(self, func, args_list):
         """ Add a list of tasks to the queue """
@@ -77,8 +130,11 @@ class ThreadPool(object):
             self.add_task(func, args)
 
     def stop(self):
-        for trd in self.pool:
+        with self.lock:
+            pool = list(self.pool)
+        for trd in pool:
             trd.stop_flag.set()
+        for trd in pool:
             trd.join()
 
     def wait_completion(self):
@@ -86,6 +142,89 @@ class ThreadPool(object):
         self.tasks.join()
 
 
+class NotifierScaler(object):
+    """Keep enough notifier workers running on a thread pool to clear the queue backlog
+    within AUTOSCALE['drain_target'] seconds, at the send latency observed lately.
+    Workers are added as soon as the backlog grows, and retired one at a time, at most
+    once per AUTOSCALE['cooldown'] seconds, while fewer are needed.
+    A scaler looks after the queue and the workers of a single notification service.
+    """
+    def __init__(self, pool, queue, provider, stop_flag=None):
+        self.pool = pool
+        self.queue = queue
+        self.provider = provider
+        self.stop_flag = stop_flag or threading.Event()
+        self.max_workers = settings.THREAD_COUNT[provider.upper()]
+        self.min_workers = min(settings.AUTOSCALE['min_notifiers'], self.max_workers)
+        self.workers = []  # stop flags of running notifier workers, oldest first
+        self.counter = 0
+        self.latency = settings.AUTOSCALE['initial_latency']
+        self.latency_totals = self.send_totals()
+        self.scaled_down = time.time()
+
+    def send_totals(self):
+        """Sum and count of all send latencies of the service observed so far"""
+        total, count = 0.0, 0
+        for key, counts in metrics.SEND_LATENCY.collect().items():
+            if key[0] != self.provider:
+                continue
+            total += counts[-1]
+            count += sum(counts[:-1])
+        return total, count
+
+    def observe_latency(self):
+        """Mean send latency since last call, or the last known one if nothing was sent meanwhile"""
+        total, count = self.send_totals()
+        last_total, last_count = self.latency_totals
+        if count > last_count:
+            self.latency = (total - last_total) / (count - last_count)
+        self.latency_totals = (total, count)
+        return self.latency
+
+    def target(self, backlog, latency):
+        needed = int(math.ceil(backlog * latency / settings.AUTOSCALE['drain_target']))
+        return max(self.min_workers, min(self.max_workers, needed))
+
+    def start_worker(self):
+        self.counter += 1
+        stop_flag = threading.Event()
+        self.workers.append(stop_flag)
+        kwargs = {'queue': self.queue, 'provider': self.provider, 'stop_flag': stop_flag}
+        self.pool.add_task({'func': notifier_func, 'args': (), 'kwargs': kwargs}, name='{}-notifier{}'.format(self.provider, self.counter), daemon=True)
+
+    def retire_worker(self):
+        # the worker finishes its current messages, then its pool thread idles out
+        self.workers.pop().set()
+
+    def check(self):
+        target = self.target(self.queue.size(), self.observe_latency())
+        current = len(self.workers)
+        if target > current:
+            logger.info('scaling {} notifier workers up from {} to {}'.format(self.provider, current, target))
+            for i in range(target - current):
+                self.start_worker()
+        elif target < current and time.time() - self.scaled_down >= settings.AUTOSCALE['cooldown']:
+            logger.info('scaling {} notifier workers down from {} to {}'.format(self.provider, current, current - 1))
+            self.retire_worker()
+            self.scaled_down = time.time()
+        if target >= current:
+            # cool-down counts from the last time the workers were all needed
+            self.scaled_down = time.time()
+        metrics.NOTIFIERS.set(len(self.workers), provider=self.provider)
+
+    def run(self, *args, **kwargs):
+        logger.info('{} notifier autoscaler started'.format(self.provider))
+        while True:
+            try:
+                self.check()
+            except errors.DependencyError as e:
+                logger.error('failed to check {} queue backlog: {}'.format(self.provider, e))
+            if self.stop_flag.wait(settings.AUTOSCALE['interval']):
+                break
+        for stop_flag in self.workers:
+            stop_flag.set()
+
+
 class WebServiceThread(threading.Thread):
     def __init__(self, *args, **kwargs):
         self.qs = kwargs.pop('qs')
@@ -105,7 +244,7 @@ class WebServiceThread(threading.Thread):
 def webservice_func(*args, **kwargs):
     logger.info('webservice thread started')
     try:
-        srv = webservice.Service(qs=kwargs.pop('qs'))
+        srv = webservice.Service(qs=kwargs.pop('qs'), local_notifiers=kwargs.pop('local_notifiers', True))
         srv.run(*args, **kwargs)
     except errors.PontiacError as e:
         print('Pontiac Error. type: "{}", {}'.format(type(e), e))
@@ -118,57 +257,159 @@ class NotifierThread(threading.Thread):
         threading.Thread.__init__(self, *args, **kwargs)
 
     def run(self, *args, **kwargs):
-        logger.info('notifier thread started')
-        try:
-            notifr = notifier.Notifier()
-            while True:
-                msg = self.queue.get()
-                logger.debug('received a new message on notification queue: "{}"'.format(msg))
-                try:
-                    notifr.notify(msg=msg)
-                except errors.DataValidationError as e:
-                    print('Data Validation Error: {}'.format(e))
-        except errors.PontiacError as e:
-            print('Pontiac Error. type: "{}", {}'.format(type(e), e))
-        logger.info('notifier thread finished')
+        notifier_func(queue=self.queue)
 
 
 def notifier_func(*args, **kwargs):
+    """Take messages off the queue and send them, until stop_flag (if given) is set.
+    If the queue is of a single notification service (provider), only that one is connected to.
+    A ready event is set once connections are set up, and heartbeat (a multiprocessing.Value)
+    is updated on every round, if they are given.
+    Tokens which failed for a transient reason are queued again to be retried later.
+    """
     logger.info('notifier thread started')
+    stop_flag = kwargs.get('stop_flag') or threading.Event()
+    heartbeat = kwargs.get('heartbeat')
+    retrier = retry.Retrier(kwargs['queue'])
     try:
-        notifr = notifier.Notifier()
-        while True:
-            msg = kwargs['queue'].get()
-            logger.debug('received a new message on notification queue: "{}"'.format(msg))
+        providers = [kwargs['provider']] if kwargs.get('provider') else taskq.PROVIDERS
+        notifr = notifier.Notifier(providers=providers, retrier=retrier)
+        if kwargs.get('ready'):
+            kwargs['ready'].set()
+        while not stop_flag.is_set():
+            if heartbeat is not None:
+                heartbeat.value = time.time()
+            msgs = kwargs['queue'].get_many(settings.NOTIFIER['batch_size'], timeout=settings.NOTIFIER['poll_timeout'])
+            if not msgs:
+                if retrier.pending:
+                    # retries which failed to be queued before
+                    try:
+                        retrier.flush()
+                    except errors.DependencyError as e:
+                        logger.error('failed to queue retries of messages: {}'.format(e))
+                continue
+            dequeued = time.time()
+            if settings.FCM['batch_linger'] and any(msg.get('type') == 'fcm' for msg in msgs):
+                fill_batch(kwargs['queue'], msgs, settings.NOTIFIER['batch_size'], settings.FCM['batch_linger'])
+            logger.debug('received {} new messages on notification queue'.format(len(msgs)))
+            done = notifr.notify_many(msgs, dequeued=dequeued)
             try:
-                notifr.notify(msg=msg)
-            except errors.DataValidationError as e:
-                print('Data Validation Error: {}'.format(e))
+                retrier.flush()
+            except errors.DependencyError as e:
+                # the messages are left unacknowledged, to be redelivered whole
+                logger.error('failed to queue retries of messages: {}'.format(e))
+                continue
+            # messages which were not done are left unacknowledged to be redelivered (by reliable queues)
+            kwargs['queue'].ack_many([msg for msg, ok in zip(msgs, done) if ok])
     except errors.PontiacError as e:
         print('Pontiac Error. type: "{}", {}'.format(type(e), e))
     logger.info('notifier thread finished')
 
 
+def fill_batch(queue, msgs, max_items, window):
+    """Keep taking messages off the queue for a short window of time, so that more
+    messages can be sent together
+    """
+    deadline = time.time() + window
+    while len(msgs) < max_items:
+        more = queue.get_many(max_items - len(msgs), timeout=0)
+        msgs.extend(more)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        if not more:
+            time.sleep(min(remaining, window / 4))
+    return msgs
+
+
+def housekeeper_func(*args, **kwargs):
+    """Periodically run maintenance jobs of task queues (requeueing and purging expired tasks),
+    and poll APNS feedback service
+    """
+    logger.info('housekeeper thread started')
+    qs = kwargs['qs']
+    stop_flag = kwargs.get('stop_flag') or threading.Event()
+    feedback_polled = time.time()
+    while not stop_flag.wait(settings.QUEUE_HOUSEKEEPING_INTERVAL):
+        for key, q in qs.items():
+            try:
+                q.requeue_expired()
+                purged = q.purge_expired()
+                if purged:
+                    metrics.EXPIRED.inc(purged, stage='purge')
+                    logger.info('purged {} expired messages from queue "{}"'.format(purged, key))
+            except errors.DependencyError as e:
+                logger.error('housekeeping of queue "{}" failed: {}'.format(key, e))
+        feedback_interval = settings.TOKENS.get('feedback_interval')
+        if feedback_interval and time.time() - feedback_polled >= feedback_interval:
+            feedback_polled = time.time()
+            try:
+                count = notifier.poll_apns_feedback()
+                logger.info('APNS feedback reported {} dead tokens'.format(count))
+            except errors.PontiacError as e:
+                logger.error('polling APNS feedback failed: {}'.format(e))
+
+
+def promoter_func(*args, **kwargs):
+    """Put scheduled messages which are due in their queues, at most SCHEDULE['rate'] per second per queue"""
+    logger.info('promoter thread started')
+    qs = kwargs['qs']
+    stop_flag = kwargs.get('stop_flag') or threading.Event()
+    interval = settings.SCHEDULE['interval']
+    budget = max(1, int(settings.SCHEDULE['rate'] * interval))
+    while not stop_flag.wait(interval):
+        for key, q in qs.items():
+            try:
+                promoted = q.promote_due(budget)
+            except errors.DependencyError as e:
+                logger.error('promoting scheduled messages of queue "{}" failed: {}'.format(key, e))
+                continue
+            if promoted:
+                metrics.PROMOTED.inc(promoted, queue=q.key)
+                logger.debug('promoted {} scheduled messages to queue "{}"'.format(promoted, key))
+
+
 def run_multi_thread(args):
     """Run two threads for notification receiver (webservice) and notification processor (notifier)
     """
     logger.info('running in multi-thread mode')
-    if args.queuer == 'queue':
-        q_class = taskq.MemoryQueue
-    elif args.queuer == 'redis':
-        q_class = taskq.RedisQueue
+    qs = taskq.make_queues(args.queuer)
+
+    # room for webservice (or supervisor), housekeeper, promoter, and autoscalers or reactor. notifiers run on pools of their own
+    pool = ThreadPool(max_threads=len(qs) + 4, idle_timeout=settings.AUTOSCALE['idle_timeout'], name='service')
+    webservice_count = settings.THREAD_COUNT['WEBSERVICE']
+    if webservice_count > 1 and args.queuer != 'redis':
+        logger.warning('multiple webservice processes need a shared queue (--queuer redis). running one webservice thread')
+        webservice_count = 1
+    if webservice_count > 1:
+        # a twisted reactor is bound to a single thread, so more webservices means more processes
+        logger.info('creating {} webservice processes'.format(webservice_count))
+        supervisor = processes.Supervisor()
+        processes.add_webservices(supervisor, args, webservice_count)
+        pool.add_task({'func': supervisor.run, 'args': (), 'kwargs': {}}, name='supervisor', daemon=True)
+    else:
+        logger.info('creating 1 webservice thread')
+        pool.add_task({'func': webservice_func, 'args': (), 'kwargs': {'qs': qs}}, name='webservice', daemon=True)
+    notifier_pools = []
+    if settings.NOTIFIER['engine'] == 'async':
+        for provider, q in qs.items():
+            logger.info('creating async {} notifier engine'.format(provider))
+            engine.start_engine(q)
+        if webservice_count > 1:
+            # no webservice thread runs the reactor in this process
+            pool.add_task({'func': engine.reactor_func, 'args': (), 'kwargs': {}}, name='reactor', daemon=True)
     else:
-        raise NotImplementedError()
-
-    qs = {
-        'notif': q_class(key='notif'),
-    }
-
-    pool = ThreadPool(max_threads=sum(settings.THREAD_COUNT.values()))
-    logger.info('creating {} webservice threads'.format(settings.THREAD_COUNT['WEBSERVICE']))
-    pool.add_task({'func': webservice_func, 'args': (), 'kwargs': {'qs': qs}}, name='webservice', daemon=True)
-    logger.info('creating {} notification threads'.format(settings.THREAD_COUNT['NOTIFICATION']))
-    for i in range(settings.THREAD_COUNT['NOTIFICATION']):
-        pool.add_task({'func': notifier_func, 'args': (), 'kwargs': {'queue': qs['notif']}}, name='notifier{}'.format(i), daemon=True)
+        for provider, q in qs.items():
+            max_threads = settings.THREAD_COUNT[provider.upper()]
+            logger.info('creating {} to {} {} notification threads'.format(min(settings.AUTOSCALE['min_notifiers'], max_threads), max_threads, provider))
+            notifier_pool = ThreadPool(max_threads=max_threads, idle_timeout=settings.AUTOSCALE['idle_timeout'], name=provider)
+            notifier_pools.append(notifier_pool)
+            scaler = NotifierScaler(notifier_pool, q, provider)
+            scaler.check()
+            pool.add_task({'func': scaler.run, 'args': (), 'kwargs': {}}, name='{}-autoscaler'.format(provider), daemon=True)
+    pool.add_task({'func': housekeeper_func, 'args': (), 'kwargs': {'qs': qs}}, name='housekeeper', daemon=True)
+    pool.add_task({'func': promoter_func, 'args': (), 'kwargs': {'qs': qs}}, name='promoter', daemon=True)
     pool.wait_completion()
     pool.stop()
+    for notifier_pool in notifier_pools:
+        notifier_pool.stop()
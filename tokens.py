@@ -0,0 +1,401 @@
+from __future__ import unicode_literals, print_function, division, absolute_import
+from pprint import pprint
+import os
+import time
+import math
+import struct
+import bisect
+import hashlib
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+
+import six
+import redis
+
+import settings
+import errors
+import taskq
+
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    """Compact set membership test, with no false negatives and about error_rate false
+    positives for up to capacity items
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, item):
+        if isinstance(item, six.text_type):
+            item = item.encode('utf-8')
+        # double hashing: two independent hash values make all k positions
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for pos in self.positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(item))
+
+
+class TokenRegistry(object):
+    """Set of device tokens known to be dead, per notification service.
+    Lookups are answered by an in-memory bloom filter, and only the tokens it reports
+    as (possibly) dead are checked against the authoritative set.
+    """
+    def __init__(self):
+        self.filters = {}
+        self.lock = threading.Lock()
+
+    def filter(self, provider):
+        bloom = self.filters.get(provider)
+        if bloom is None:
+            with self.lock:
+                bloom = self.filters.get(provider)
+                if bloom is None:
+                    bloom = self.filters[provider] = BloomFilter(settings.TOKENS['bloom_capacity'], settings.TOKENS['bloom_error_rate'])
+        return bloom
+
+    def add(self, provider, tokens):
+        """Record tokens as dead"""
+        if not tokens:
+            return
+        bloom = self.filter(provider)
+        for token in tokens:
+            bloom.add(token)
+        self.store(provider, tokens)
+
+    def live(self, provider, tokens):
+        """Return the given tokens, except the ones known to be dead"""
+        bloom = self.filter(provider)
+        candidates = [token for token in tokens if token in bloom]
+        if not candidates:
+            return tokens
+        dead = self.confirm(provider, candidates)
+        if not dead:
+            return tokens
+        return [token for token in tokens if token not in dead]
+
+    def store(self, provider, tokens):
+        """Add tokens to the authoritative set"""
+        raise NotImplementedError()
+
+    def confirm(self, provider, tokens):
+        """Return the set of given tokens which are in the authoritative set"""
+        raise NotImplementedError()
+
+    def sync(self):
+        """Load tokens added by other processes into the filters"""
+        pass
+
+
+class MemoryTokenRegistry(TokenRegistry):
+    def __init__(self):
+        TokenRegistry.__init__(self)
+        self.sets = {}
+
+    def store(self, provider, tokens):
+        with self.lock:
+            self.sets.setdefault(provider, set()).update(tokens)
+
+    def confirm(self, provider, tokens):
+        return self.sets.get(provider, set()).intersection(tokens)
+
+
+class Changelog(object):
+    """Redis stream of the items added to a redis set or hash, for processes keeping a copy of them
+    (like a bloom filter) to load only the additions. Entries are numbered, so that a reader which
+    fell behind more than TOKENS['changelog_size'] entries, trimmed off the stream since, can tell.
+    """
+    # KEYS: stream, counter. ARGV: max length, items joined by newlines
+    APPEND_SCRIPT = """
+        local n = redis.call('INCR', KEYS[2])
+        return redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'n', n, 'items', ARGV[2])
+    """
+
+    def __init__(self, conn, key):
+        self.conn = conn
+        self.key = key
+        self.counter_key = '{}:count'.format(key)
+        self.cursor = None  # id of the last entry read, None until everything is loaded
+        self.count = 0  # number of the last entry read
+        self.append_script = conn.register_script(Changelog.APPEND_SCRIPT)
+
+    def append(self, items):
+        """Record items added. Items can not contain newlines."""
+        self.append_script(keys=[self.key, self.counter_key], args=[settings.TOKENS['changelog_size'], '\n'.join(items)])
+
+    def reset(self):
+        """Start reading after the last entry, before loading everything"""
+        last = self.conn.xrevrange(self.key, count=1)
+        if last:
+            self.cursor, self.count = last[0][0], int(last[0][1][b'n'])
+        else:
+            self.cursor, self.count = '0-0', 0
+
+    def read(self, batch=1000):
+        """Return the items added since the last read, or None if everything has to be loaded,
+        as some entries have been trimmed off since, or nothing was loaded yet
+        """
+        if self.cursor is None:
+            return None
+        items = []
+        while True:
+            found = self.conn.xread({self.key: self.cursor}, count=batch)
+            entries = found[0][1] if found else []
+            for entry_id, fields in entries:
+                n = int(fields[b'n'])
+                if n != self.count + 1:
+                    self.cursor = None
+                    return None
+                items.extend(fields[b'items'].decode('utf-8').split('\n'))
+                self.cursor, self.count = entry_id, n
+            if len(entries) < batch:
+                return items
+
+    def sync(self, add, load_all):
+        """Pass each item added since the last sync to add, or each item load_all returns,
+        if everything has to be loaded
+        """
+        try:
+            added = self.read()
+            if added is None:
+                self.reset()
+                added = load_all()
+            for item in added:
+                add(item)
+        except redis.RedisError:
+            # what was read may not all have been added
+            self.cursor = None
+            raise
+
+
+class RedisTokenRegistry(TokenRegistry):
+    """Registry shared by all processes, as a redis set per notification service.
+    Filters are filled from redis on start, and then every TOKENS['sync_interval'] seconds
+    on lookups, with the tokens added since, from a changelog along each set.
+    """
+    def __init__(self):
+        TokenRegistry.__init__(self)
+        self.conn = taskq.redis_connection()
+        self.changelogs = dict((provider, Changelog(self.conn, '{}:log'.format(self.key(provider))))
+                               for provider in settings.TOKENS['providers'])
+        self.synced = 0
+        try:
+            self.sync()
+        except errors.DependencyError as e:
+            # filters are loaded on a later lookup, dead tokens are not skipped until then
+            logger.error(e)
+
+    def live(self, provider, tokens):
+        if time.time() - self.synced > settings.TOKENS['sync_interval']:
+            try:
+                self.sync()
+            except errors.DependencyError as e:
+                logger.error(e)
+        return TokenRegistry.live(self, provider, tokens)
+
+    def key(self, provider):
+        return '{}:{}'.format(settings.TOKENS['redis_key'], provider)
+
+    def store(self, provider, tokens):
+        try:
+            self.conn.sadd(self.key(provider), *tokens)
+            if provider in self.changelogs:
+                self.changelogs[provider].append(tokens)
+        except redis.RedisError as e:
+            raise errors.DependencyError('failed to add dead tokens to redis: {}'.format(e))
+
+    def confirm(self, provider, tokens):
+        try:
+            pipe = self.conn.pipeline(transaction=False)
+            for token in tokens:
+                pipe.sismember(self.key(provider), token)
+            found = pipe.execute()
+        except redis.RedisError as e:
+            # better to send to a dead token than not to send to a live one
+            logger.error('failed to check dead tokens on redis: {}'.format(e))
+            return set()
+        return set(token for token, dead in zip(tokens, found) if dead)
+
+    def sync(self):
+        self.synced = time.time()
+        for provider, changelog in self.changelogs.items():
+            key = self.key(provider)
+            try:
+                changelog.sync(self.filter(provider).add, lambda: self.conn.sscan_iter(key, count=1000))
+            except redis.RedisError as e:
+                raise errors.DependencyError('failed to load dead tokens from redis: {}'.format(e))
+
+
+class CanonicalCache(object):
+    """Mappings of FCM registration ids to the canonical ids FCM reported for them.
+    Lookups are answered by an LRU cache of at most max_size mappings. If a redis connection
+    is given, all mappings are also kept in a redis hash, and lookups which miss the cache
+    go to redis only for ids an in-memory bloom filter reports as (possibly) mapped.
+    Mappings added are numbered, for scans to page through them in a stable order.
+    """
+    def __init__(self, max_size, conn=None):
+        self.max_size = max_size
+        self.conn = conn
+        self.mappings = OrderedDict()
+        self.serials = {}  # registration id to serial number of its mapping, for those added here
+        self.added = []  # (serial number, registration id) in order of addition, including replaced ones
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+        self.bloom = None
+        if self.conn is not None:
+            self.bloom = BloomFilter(settings.TOKENS['bloom_capacity'], settings.TOKENS['bloom_error_rate'])
+            self.changelog = Changelog(self.conn, '{}:log'.format(self.key))
+            self.synced = 0
+            try:
+                self.sync()
+            except errors.DependencyError as e:
+                # the filter is loaded on a later lookup
+                logger.error(e)
+
+    @property
+    def key(self):
+        return settings.TOKENS['canonical_redis_key']
+
+    def remember(self, token, canonical):
+        # called with lock held
+        self.mappings.pop(token, None)
+        self.mappings[token] = canonical
+        while len(self.mappings) > self.max_size:
+            self.serials.pop(self.mappings.popitem(last=False)[0], None)
+
+    def add(self, mappings):
+        """Record a dict of registration id to canonical id"""
+        if not mappings:
+            return
+        with self.lock:
+            for token, canonical in mappings.items():
+                self.remember(token, canonical)
+                serial = next(self.counter)
+                self.serials[token] = serial
+                self.added.append((serial, token))
+            if len(self.added) > 2 * len(self.serials) + 1000:
+                # drop entries of replaced and evicted mappings
+                self.added = [(serial, token) for serial, token in self.added if self.serials.get(token) == serial]
+        if self.conn is not None:
+            for token in mappings:
+                self.bloom.add(token)
+            try:
+                self.conn.hset(self.key, mapping=mappings)
+                self.changelog.append(list(mappings))
+            except redis.RedisError as e:
+                raise errors.DependencyError('failed to add canonical ids to redis: {}'.format(e))
+
+    def lookup(self, tokens):
+        """Return a dict of the given tokens which have canonical ids, to their canonical ids"""
+        found = {}
+        missed = []
+        with self.lock:
+            for token in tokens:
+                canonical = self.mappings.get(token)
+                if canonical is not None:
+                    self.remember(token, canonical)  # mark as recently used
+                    found[token] = canonical
+                else:
+                    missed.append(token)
+        if self.conn is None or not missed:
+            return found
+        if time.time() - self.synced > settings.TOKENS['sync_interval']:
+            try:
+                self.sync()
+            except errors.DependencyError as e:
+                logger.error(e)
+        missed = [token for token in missed if token in self.bloom]
+        if not missed:
+            return found
+        try:
+            values = self.conn.hmget(self.key, missed)
+        except redis.RedisError as e:
+            logger.error('failed to look canonical ids up on redis: {}'.format(e))
+            return found
+        loaded = dict((token, value.decode('utf-8')) for token, value in zip(missed, values) if value is not None)
+        with self.lock:
+            for token, canonical in loaded.items():
+                self.remember(token, canonical)
+        found.update(loaded)
+        return found
+
+    def rewrite(self, tokens):
+        """Replace tokens with their canonical ids, and drop duplicates, keeping the order"""
+        found = self.lookup(tokens)
+        seen = set()
+        result = []
+        for token in tokens:
+            token = found.get(token, token)
+            if token not in seen:
+                seen.add(token)
+                result.append(token)
+        return result
+
+    def scan(self, cursor=0, count=1000):
+        """Return next cursor (0 when done) and a dict of up to about count mappings, starting at cursor"""
+        if self.conn is not None:
+            try:
+                cursor, mappings = self.conn.hscan(self.key, cursor=cursor, count=count)
+            except redis.RedisError as e:
+                raise errors.DependencyError('failed to read canonical ids from redis: {}'.format(e))
+            return cursor, dict((k.decode('utf-8'), v.decode('utf-8')) for k, v in mappings.items())
+        # cursors are serial numbers of mappings, which lookups do not change, unlike the LRU order
+        mappings = {}
+        with self.lock:
+            for i in range(bisect.bisect_left(self.added, (cursor,)), len(self.added)):
+                serial, token = self.added[i]
+                if self.serials.get(token) != serial:
+                    continue
+                if len(mappings) >= count:
+                    return serial, mappings
+                mappings[token] = self.mappings[token]
+        return 0, mappings
+
+    def sync(self):
+        """Load ids mapped by other processes into the bloom filter"""
+        self.synced = time.time()
+        try:
+            self.changelog.sync(self.bloom.add, lambda: (token for token, _ in self.conn.hscan_iter(self.key, count=1000)))
+        except redis.RedisError as e:
+            raise errors.DependencyError('failed to load canonical ids from redis: {}'.format(e))
+
+
+_registry = None
+_registry_pid = None
+_registry_lock = threading.Lock()
+_canonical = None
+_canonical_pid = None
+
+
+def registry():
+    """Return the dead token registry of this process, of the configured type"""
+    global _registry, _registry_pid
+    with _registry_lock:
+        if _registry is None or _registry_pid != os.getpid():
+            if settings.TOKENS['registry'] == 'redis':
+                _registry = RedisTokenRegistry()
+            else:
+                _registry = MemoryTokenRegistry()
+            _registry_pid = os.getpid()
+        return _registry
+
+
+def canonical_cache():
+    """Return the FCM canonical id cache of this process, kept in redis too with redis registry"""
+    global _canonical, _canonical_pid
+    with _registry_lock:
+        if _canonical is None or _canonical_pid != os.getpid():
+            conn = taskq.redis_connection() if settings.TOKENS['registry'] == 'redis' else None
+            _canonical = CanonicalCache(settings.TOKENS['canonical_max_size'], conn=conn)
+            _canonical_pid = os.getpid()
+        return _canonical
@@ -2,42 +2,118 @@
 from __future__ import unicode_literals, print_function, division, absolute_import
 from pprint import pprint
 import logging
+import os
 import sys
 import cgi
+import socket
+import threading
+import time
 
 import simplejson as json
 import jsonschema
 
 from twisted.web import server, resource
-from twisted.internet import reactor, endpoints
+from twisted.internet import reactor, endpoints, defer, threads, task
+from twisted.python import threadpool, failure
 
 import settings
 import errors
 import taskq
+import metrics
+import tokens
+import notifier
 
 
 logger = logging.getLogger(__name__)
 
 
 class GetStat(resource.Resource):
+    """Render collected metrics as a json document"""
     isLeaf = True
+    content_type = b'application/json'
+
+    def __init__(self, *args, **kwargs):
+        self.qs = kwargs.pop('qs')
+        self.threadpool = kwargs.pop('threadpool')
+        resource.Resource.__init__(self, *args, **kwargs)
 
     def render_GET(self, request):
+        # queue depths need blocking queue calls, so they are refreshed on the thread pool
+        d = defer_to_threadpool(self.threadpool, metrics.update_queue_depths, self.qs)
+        d.addBoth(self._render, request)
+        request.notifyFinish().addErrback(lambda err: d.cancel())
+        return server.NOT_DONE_YET
+
+    def _render(self, result, request):
+        if isinstance(result, failure.Failure):
+            if result.check(defer.CancelledError):
+                return
+            logger.warning('failed to update queue depths: {}'.format(result.value))
+        request.setResponseCode(200)
+        request.setHeader(b'content-type', self.content_type)
+        request.write(self.content().encode('utf-8'))
+        request.finish()
+
+    def content(self):
+        return json.dumps(metrics.REGISTRY.as_dict(), indent=4, separators=(',', ': '))
+
+
+class GetMetrics(GetStat):
+    """Render collected metrics in Prometheus text exposition format"""
+    content_type = b'text/plain; version=0.0.4'
+
+    def content(self):
+        return metrics.REGISTRY.exposition()
+
+
+class GetCanonical(resource.Resource):
+    """Render FCM canonical id mappings as a json document, a page at a time.
+    Query arguments are cursor (0 to start, the returned one to continue) and count.
+    Mappings kept in memory are only known here if notifiers run in this process (local_notifiers).
+    """
+    isLeaf = True
+
+    def __init__(self, *args, **kwargs):
+        self.threadpool = kwargs.pop('threadpool')
+        self.local_notifiers = kwargs.pop('local_notifiers', True)
+        resource.Resource.__init__(self, *args, **kwargs)
+
+    def render_GET(self, request):
+        if not self.local_notifiers and settings.TOKENS['registry'] != 'redis':
+            return resource.ErrorPage(501, 'NOT_IMPLEMENTED', 'Message: canonical ids are kept by notifier processes. '
+                                      'set TOKENS["registry"] to "redis" to share them').render(request)
         try:
-            request.setResponseCode(200)
-            request.setHeader(b'content-type', b'text/plain')
-            content = 'I am stat\n'
-            return content.encode('ascii')
-        except Exception as e:
-            return resource.ErrorPage(500, 'Error', 'Message: {}'.format(e)).render(request)
+            cursor = int(request.args.get(b'cursor', [0])[0])
+            count = min(int(request.args.get(b'count', [1000])[0]), 10000)
+        except ValueError:
+            return resource.ErrorPage(400, 'BAD_REQUEST', 'Message: invalid cursor or count').render(request)
+        d = defer_to_threadpool(self.threadpool, tokens.canonical_cache().scan, cursor, count)
+        d.addCallbacks(self._render, self._failed, callbackArgs=(request,), errbackArgs=(request,))
+        request.notifyFinish().addErrback(lambda err: d.cancel())
+        return server.NOT_DONE_YET
+
+    def _render(self, result, request):
+        cursor, mappings = result
+        request.setResponseCode(200)
+        request.setHeader(b'content-type', b'application/json')
+        content = json.dumps({'cursor': cursor, 'mappings': mappings}, ensure_ascii=True, sort_keys=True)
+        request.write(content.encode('ascii'))
+        request.finish()
+
+    def _failed(self, err, request):
+        if err.check(defer.CancelledError):
+            return
+        request.write(resource.ErrorPage(500, 'Error', 'Message: {}'.format(err.value)).render(request))
+        request.finish()
 
 
 class AddNotif(resource.Resource):
+    """Accept notification messages, putting each one in the queue of its notification service"""
     isLeaf = True
 
     def __init__(self, *args, **kwargs):
-        self.queue = kwargs.pop('queue')
-        self.number_requests = 0
+        self.queues = kwargs.pop('queues')
+        self.threadpool = kwargs.pop('threadpool')
         try:
             self.schema = json.loads(open(settings.SCHEMA['NOTIFICATION']).read())
         except (KeyError, IOError, ValueError):
@@ -49,57 +125,133 @@ class AddNotif(resource.Resource):
         return content.encode('ascii')
 
     def render_POST(self, request):
-        self.number_requests += 1
         try:
             data_str = cgi.escape(request.content.read())
             logger.debug('post request data string: "{}"'.format(data_str))
             data_dict = json.loads(data_str)
         except ValueError as e:
-            return resource.ErrorPage(400, 'BAD_REQUEST', 'Message: invalid json document').render(request)
+            return self._reject(request, 'invalid_json')
 
         try:
             jsonschema.validate(data_dict, self.schema)
         except jsonschema.ValidationError as e:
-            return resource.ErrorPage(400, 'BAD_REQUEST', 'Message: invalid json document').render(request)
+            return self._reject(request, 'invalid_schema')
 
-        try:
-            num_notif = 0
-            for notif in data_dict:
-                self.queue.put(notif)
-                num_notif += 1
-            request.setResponseCode(202)
-            request.setHeader(b'content-type', b'application/json')
-            result = {
-                'msg_accepted': num_notif,
-                'queue_pending': self.queue.size(),
-                'total_requests': self.number_requests
-            }
-            content = json.dumps(result, ensure_ascii=True, indent=4, separators=(',', ': '), sort_keys=True)
-            logger.debug('response string: "{}"'.format(content))
-            return content.encode('ascii')
-        except Exception as e:
-            return resource.ErrorPage(500, 'Error', 'Message: {}'.format(e)).render(request)
-
-    def _responseFailed(self, err, call):
+        # expiry is parsed once here, so that expired messages can be purged from queues, and dropped cheaply
+        for msg in data_dict:
+            if 'expiry_time' in msg:
+                try:
+                    msg['expires_at'] = notifier.parse_expiry(msg.pop('expiry_time'))
+                except errors.DataValidationError:
+                    return self._reject(request, 'invalid_expiry', 'invalid expiry time')
+
+        # oversized messages would only be rejected by notification services
+        truncate = settings.PAYLOAD.get('oversize') == 'truncate'
+        for msg in data_dict:
+            body = msg['body']
+            if not notifier.fit_payload(msg, truncate=truncate):
+                return self._reject(request, 'payload_too_large', 'payload of a message is too large')
+            if msg['body'] != body:
+                metrics.TRUNCATED.inc()
+
+        now = time.time()
+        accepted = [msg for msg in data_dict if msg.get('expires_at', now) >= now]
+        if len(accepted) < len(data_dict):
+            metrics.EXPIRED.inc(len(data_dict) - len(accepted), stage='ingestion')
+        scheduled = sum(1 for msg in accepted if msg.get('send_at', now) > now)
+        if scheduled:
+            metrics.SCHEDULED.inc(scheduled)
+
+        by_provider = {}
+        for msg in accepted:
+            by_provider.setdefault(msg['type'], []).append(msg)
+
+        # queue depths are refreshed in the background (see Service), as getting them may block
+        high_water = settings.WEBSERVICE.get('queue_high_water')
+        if high_water and any(metrics.QUEUE_DEPTH.get(0, queue=self.queues[provider].key) > high_water for provider in by_provider):
+            metrics.REQUESTS.inc(result='rejected')
+            metrics.REJECTIONS.inc(reason='queue_full')
+            request.setHeader(b'retry-after', str(settings.WEBSERVICE.get('retry_after', 5)).encode('ascii'))
+            return resource.ErrorPage(429, 'TOO_MANY_REQUESTS', 'Message: queue is full, retry later').render(request)
+
+        # queue operations are blocking, so they are done on the thread pool not to stall the reactor
+        d = defer_to_threadpool(self.threadpool, self.enqueue, by_provider)
+        d.addCallback(self._enqueued, request, len(data_dict), len(accepted))
+        d.addErrback(self._failed, request)
+        request.notifyFinish().addErrback(self._responseFailed, d)
+        return server.NOT_DONE_YET
+
+    def _reject(self, request, reason, message='invalid json document'):
+        metrics.REQUESTS.inc(result='rejected')
+        metrics.REJECTIONS.inc(reason=reason)
+        return resource.ErrorPage(400, 'BAD_REQUEST', 'Message: {}'.format(message)).render(request)
+
+    def enqueue(self, by_provider):
+        """Put lists of messages in the queues of their services. Returns the sizes of the queues afterwards."""
+        return dict((provider, self.queues[provider].put_many(msgs)) for provider, msgs in by_provider.items())
+
+    def _enqueued(self, queue_sizes, request, num_notif, num_enqueued):
+        metrics.REQUESTS.inc(result='accepted')
+        metrics.ENQUEUED.inc(num_enqueued)
+        for provider, queue_size in queue_sizes.items():
+            metrics.QUEUE_DEPTH.set(queue_size, queue=self.queues[provider].key)
+        request.setResponseCode(202)
+        request.setHeader(b'content-type', b'application/json')
+        result = {
+            'msg_accepted': num_notif,
+            'queue_pending': sum(queue_sizes.values()),
+            'total_requests': metrics.REQUESTS.total()
+        }
+        content = json.dumps(result, ensure_ascii=True, indent=4, separators=(',', ': '), sort_keys=True)
+        logger.debug('response string: "{}"'.format(content))
+        request.write(content.encode('ascii'))
+        request.finish()
+
+    def _failed(self, err, request):
+        metrics.REQUESTS.inc(result='rejected')
+        if err.check(defer.CancelledError):
+            metrics.REJECTIONS.inc(reason='client_disconnected')
+            return
+        metrics.REJECTIONS.inc(reason='queue_error')
+        request.write(resource.ErrorPage(500, 'Error', 'Message: {}'.format(err.value)).render(request))
+        request.finish()
+
+    def _responseFailed(self, err, d):
         """To cancel deferred calls on this request"""
-        call.cancel()
+        d.cancel()
         logger.warning('async response interrupted: "{}"'.format(err))
 
-    def _delayedRender(self, request):
-        request.write("<html><body>Sorry to keep you waiting.</body></html>")
-        request.finish()
 
-    def render_PST(self, request):
-        # TODO: for pushing asynchronously to redis (or other task queue)
-        call = reactor.callLater(5, self._delayedRender, request)
-        request.notifyFinish().addErrback(self._responseFailed, call)
-        return server.NOT_DONE_YET
+def defer_to_threadpool(pool, func, *args, **kwargs):
+    """Run a blocking function on the given thread pool, returning a Deferred for its result.
+    Cancelling the Deferred before a pool thread picks the call up prevents it from running at all.
+    """
+    cancelled = threading.Event()
+
+    def run():
+        if cancelled.is_set():
+            raise defer.CancelledError()
+        return func(*args, **kwargs)
+
+    def done(result):
+        if not d.called:
+            d.callback(result)
+
+    def failed(err):
+        if not d.called:
+            d.errback(err)
+
+    d = defer.Deferred(lambda _: cancelled.set())
+    threads.deferToThreadPool(reactor, pool, run).addCallbacks(done, failed)
+    return d
 
 
 def get_root_resource(*args, **kwargs):
     root = resource.Resource()
-    root.putChild('stat', GetStat())
-    root.putChild('notif', AddNotif(queue=kwargs['qs']['notif']))
+    root.putChild('stat', GetStat(qs=kwargs['qs'], threadpool=kwargs['threadpool']))
+    root.putChild('metrics', GetMetrics(qs=kwargs['qs'], threadpool=kwargs['threadpool']))
+    root.putChild('canonical', GetCanonical(threadpool=kwargs['threadpool'], local_notifiers=kwargs.get('local_notifiers', True)))
+    root.putChild('notif', AddNotif(queues=kwargs['qs'], threadpool=kwargs['threadpool']))
     return root
 
 
@@ -107,22 +259,68 @@ def get_site(*args, **kwargs):
     encoders = [
         server.GzipEncoderFactory()
     ]
-    wrapped = resource.EncodingResourceWrapper(get_root_resource(qs=kwargs['qs']), encoders)
+    root = get_root_resource(qs=kwargs['qs'], threadpool=kwargs['threadpool'], local_notifiers=kwargs.get('local_notifiers', True))
+    wrapped = resource.EncodingResourceWrapper(root, encoders)
     site = server.Site(wrapped)
     return site
 
 
+def listen_socket(reuse_port=False):
+    """Create a listening socket on the configured http address"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((settings.HTTP_SOCKET['host'], settings.HTTP_SOCKET['port']))
+    sock.listen(settings.HTTP_SOCKET.get('backlog', 128))
+    sock.setblocking(False)
+    return sock
+
+
 class Service(object):
     """Encapsulate HTTP service logic
     """
     def __init__(self, *args, **kwargs):
         self.qs = kwargs['qs']
+        self.listen_fd = kwargs.get('listen_fd')
+        self.reuse_port = kwargs.get('reuse_port', False)
+        self.local_notifiers = kwargs.get('local_notifiers', True)  # whether notifiers run in this process
+        self.watch_parent = kwargs.get('watch_parent', False)
 
     def run(self, *args, **kwargs):
-        reactor.listenTCP(settings.HTTP_SOCKET['port'], get_site(qs=self.qs))
+        pool = threadpool.ThreadPool(minthreads=1, maxthreads=settings.WEBSERVICE['queue_threads'], name='webservice-queue')
+        reactor.callWhenRunning(pool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+        site = get_site(qs=self.qs, threadpool=pool, local_notifiers=self.local_notifiers)
+        if self.listen_fd is not None:
+            # listening socket inherited from the parent process
+            reactor.adoptStreamPort(self.listen_fd, socket.AF_INET, site)
+        elif self.reuse_port:
+            # one of several webservice processes, each binding its own socket
+            sock = listen_socket(reuse_port=True)
+            reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, site)
+            sock.close()
+        else:
+            reactor.listenTCP(settings.HTTP_SOCKET['port'], site)
         #endpoints.serverFromString(reactor, "tcp:8080").listen(site)
+        if settings.WEBSERVICE.get('queue_high_water'):
+            task.LoopingCall(self._update_queue_depths, pool).start(settings.WEBSERVICE.get('depth_interval', 1))
+        if self.watch_parent:
+            task.LoopingCall(self._check_parent, os.getppid()).start(settings.PROCESS['monitor_interval'], now=False)
         reactor.run(installSignalHandlers=0)
 
+    def _update_queue_depths(self, pool):
+        """Refresh queue depths checked by AddNotif. The next refresh waits for this one to finish."""
+        d = threads.deferToThreadPool(reactor, pool, metrics.update_queue_depths, self.qs)
+        d.addErrback(lambda err: logger.warning('failed to update queue depths: {}'.format(err.getErrorMessage())))
+        return d
+
+    def _check_parent(self, parent_pid):
+        """Stop serving when the supervising process is gone"""
+        if os.getppid() != parent_pid:
+            logger.warning('parent process {} is gone. stopping webservice'.format(parent_pid))
+            reactor.stop()
+
 
 if __name__ == '__main__':
     http_service = Service()